@@ -23,6 +23,8 @@ from rest_framework import permissions
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 
+from chatbot.metrics import metrics_view
+
 schema_view = get_schema_view(
     openapi.Info(
         title="Chatbot API",
@@ -37,6 +39,7 @@ urlpatterns = [
     path('', RedirectView.as_view(url='/api/chat/', permanent=False)),
     path('admin/', admin.site.urls),
     path('api/', include('chatbot.urls')),
+    path('metrics', metrics_view),
     re_path(r'^swagger/$', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
 ]+ static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 
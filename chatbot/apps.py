@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class ChatbotConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chatbot'
+
+    def ready(self):
+        # Signal receivers (blob reference counting, auth cache invalidation,
+        # DB query metrics)
+        from . import authentication, blobs, metrics  # noqa: F401
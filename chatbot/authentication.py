@@ -0,0 +1,207 @@
+"""
+Token authentication for the chat API, with guests for anonymous callers.
+
+A token's (user, token) pair is cached for AUTH_CACHE_TTL seconds under a
+hash of its key, so most requests authenticate without a query. Deleting a
+token (logout, rotation, deleting the user) or deactivating its user drops
+the cached entry; other changes to the user show up within the TTL.
+Guest users are cached the same way.
+
+The entry is only dropped from this process's cache unless the default
+cache is shared (Redis). With per-process LocMemCache a revoked token would
+stay valid in other workers for up to the TTL, so AUTH_CACHE_TTL defaults
+to 0 (no caching) there; see backend/settings.py.
+"""
+import hashlib
+import uuid
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.signing import BadSignature, TimestampSigner
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework.authentication import TokenAuthentication, get_authorization_header
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+
+from . import metrics
+from .models import GuestSession
+
+
+def token_cache_key(key):
+    return f"auth_token:{hashlib.sha256(key.encode()).hexdigest()}"
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    def authenticate_credentials(self, key):
+        if not settings.AUTH_CACHE_TTL:
+            return super().authenticate_credentials(key)
+        cache_key = token_cache_key(key)
+        credentials = cache.get(cache_key)
+        metrics.record_cache("auth_token", credentials is not None)
+        if credentials is None:
+            credentials = super().authenticate_credentials(key)
+            cache.set(cache_key, credentials, timeout=settings.AUTH_CACHE_TTL)
+        return credentials
+
+
+class LenientTokenAuthentication(CachedTokenAuthentication):
+    def authenticate(self, request):
+        try:
+            return super().authenticate(request)
+        except AuthenticationFailed:
+            return None
+
+
+@receiver(post_delete, sender=Token)
+def forget_token(sender, instance, **kwargs):
+    cache.delete(token_cache_key(instance.key))
+
+
+@receiver(post_save, sender=User)
+def forget_inactive_user_tokens(sender, instance, **kwargs):
+    if not instance.is_active:
+        keys = Token.objects.filter(user_id=instance.pk).values_list("key", flat=True)
+        cache.delete_many([token_cache_key(key) for key in keys])
+
+
+# ----------------------------------------
+# GUEST SESSIONS
+# ----------------------------------------
+# Callers without a token get a guest user of their own. Its id, signed and
+# valid for GUEST_SESSION_TTL seconds, goes back in the X-Guest-Token
+# response header (chatbot/middleware.py); clients send it in the same
+# request header to keep their conversations. The user is created only
+# when a write needs an owner (creating a conversation), so crawlers and
+# clients that never send the header back don't add users, and is removed
+# by tasks.reap_guest_sessions once it expires.
+GUEST_HEADER = "X-Guest-Token"
+guest_signer = TimestampSigner(salt="chatbot.guest")
+
+
+def guest_cache_key(user_id):
+    return f"guest_user:{user_id}"
+
+
+def underlying_request(request):
+    # DRF wraps the HttpRequest; the middleware only sees the original.
+    return getattr(request, "_request", request)
+
+
+def read_guest_token(request):
+    """The guest user id in the request's X-Guest-Token, or None if absent, forged or expired."""
+    value = request.headers.get(GUEST_HEADER)
+    if not value:
+        return None
+    try:
+        return int(guest_signer.unsign(value, max_age=settings.GUEST_SESSION_TTL))
+    except (BadSignature, ValueError):
+        return None
+
+
+def create_guest_user():
+    with transaction.atomic():
+        user = User(username=f"guest_{uuid.uuid4().hex}")
+        user.set_unusable_password()
+        user.save()
+        GuestSession.objects.create(
+            user=user,
+            expires_at=timezone.now() + timedelta(seconds=settings.GUEST_SESSION_TTL),
+        )
+
+    # tasks -> usage -> ratelimit imports this module.
+    from .tasks import submit_guest_reaper
+    submit_guest_reaper()
+    return user
+
+
+def get_guest_user(request, create=False):
+    """
+    The caller's guest user, or None if the request carries no valid guest
+    token. ``create=True`` issues a new guest user instead of returning None.
+    """
+    http_request = underlying_request(request)
+    if hasattr(http_request, "_guest_user"):
+        return http_request._guest_user
+
+    user = None
+    user_id = read_guest_token(http_request)
+    if user_id is None and not create:
+        return None
+    if user_id is not None:
+        user = cache.get(guest_cache_key(user_id)) if settings.AUTH_CACHE_TTL else None
+        if user is None:
+            user = User.objects.filter(id=user_id, guest_session__isnull=False).first()
+            if user is not None and settings.AUTH_CACHE_TTL:
+                cache.set(guest_cache_key(user_id), user, timeout=settings.AUTH_CACHE_TTL)
+
+    if user is None:
+        if not create:
+            return None
+        user = create_guest_user()
+        http_request.guest_token = guest_signer.sign(str(user.id))
+
+    http_request._guest_user = user
+    return user
+
+
+def get_chat_user(request, create=False):
+    """The token user, else the guest user (see get_guest_user); None for an unknown guest."""
+    if request.user and request.user.is_authenticated:
+        return request.user
+    return get_guest_user(request, create)
+
+
+# ----------------------------------------
+# ASYNC VARIANTS
+# ----------------------------------------
+# DRF authentication is sync-only; the async chat views use these instead.
+# The result is memoized on the request so decorators (rate limiting) and
+# the view share a single token lookup.
+async def aauthenticate_token(request):
+    """Async LenientTokenAuthentication: a missing or bad token means guest."""
+    if hasattr(request, "_token_user"):
+        return request._token_user
+
+    request._token_user = None
+    auth = get_authorization_header(request).split()
+    if len(auth) != 2 or auth[0].lower() != b"token":
+        return None
+
+    try:
+        key = auth[1].decode()
+    except UnicodeError:
+        return None
+
+    cache_key = token_cache_key(key)
+    credentials = None
+    if settings.AUTH_CACHE_TTL:
+        credentials = await cache.aget(cache_key)
+        metrics.record_cache("auth_token", credentials is not None)
+    if credentials is None:
+        try:
+            token = await Token.objects.select_related("user").aget(key=key)
+        except Token.DoesNotExist:
+            return None
+        if not token.user.is_active:
+            return None
+        credentials = (token.user, token)
+        if settings.AUTH_CACHE_TTL:
+            await cache.aset(cache_key, credentials, timeout=settings.AUTH_CACHE_TTL)
+
+    request._token_user = credentials[0]
+    return request._token_user
+
+
+async def aget_chat_user(request, create=False):
+    user = await aauthenticate_token(request)
+    if user is not None:
+        return user
+    if hasattr(request, "_guest_user"):
+        return request._guest_user
+    return await sync_to_async(get_guest_user)(request, create)
@@ -0,0 +1,71 @@
+"""
+Content-addressed storage for uploaded files.
+
+Each distinct file (by sha256) is stored once as a FileBlob under
+chat_blobs/; messages reference it and FileBlob.ref_count counts them.
+Deleting a message, directly or through its conversation, releases its
+reference, and the last release deletes the blob and its file.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .models import ChatMessage, FileBlob
+
+
+def blob_name(digest):
+    return f"{digest[:2]}/{digest}"
+
+
+def create_blob(file, digest, mime_type):
+    """Store ``file`` as a new blob; returns (blob, created), False if a concurrent upload won."""
+    blob = FileBlob(sha256=digest, size=file.size, mime_type=mime_type)
+    blob.file.save(blob_name(digest), file, save=False)
+    try:
+        with transaction.atomic():
+            blob.save()
+    except IntegrityError:
+        # A concurrent upload of the same content stored it first.
+        blob.file.delete(save=False)
+        return FileBlob.objects.select_for_update().get(sha256=digest), False
+    return blob, True
+
+
+def attach_upload(conversation, prompt, file, digest, mime_type):
+    """
+    Save the user message for an upload, storing the file only if its
+    content is new. The reference and the message commit together.
+    """
+    created = None
+    try:
+        with transaction.atomic():
+            blob = FileBlob.objects.select_for_update().filter(sha256=digest).first()
+            if blob is None:
+                blob, new = create_blob(file, digest, mime_type)
+                created = blob if new else None
+            FileBlob.objects.filter(pk=blob.pk).update(ref_count=F("ref_count") + 1)
+            return ChatMessage.objects.create(
+                conversation=conversation,
+                role="user",
+                content=prompt,
+                file=blob.file.name,
+                blob=blob,
+            )
+    except BaseException:
+        # The file was written before the commit; its row is gone with the
+        # rollback, and a leftover would make the next copy a suffixed one.
+        if created is not None:
+            created.file.delete(save=False)
+        raise
+
+
+@receiver(post_delete, sender=ChatMessage)
+def release_blob(sender, instance, **kwargs):
+    if instance.blob_id is None:
+        return
+    FileBlob.objects.filter(pk=instance.blob_id).update(ref_count=F("ref_count") - 1)
+    orphan = FileBlob.objects.filter(pk=instance.blob_id, ref_count__lte=0).first()
+    if orphan is not None:
+        orphan.delete()
+        transaction.on_commit(lambda: orphan.file.delete(save=False))
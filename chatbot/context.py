@@ -0,0 +1,198 @@
+"""
+Token-budgeted chat context shared by the chat, stream and regenerate views.
+
+The newest messages that fit CONTEXT_TOKEN_BUDGET are kept in a cached
+per-conversation window. A new turn is appended to the window instead of
+re-querying the transcript; anything that deletes messages invalidates it
+and the next build reloads only the newest rows. Older messages come back
+through retrieval memory when relevant.
+
+Concurrent turns of one conversation can append at the same time, so the
+window is versioned: every append or invalidation increments an atomic
+counter in the cache and the window records the version it reflects. An
+append only extends the window it would have been built on (one version
+back), and a build only uses a window whose version is current; anything
+else is reloaded from the database rather than risk dropping a message.
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from . import memory, metrics
+from .models import ChatMessage
+
+
+def estimate_tokens(text):
+    # ~4 characters per token is close enough for budgeting and costs nothing.
+    return len(text or "") // 4 + 1
+
+
+def window_key(conversation_id):
+    return f"context_window_{conversation_id}"
+
+
+def version_key(conversation_id):
+    return f"context_window_version_{conversation_id}"
+
+
+async def anext_version(conversation_id):
+    """Increment the window version; None if it was missing (no window can be trusted)."""
+    key = version_key(conversation_id)
+    if await cache.aadd(key, 0, timeout=settings.CONTEXT_WINDOW_TTL):
+        return None
+    try:
+        return await cache.aincr(key)
+    except ValueError:
+        # Expired between add() and incr().
+        return None
+
+
+async def acurrent_version(conversation_id):
+    key = version_key(conversation_id)
+    version = await cache.aget(key)
+    if version is None:
+        await cache.aadd(key, 0, timeout=settings.CONTEXT_WINDOW_TTL)
+        version = await cache.aget(key)
+    return version
+
+
+def trim_to_budget(entries, budget):
+    """Drop the oldest entries until the rest fit the budget (newest always kept)."""
+    total = sum(entry["tokens"] for entry in entries)
+    start = 0
+    while total > budget and start < len(entries) - 1:
+        total -= entries[start]["tokens"]
+        start += 1
+    return entries[start:]
+
+
+def to_entry(message):
+    return {
+        "id": message.id,
+        "role": message.role,
+        "content": message.content or "",
+        "tokens": estimate_tokens(message.content),
+    }
+
+
+async def aload_window(conversation):
+    # Read before the rows: a turn saved meanwhile makes this window stale, not wrong.
+    version = await acurrent_version(conversation.id)
+    budget = settings.CONTEXT_TOKEN_BUDGET
+    entries = []
+    total = 0
+    newest_first = ChatMessage.objects.filter(
+        conversation=conversation
+    ).order_by("-timestamp", "-id")[:settings.CONTEXT_MAX_MESSAGES]
+
+    async for message in newest_first:
+        entry = to_entry(message)
+        if entries and total + entry["tokens"] > budget:
+            break
+        entries.append(entry)
+        total += entry["tokens"]
+
+    entries.reverse()
+    if version is not None:
+        window = {"version": version, "entries": entries}
+        await cache.aset(window_key(conversation.id), window, timeout=settings.CONTEXT_WINDOW_TTL)
+    return entries
+
+
+async def aappend_message(*messages):
+    """Append freshly saved messages of one conversation to its cached window, if one exists."""
+    conversation_id = messages[0].conversation_id
+    version = await anext_version(conversation_id)
+    key = window_key(conversation_id)
+    window = await cache.aget(key)
+    if window is None:
+        return
+    if version is None or window["version"] != version - 1:
+        # Another turn changed the conversation since this window was cached.
+        await cache.adelete(key)
+        return
+
+    # A window loaded after these messages were saved already has them.
+    known = {entry["id"] for entry in window["entries"]}
+    entries = window["entries"] + [to_entry(m) for m in messages if m.id not in known]
+    entries = trim_to_budget(entries, settings.CONTEXT_TOKEN_BUDGET)[-settings.CONTEXT_MAX_MESSAGES:]
+    await cache.aset(key, {"version": version, "entries": entries}, timeout=settings.CONTEXT_WINDOW_TTL)
+
+
+async def ainvalidate_window(conversation_id):
+    # The new version also voids a window being loaded right now.
+    await anext_version(conversation_id)
+    await cache.adelete(window_key(conversation_id))
+
+
+async def acached_window(conversation_id):
+    """The cached window entries if they are current, else None."""
+    found = await cache.aget_many([window_key(conversation_id), version_key(conversation_id)])
+    window = found.get(window_key(conversation_id))
+    if window is None or window["version"] != found.get(version_key(conversation_id)):
+        return None
+    return window["entries"]
+
+
+def within_budget(messages, budget):
+    """Keep messages in the given order while they fit ``budget``; return them oldest first."""
+    chosen = []
+    used = 0
+    for message in messages:
+        tokens = estimate_tokens(message.content)
+        if used + tokens <= budget:
+            chosen.append(message)
+            used += tokens
+    return sorted(chosen, key=lambda m: (m.timestamp, m.id))
+
+
+def memory_entry(messages):
+    lines = "\n".join(f"{m.role}: {m.content}" for m in messages)
+    return {
+        "role": "user",
+        "content": f"Relevant earlier messages:\n{lines}",
+    }
+
+
+def summary_entry(conversation):
+    return {
+        "role": "user",
+        "content": f"Summary of the earlier conversation:\n{conversation.summary}",
+    }
+
+
+async def abuild_history(conversation, pending=(), exclude=()):
+    """
+    Return the model context: the summary (if any), older messages relevant
+    to the latest user message (chatbot/memory.py) and the newest messages
+    within budget.
+
+    ``pending`` holds turns (role/content dicts) not saved yet, such as the
+    user message of a turn that is persisted together with the reply.
+    ``exclude`` holds ids of saved messages to leave out, such as the reply
+    being regenerated.
+    """
+    entries = await acached_window(conversation.id)
+    metrics.record_cache("context_window", entries is not None)
+    if entries is None:
+        entries = await aload_window(conversation)
+    entries = [entry for entry in entries if entry["id"] not in exclude] + [
+        {"role": turn["role"], "content": turn["content"], "tokens": estimate_tokens(turn["content"])}
+        for turn in pending
+    ]
+
+    query = next((entry["content"] for entry in reversed(entries) if entry["role"] == "user"), None)
+    window_ids = [entry["id"] for entry in entries if "id" in entry] + list(exclude)
+    recalled = within_budget(
+        await memory.arecall(conversation, query, window_ids),
+        settings.MEMORY_TOKEN_BUDGET,
+    )
+
+    preamble = []
+    if conversation.summary:
+        preamble.append(summary_entry(conversation))
+    if recalled:
+        preamble.append(memory_entry(recalled))
+    budget = settings.CONTEXT_TOKEN_BUDGET - sum(estimate_tokens(entry["content"]) for entry in preamble)
+    entries = trim_to_budget(entries, budget)
+
+    return preamble + [{"role": entry["role"], "content": entry["content"]} for entry in entries]
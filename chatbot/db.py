@@ -0,0 +1,107 @@
+"""
+Retrying database work that failed on a dropped or stale connection.
+
+Only idempotent work is retried:
+
+* ``db_retry`` wraps a function the caller knows is safe to run twice (the
+  background jobs in tasks.py, the register/login lookups), sync or async.
+* ``db_retry_middleware`` re-runs whole GET/HEAD/OPTIONS requests whose view
+  answered with a database outage response (see exceptions.py).
+
+Before each retry the broken connections are closed with
+close_old_connections(), so the next attempt opens a fresh one (or takes
+one from the pool); if that fails too, its error propagates. Nothing is
+retried inside a transaction, where the work done so far is already lost.
+"""
+import asyncio
+import inspect
+import logging
+import random
+import time
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, close_old_connections, connections
+from django.utils.decorators import sync_and_async_middleware
+
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_ERRORS = (OperationalError, InterfaceError)
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+def in_transaction():
+    return any(conn.in_atomic_block for conn in connections.all(initialized_only=True))
+
+
+def backoff(attempt):
+    return random.uniform(0, settings.DB_RETRY_BASE_DELAY * 2 ** attempt)
+
+
+def should_retry(exc, attempt):
+    if attempt + 1 >= settings.DB_RETRY_ATTEMPTS or in_transaction():
+        return False
+    logger.warning("Database error, retrying with a new connection: %s", exc)
+    close_old_connections()
+    return True
+
+
+def db_retry(func):
+    """Retry ``func`` on connection errors; only for work that is safe to repeat."""
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            for attempt in range(settings.DB_RETRY_ATTEMPTS):
+                try:
+                    return await func(*args, **kwargs)
+                except RETRYABLE_ERRORS as exc:
+                    if not await sync_to_async(should_retry)(exc, attempt):
+                        raise
+                await asyncio.sleep(backoff(attempt))
+        return async_wrapper
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(settings.DB_RETRY_ATTEMPTS):
+            try:
+                return func(*args, **kwargs)
+            except RETRYABLE_ERRORS as exc:
+                if not should_retry(exc, attempt):
+                    raise
+            time.sleep(backoff(attempt))
+    return wrapper
+
+
+def is_retryable(request, response, attempt):
+    return (
+        request.method in IDEMPOTENT_METHODS
+        and getattr(response, "database_unavailable", False)
+        and attempt + 1 < settings.DB_RETRY_ATTEMPTS
+    )
+
+
+@sync_and_async_middleware
+def db_retry_middleware(get_response):
+    """Re-run idempotent requests that failed on a broken database connection."""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            for attempt in range(settings.DB_RETRY_ATTEMPTS):
+                response = await get_response(request)
+                if not is_retryable(request, response, attempt):
+                    return response
+                # Connections live on the thread sync_to_async runs DB work on.
+                await sync_to_async(close_old_connections)()
+                await asyncio.sleep(backoff(attempt))
+            return response
+    else:
+        def middleware(request):
+            for attempt in range(settings.DB_RETRY_ATTEMPTS):
+                response = get_response(request)
+                if not is_retryable(request, response, attempt):
+                    return response
+                close_old_connections()
+                time.sleep(backoff(attempt))
+            return response
+    return middleware
@@ -0,0 +1,95 @@
+"""
+Local text extraction and chunking for large uploaded documents.
+
+PDF (with the optional pypdf package), DOCX and plain text uploads are
+turned into text locally and split into chunks of at most
+DOCUMENT_CHUNK_TOKENS, so a long document is analysed as several bounded
+model calls (see gemini.amap_reduce_document) instead of one oversized
+request. Anything that cannot be extracted is sent to the model as a file.
+"""
+import codecs
+import zipfile
+from importlib.util import find_spec
+from xml.etree import ElementTree
+
+from django.conf import settings
+
+from .context import estimate_tokens
+from .uploads import DOCX
+
+
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def pdf_text(file):
+    if find_spec("pypdf") is None:
+        return None
+    from pypdf import PdfReader
+
+    reader = PdfReader(file)
+    return "\n\n".join(page.extract_text() or "" for page in reader.pages)
+
+
+def docx_text(file):
+    with zipfile.ZipFile(file) as archive:
+        root = ElementTree.fromstring(archive.read("word/document.xml"))
+    paragraphs = [
+        "".join(node.text or "" for node in paragraph.iter(f"{WORD_NAMESPACE}t"))
+        for paragraph in root.iter(f"{WORD_NAMESPACE}p")
+    ]
+    return "\n".join(paragraphs)
+
+
+def plain_text(file):
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    return "".join(decoder.decode(chunk) for chunk in file.chunks()) + decoder.decode(b"", final=True)
+
+
+EXTRACTORS = {
+    "application/pdf": pdf_text,
+    DOCX: docx_text,
+    "text/plain": plain_text,
+    "application/json": plain_text,
+}
+
+
+def extract_text(file, mime_type):
+    """The document's text, or None when it cannot be extracted locally."""
+    extractor = EXTRACTORS.get(mime_type)
+    if extractor is None:
+        return None
+    file.seek(0)
+    try:
+        text = extractor(file)
+    except Exception:
+        # Damaged or unusual files are left to the model.
+        return None
+    finally:
+        file.seek(0)
+    # Scanned PDFs have no text layer.
+    return text if text and text.strip() else None
+
+
+def needs_chunking(text):
+    return estimate_tokens(text) > settings.DOCUMENT_CHUNK_TOKENS
+
+
+def split_text(text, max_tokens):
+    """Split on paragraph boundaries into chunks of at most ``max_tokens``."""
+    # Inverse of estimate_tokens.
+    max_chars = max(1, (max_tokens - 1) * 4)
+    chunks = []
+    current = []
+    size = 0
+    for paragraph in text.split("\n"):
+        # A paragraph longer than a whole chunk is cut into pieces.
+        pieces = [paragraph[i:i + max_chars] for i in range(0, len(paragraph), max_chars)] or [""]
+        for piece in pieces:
+            if current and size + len(piece) + 1 > max_chars:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            current.append(piece)
+            size += len(piece) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return [chunk for chunk in chunks if chunk.strip()]
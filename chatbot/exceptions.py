@@ -1,33 +1,122 @@
-from django.db.utils import DatabaseError, OperationalError, ProgrammingError
+from django.db.utils import DatabaseError, InterfaceError, OperationalError, ProgrammingError
+from django.http import JsonResponse
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import exception_handler
 
 
-def api_exception_handler(exc, context):
-    response = exception_handler(exc, context)
-    if response is not None:
-        return response
+class ModelError(Exception):
+    """
+    A model call failed (see chatbot/resilience.py).
+
+    The message is safe to show to clients; the provider's own error is
+    chained as ``__cause__``. ``retryable`` errors are retried with backoff
+    and count against the circuit breaker.
+    """
+    status_code = status.HTTP_502_BAD_GATEWAY
+    default_message = "The AI model failed to respond. Please try again."
+    retryable = False
+
+    def __init__(self, message=None, retry_after=None):
+        super().__init__(message or self.default_message)
+        self.retry_after = retry_after
+
+
+class ModelTimeout(ModelError):
+    status_code = status.HTTP_504_GATEWAY_TIMEOUT
+    default_message = "The AI model took too long to respond. Please try again."
+    retryable = True
+
 
-    # Return JSON instead of HTML traceback for transient DB outages.
-    if isinstance(exc, OperationalError):
-        return Response(
+class ModelUnavailable(ModelError):
+    """The provider is overloaded, rate limited or down (429/5xx, connection errors)."""
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_message = "The AI model is temporarily unavailable. Please retry shortly."
+    retryable = True
+
+
+class CircuitOpen(ModelUnavailable):
+    """Failing fast while the circuit breaker is open; not retried."""
+    retryable = False
+
+
+class ModelRejected(ModelError):
+    """The provider refused this request (a 4xx other than 429), e.g. an unreadable file."""
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_message = "The AI model could not process this request."
+
+
+def model_error_payload(exc):
+    """Map a ModelError to an (error payload, status) pair."""
+    return {"error": str(exc), "status": exc.status_code}, exc.status_code
+
+
+def model_error_response(exc):
+    payload, status_code = model_error_payload(exc)
+    response = JsonResponse(payload, status=status_code)
+    if exc.retry_after is not None:
+        response["Retry-After"] = str(exc.retry_after)
+    return response
+
+
+def database_error_payload(exc):
+    """Map a DB-level exception to an (error payload, status) pair, or None."""
+    # Return JSON instead of HTML traceback for transient DB outages
+    # (InterfaceError: the connection was already closed).
+    if isinstance(exc, (OperationalError, InterfaceError)):
+        return (
             {"error": "Database connection temporarily unavailable. Please retry in a few seconds."},
-            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            status.HTTP_503_SERVICE_UNAVAILABLE,
         )
 
     # Missing relations/tables after deploy should surface as JSON for clients.
     if isinstance(exc, ProgrammingError):
-        return Response(
+        return (
             {"error": "Database schema is not ready. Run migrations and retry."},
-            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            status.HTTP_503_SERVICE_UNAVAILABLE,
         )
 
     # Catch-all for other DB-level failures.
     if isinstance(exc, DatabaseError):
-        return Response(
+        return (
             {"error": "Database error occurred. Please try again shortly."},
-            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            status.HTTP_503_SERVICE_UNAVAILABLE,
         )
 
+    return None
+
+
+def database_error_response(exc, response_class=JsonResponse):
+    """The error response for a DB exception (DatabaseError or InterfaceError)."""
+    payload, status_code = database_error_payload(exc)
+    response = response_class(payload, status=status_code)
+    # Lets db.db_retry_middleware re-run idempotent requests.
+    response.database_unavailable = isinstance(exc, (OperationalError, InterfaceError))
+    return response
+
+
+def stream_error_payload(exc):
+    """The error event for a streamed turn that failed unexpectedly; details stay in the logs."""
+    payload, status_code = database_error_payload(exc) or (
+        {"error": "The reply could not be completed. Please try again."},
+        status.HTTP_500_INTERNAL_SERVER_ERROR,
+    )
+    return {**payload, "status": status_code}
+
+
+def api_exception_handler(exc, context):
+    response = exception_handler(exc, context)
+    if response is not None:
+        return response
+
+    if isinstance(exc, ModelError):
+        payload, status_code = model_error_payload(exc)
+        response = Response(payload, status=status_code)
+        if exc.retry_after is not None:
+            response["Retry-After"] = str(exc.retry_after)
+        return response
+
+    if isinstance(exc, (DatabaseError, InterfaceError)):
+        return database_error_response(exc, response_class=Response)
+
     return response
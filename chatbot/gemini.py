@@ -1,104 +1,135 @@
-import os
-from google import genai
-from google.genai import types
+import asyncio
+import time
+from contextlib import aclosing
+
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.core.cache import cache
 
+from . import documents, metrics, resilience, response_cache, uploads
+from .context import estimate_tokens
+from .exceptions import ModelError
+from .providers import Usage, get_provider
 
-# Initialize client
-client = genai.Client(api_key=settings.GEMINI_API_KEY)
 
+# Model calls go through chatbot/resilience.py (retries, circuit breaker,
+# hedging) and raise a ModelError (chatbot/exceptions.py) when they fail.
+# Their latency, time to first token and tokens per second are recorded
+# in chatbot/metrics.py; replies served from the response cache are not
+# model calls.
+def timed_stream(chunks, usage=None):
+    started = time.perf_counter()
+    first = None
+    try:
+        for chunk in chunks:
+            if first is None:
+                first = time.perf_counter()
+                metrics.record_first_chunk(first - started)
+            yield chunk
+    except ModelError as exc:
+        metrics.record_model_error("stream", exc)
+        raise
+    finished = time.perf_counter()
+    metrics.record_model_call("stream", finished - started, usage, generating=finished - (first or started))
 
-# ==============================
-# 1️⃣ Normal Response Function
-# ==============================
-def ask_gemini(messages, temperature=0.7):
+
+async def atimed_stream(chunks, usage=None):
+    started = time.perf_counter()
+    first = None
     try:
-        model_id = "gemini-2.5-flash"
+        async with aclosing(chunks):
+            async for chunk in chunks:
+                if first is None:
+                    first = time.perf_counter()
+                    metrics.record_first_chunk(first - started)
+                yield chunk
+    except ModelError as exc:
+        metrics.record_model_error("stream", exc)
+        raise
+    finished = time.perf_counter()
+    metrics.record_model_call("stream", finished - started, usage, generating=finished - (first or started))
 
-        formatted_contents = [
-            types.Content(
-                role=msg["role"],
-                parts=[types.Part.from_text(text=msg["content"])]
-            )
-            for msg in messages
-        ]
-
-        response = client.models.generate_content(
-            model=model_id,
-            contents=formatted_contents,
-            config=types.GenerateContentConfig(
-                temperature=temperature
-            )
-        )
 
-        return response.text
+# ==============================
+# 1️⃣ Normal Response Function
+# ==============================
+def ask_gemini(messages, temperature=0.7, use_cache=True, usage=None):
+    provider = get_provider()
+    if not response_cache.is_enabled(use_cache):
+        with metrics.model_call("generate", usage):
+            return resilience.call(provider.generate, messages, temperature=temperature, usage=usage)
 
-    except Exception as e:
-        return f"Error: {str(e)}"
+    key = response_cache.cache_key(provider.model, temperature, messages)
+    reply = response_cache.lookup(key)
+    if reply is None:
+        with metrics.model_call("generate", usage):
+            reply = resilience.call(provider.generate, messages, temperature=temperature, usage=usage)
+        response_cache.store(key, reply)
+    return reply
 
 
 # ==============================
 # 2️⃣ Streaming Response Function
 # ==============================
-def ask_gemini_stream(messages, temperature=0.7):
-    try:
-        model_id = "gemini-2.5-flash"
-
-        formatted_contents = [
-            types.Content(
-                role=msg["role"],
-                parts=[types.Part.from_text(text=msg["content"])]
-            )
-            for msg in messages
-        ]
-
-        stream = client.models.generate_content_stream(
-            model=model_id,
-            contents=formatted_contents,
-            config=types.GenerateContentConfig(
-                temperature=temperature
-            )
-        )
+def ask_gemini_stream(messages, temperature=0.7, use_cache=True, usage=None):
+    provider = get_provider()
+    chunks = timed_stream(resilience.stream(lambda: provider.stream(messages, temperature=temperature, usage=usage)), usage)
+    if not response_cache.is_enabled(use_cache):
+        yield from chunks
+        return
 
-        for chunk in stream:
-            if chunk.text:
-                yield chunk.text
+    key = response_cache.cache_key(provider.model, temperature, messages)
+    reply = response_cache.lookup(key)
+    if reply is not None:
+        yield reply
+        return
 
-    except Exception as e:
-        yield f"Error: {str(e)}"
+    text = ""
+    for chunk in chunks:
+        text += chunk
+        yield chunk
+    response_cache.store(key, text)
 
 
 # ==============================
 # 3️⃣ File Analysis Function (NEW)
 # ==============================
-def ask_gemini_file(file_bytes, prompt):
-    try:
-        model_id = "gemini-2.5-flash" # Use a valid model ID
-
-        response = client.models.generate_content(
-            model=model_id,
-            # ADD THIS CONFIG BLOCK
-            config=types.GenerateContentConfig(
-                system_instruction="Reply in plain text only. Do not use markdown formatting like **bold** or *italics*."
-            ),
-            contents=[
-                types.Content(
-                    role="user",
-                    parts=[
-                        types.Part.from_bytes(
-                            data=file_bytes,
-                            mime_type="application/pdf"
-                        ),
-                        types.Part.from_text(text=prompt)
-                    ]
-                )
-            ]
-        )
-        return response.text
-    except Exception as e:
-        return f"Error: {str(e)}"
-    
-def summarize_conversation(messages):
+# file_bytes may also be a RemoteFile returned by upload_file().
+def ask_gemini_file(file_bytes, prompt, mime_type="application/pdf", usage=None):
+    with metrics.model_call("analyze_file", usage):
+        return resilience.call(get_provider().analyze_file, file_bytes, prompt, mime_type, usage=usage)
+
+
+def remote_file_key(provider, digest):
+    return f"remote_file:{type(provider).__name__}:{digest}"
+
+
+def upload_file(source, mime_type, digest):
+    """
+    Upload a large file to the provider once and reuse the handle.
+
+    ``digest`` (the file's sha256) keys the handle in the cache for
+    REMOTE_FILE_TTL seconds, so the same file is not uploaded again.
+    """
+    provider = get_provider()
+    key = remote_file_key(provider, digest)
+    remote = cache.get(key)
+    metrics.record_cache("remote_file", remote is not None)
+    if remote is None:
+        with metrics.model_call("upload_file"):
+            remote = resilience.call(provider.upload_file, source, mime_type)
+        cache.set(key, remote, timeout=settings.REMOTE_FILE_TTL)
+    return remote
+
+
+def count_tokens(messages):
+    with metrics.model_call("count_tokens"):
+        return resilience.call(get_provider().count_tokens, messages)
+
+
+def summarize_conversation(messages, usage=None):
+    """Summary of a batch of role/content messages."""
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
     prompt = [
         {
             "role": "user",
@@ -107,16 +138,34 @@ Summarize this conversation briefly to preserve memory context.
 Focus on key topics and decisions only.
 
 Conversation:
-{messages}
+{transcript}
+"""
+        }
+    ]
+
+    return ask_gemini(prompt, use_cache=False, usage=usage)
+
+
+def merge_summaries(summaries, usage=None):
+    """One summary covering consecutive ``summaries`` (oldest first)."""
+    parts = "\n\n".join(f"Part {i}:\n{summary}" for i, summary in enumerate(summaries, 1))
+    prompt = [
+        {
+            "role": "user",
+            "content": f"""
+Combine these summaries of consecutive parts of one conversation into a
+single brief summary. Keep key topics, facts and decisions; drop detail.
+
+{parts}
 """
         }
     ]
 
-    return ask_gemini(prompt)
+    return ask_gemini(prompt, use_cache=False, usage=usage)
 
 
-def generate_conversation_title(user_message, assistant_reply=None):
-    prompt_text = f"""
+def title_prompt(user_message, assistant_reply=None):
+    return f"""
 Create a short, generic chat title in 4-6 words.
 
 Rules:
@@ -132,6 +181,194 @@ Assistant reply:
 {assistant_reply or ''}
 """.strip()
 
+
+def generate_conversation_title(user_message, assistant_reply=None, use_cache=True, usage=None):
     return ask_gemini([
-        {"role": "user", "content": prompt_text}
-    ], temperature=0.2)
+        {"role": "user", "content": title_prompt(user_message, assistant_reply)}
+    ], temperature=0.2, use_cache=use_cache, usage=usage)
+
+
+# ==============================
+# 4️⃣ Async Variants (ASGI views)
+# ==============================
+# These mirror the functions above but use the provider's async client so a
+# model round-trip yields the event loop instead of blocking a worker.
+# ``hedge=True`` marks latency-sensitive calls worth a second request
+# (see resilience.hedged).
+async def aask_gemini(messages, temperature=0.7, use_cache=True, usage=None, hedge=False):
+    provider = get_provider()
+    if not response_cache.is_enabled(use_cache):
+        with metrics.model_call("generate", usage):
+            return await resilience.acall(
+                provider.agenerate, messages, temperature=temperature, usage=usage, hedge=hedge
+            )
+
+    key = response_cache.cache_key(provider.model, temperature, messages)
+    reply = await response_cache.alookup(key)
+    if reply is None:
+        with metrics.model_call("generate", usage):
+            reply = await resilience.acall(
+                provider.agenerate, messages, temperature=temperature, usage=usage, hedge=hedge
+            )
+        await response_cache.astore(key, reply)
+    return reply
+
+
+async def aask_gemini_stream(messages, temperature=0.7, use_cache=True, usage=None):
+    provider = get_provider()
+    chunks = atimed_stream(resilience.astream(lambda: provider.astream(messages, temperature=temperature, usage=usage)), usage)
+    async with aclosing(chunks):
+        if not response_cache.is_enabled(use_cache):
+            async for chunk in chunks:
+                yield chunk
+            return
+
+        key = response_cache.cache_key(provider.model, temperature, messages)
+        reply = await response_cache.alookup(key)
+        if reply is not None:
+            yield reply
+            return
+
+        text = ""
+        async for chunk in chunks:
+            text += chunk
+            yield chunk
+        await response_cache.astore(key, text)
+
+
+async def aask_gemini_file(file_bytes, prompt, mime_type="application/pdf", usage=None):
+    with metrics.model_call("analyze_file", usage):
+        return await resilience.acall(get_provider().aanalyze_file, file_bytes, prompt, mime_type, usage=usage)
+
+
+async def aupload_file(source, mime_type, digest):
+    provider = get_provider()
+    key = remote_file_key(provider, digest)
+    remote = await cache.aget(key)
+    metrics.record_cache("remote_file", remote is not None)
+    if remote is None:
+        with metrics.model_call("upload_file"):
+            remote = await resilience.acall(provider.aupload_file, source, mime_type)
+        await cache.aset(key, remote, timeout=settings.REMOTE_FILE_TTL)
+    return remote
+
+
+def map_prompt(prompt, chunk, index, total):
+    return f"""
+{prompt}
+
+This is part {index} of {total} of a longer document. Work only from this
+part; the partial answers are combined afterwards.
+
+{chunk}
+""".strip()
+
+
+def reduce_prompt(prompt, partials):
+    parts = "\n\n".join(f"Part {i}:\n{partial}" for i, partial in enumerate(partials, 1))
+    return f"""
+{prompt}
+
+The document was read in parts. Combine these partial answers into one
+answer, without mentioning the parts:
+
+{parts}
+""".strip()
+
+
+def reduce_groups(partials, max_tokens):
+    """Pack partial answers into groups that each fit one reduce call."""
+    groups = [[]]
+    size = 0
+    for partial in partials:
+        tokens = estimate_tokens(partial)
+        if groups[-1] and size + tokens > max_tokens:
+            groups.append([])
+            size = 0
+        groups[-1].append(partial)
+        size += tokens
+    return groups
+
+
+async def amap_reduce_document(chunks, prompt, usage=None, progress=None):
+    """
+    Answer ``prompt`` over a document split into text chunks.
+
+    Each chunk is analysed separately, at most DOCUMENT_MAP_CONCURRENCY at
+    a time, then the partial answers are merged, in rounds if they do not
+    fit one call. ``progress`` (an async callable) gets a dict after each
+    step.
+    """
+    semaphore = asyncio.Semaphore(settings.DOCUMENT_MAP_CONCURRENCY)
+    total = len(chunks)
+    done = 0
+
+    async def ask(content):
+        call_usage = Usage()
+        async with semaphore:
+            answer = await aask_gemini([{"role": "user", "content": content}], temperature=0.2, usage=call_usage)
+        if usage is not None:
+            usage.add(call_usage)
+        return answer
+
+    async def analyse(index, chunk):
+        nonlocal done
+        partial = await ask(map_prompt(prompt, chunk, index, total))
+        done += 1
+        if progress is not None:
+            await progress({"stage": "map", "done": done, "total": total})
+        return partial
+
+    partials = await asyncio.gather(*(analyse(i, chunk) for i, chunk in enumerate(chunks, 1)))
+
+    while len(partials) > 1:
+        groups = reduce_groups(partials, settings.DOCUMENT_CHUNK_TOKENS)
+        if len(groups) == len(partials):
+            # Every partial fills a call on its own; merge them regardless.
+            groups = [partials]
+        if progress is not None:
+            await progress({"stage": "reduce", "done": 0, "total": len(groups)})
+        partials = await asyncio.gather(*(ask(reduce_prompt(prompt, group)) for group in groups))
+
+    return partials[0]
+
+
+async def aask_gemini_upload(file, prompt, mime_type, digest, use_cache=True, usage=None, progress=None):
+    """
+    Analyse an uploaded file, reusing the cached analysis of the same
+    content and prompt. Long documents whose text can be extracted locally
+    are map-reduced over chunks (reporting to ``progress``); other small
+    files go inline and larger ones through aupload_file.
+    """
+    provider = get_provider()
+    key = response_cache.file_cache_key(provider.model, digest, prompt)
+    if response_cache.is_enabled(use_cache):
+        analysis = await response_cache.alookup(key)
+        if analysis is not None:
+            return analysis
+
+    text = await sync_to_async(documents.extract_text, thread_sensitive=False)(file, mime_type)
+    if text is not None and documents.needs_chunking(text):
+        chunks = documents.split_text(text, settings.DOCUMENT_CHUNK_TOKENS)
+        analysis = await amap_reduce_document(chunks, prompt, usage=usage, progress=progress)
+    else:
+        if uploads.is_inline(file):
+            source = uploads.read_bytes(file)
+        else:
+            source = await aupload_file(uploads.upload_source(file), mime_type, digest)
+        analysis = await aask_gemini_file(source, prompt, mime_type, usage=usage)
+
+    if response_cache.is_enabled(use_cache):
+        await response_cache.astore(key, analysis)
+    return analysis
+
+
+async def acount_tokens(messages):
+    with metrics.model_call("count_tokens"):
+        return await resilience.acall(get_provider().acount_tokens, messages)
+
+
+async def agenerate_conversation_title(user_message, assistant_reply=None, use_cache=True, usage=None):
+    return await aask_gemini([
+        {"role": "user", "content": title_prompt(user_message, assistant_reply)}
+    ], temperature=0.2, use_cache=use_cache, usage=usage, hedge=True)
@@ -0,0 +1,109 @@
+import asyncio
+import statistics
+import time
+
+import httpx
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, override_settings
+
+from chatbot.authentication import GUEST_HEADER
+
+
+class Command(BaseCommand):
+    help = (
+        "Fire concurrent chat requests and report throughput, latency and effective "
+        "in-flight chats (throughput x mean latency). Targets a running server, or "
+        "with --in-process drives the ASGI app directly with the fake LLM backend."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000")
+        parser.add_argument(
+            "--in-process", action="store_true", help="Skip the network; use LLM_BACKEND=fake and no rate limits."
+        )
+        parser.add_argument("--concurrency", type=int, default=200)
+        parser.add_argument("--requests", type=int, default=1000)
+        parser.add_argument("--endpoint", default="/api/chat/", help="Either /api/chat/ or /api/chat/stream/.")
+
+    def handle(self, *args, **options):
+        if options["in_process"]:
+            with override_settings(LLM_BACKEND="fake", RATE_LIMITS={}):
+                asyncio.run(self.run(InProcessClient(), **options))
+        else:
+            limits = httpx.Limits(max_connections=options["concurrency"])
+            client = httpx.AsyncClient(base_url=options["url"], timeout=120, limits=limits)
+            asyncio.run(self.run(HttpClient(client), **options))
+
+    async def run(self, client, concurrency, requests, endpoint, **kwargs):
+        created = await client.post("/api/conversations/create/", {"title": "bench"})
+        conversation_id = created["conversation_id"]
+
+        remaining = requests
+        latencies = []
+        failures = 0
+
+        async def worker():
+            nonlocal remaining, failures
+            while remaining > 0:
+                remaining -= 1
+                started = time.perf_counter()
+                try:
+                    await client.post(endpoint, {"message": "hi", "conversation_id": conversation_id})
+                except RuntimeError:
+                    failures += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        await client.close()
+
+        throughput = len(latencies) / elapsed
+        mean_latency = statistics.mean(latencies)
+        p99 = sorted(latencies)[max(int(len(latencies) * 0.99) - 1, 0)]
+        self.stdout.write(f"requests:          {len(latencies)} ({failures} failed)")
+        self.stdout.write(f"throughput:        {throughput:.1f} req/s")
+        self.stdout.write(f"latency mean/p99:  {mean_latency * 1000:.0f} ms / {p99 * 1000:.0f} ms")
+        self.stdout.write(f"in-flight chats:   {throughput * mean_latency:.1f}")
+
+
+class HttpClient:
+    def __init__(self, client):
+        self.client = client
+        self.headers = {}
+
+    async def post(self, path, payload):
+        response = await self.client.post(path, json=payload, headers=self.headers)
+        await response.aread()
+        # Keep using the guest user that owns the bench conversation.
+        if GUEST_HEADER in response.headers:
+            self.headers[GUEST_HEADER] = response.headers[GUEST_HEADER]
+        if response.status_code >= 400:
+            raise RuntimeError(response.status_code)
+        if response.headers.get("content-type", "").startswith("application/json"):
+            return response.json()
+        return None
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class InProcessClient:
+    def __init__(self):
+        self.client = AsyncClient()
+        self.headers = {}
+
+    async def post(self, path, payload):
+        response = await self.client.post(path, payload, content_type="application/json", headers=self.headers)
+        if GUEST_HEADER in response.headers:
+            self.headers[GUEST_HEADER] = response.headers[GUEST_HEADER]
+        if response.status_code >= 400:
+            raise RuntimeError(response.status_code)
+        if response.streaming:
+            async for _ in response.streaming_content:
+                pass
+            return None
+        return response.json()
+
+    async def close(self):
+        pass
@@ -0,0 +1,61 @@
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.utils import ConnectionHandler
+
+
+class Command(BaseCommand):
+    help = (
+        "Report the per-request cost of getting a database connection and running "
+        "one query: a new connection per request, a persistent one (CONN_MAX_AGE) "
+        "and Django's psycopg pool."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=200)
+        parser.add_argument("--database", default="default")
+
+    def handle(self, *args, **options):
+        base = dict(settings.DATABASES[options["database"]])
+        base["OPTIONS"] = {k: v for k, v in base.get("OPTIONS", {}).items() if k != "pool"}
+        configs = {
+            "new connection per request": {**base, "CONN_MAX_AGE": 0},
+            "persistent connection": {**base, "CONN_MAX_AGE": 600},
+        }
+        if base["ENGINE"] == "django.db.backends.postgresql" and settings.PSYCOPG_POOL_INSTALLED:
+            configs["connection pool"] = {
+                **base,
+                "CONN_MAX_AGE": 0,
+                "OPTIONS": {**base["OPTIONS"], "pool": {"min_size": 1, "max_size": 1}},
+            }
+        else:
+            self.stdout.write(self.style.WARNING("Skipping the pool: it needs PostgreSQL, psycopg 3 and psycopg_pool."))
+
+        for i, (name, config) in enumerate(configs.items()):
+            timings = self.measure(f"bench_{i}", config, base, options["requests"])
+            self.stdout.write(self.style.SUCCESS(
+                f"{name}: median {statistics.median(timings) * 1000:.2f} ms, "
+                f"p95 {statistics.quantiles(timings, n=20)[-1] * 1000:.2f} ms per request"
+            ))
+
+    def measure(self, alias, config, base, requests):
+        # A separate alias keeps the benchmark off the default connection and its pool.
+        connection = ConnectionHandler({"default": base, alias: config})[alias]
+        timings = []
+        try:
+            for _ in range(requests):
+                started = time.perf_counter()
+                # What close_old_connections() does on request_started/request_finished.
+                connection.close_if_unusable_or_obsolete()
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                    cursor.fetchone()
+                connection.close_if_unusable_or_obsolete()
+                timings.append(time.perf_counter() - started)
+        finally:
+            connection.close()
+            if hasattr(connection, "close_pool"):
+                connection.close_pool()
+        return timings
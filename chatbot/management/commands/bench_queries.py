@@ -0,0 +1,134 @@
+import importlib
+import statistics
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from chatbot.models import ChatMessage, Conversation
+
+
+title_search_indexes = importlib.import_module("chatbot.migrations.0008_chat_hot_path_indexes")
+
+SEED_USERNAME = "bench_seed"
+LOCAL_HOSTS = {"", "localhost", "127.0.0.1", "::1"}
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a large chat history under the bench_seed user, then report query "
+        "plans and timings for each view query without and with the hot-path indexes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--conversations", type=int, default=2000)
+        parser.add_argument("--messages", type=int, default=2_000_000)
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--skip-seed", action="store_true", help="Reuse a previously seeded bench_seed user.")
+        parser.add_argument("--cleanup", action="store_true", help="Delete the bench_seed user and its data, then exit.")
+        parser.add_argument(
+            "--allow-remote", action="store_true",
+            help="Run against a database that is not on this machine (its indexes are dropped and recreated).",
+        )
+
+    def handle(self, *args, **options):
+        host = connection.settings_dict.get("HOST") or ""
+        if connection.vendor != "sqlite" and host not in LOCAL_HOSTS and not options["allow_remote"]:
+            raise CommandError(
+                f"Refusing to seed and drop indexes on the database at {host}; pass --allow-remote to do it anyway."
+            )
+
+        if options["cleanup"]:
+            User.objects.filter(username=SEED_USERNAME).delete()
+            return
+
+        user, _ = User.objects.get_or_create(username=SEED_USERNAME)
+        if not options["skip_seed"]:
+            self.seed(user, options["conversations"], options["messages"])
+
+        conversation = Conversation.objects.filter(user=user).order_by("-total_messages").first()
+        middle = ChatMessage.objects.filter(conversation=conversation).order_by("id").values_list("id", flat=True)
+        since_id = middle[max(conversation.total_messages - 10, 0)]
+        queries = {
+            "list_conversations page": lambda: Conversation.objects.filter(user=user)
+            .order_by("-created_at", "-id").values("id", "title", "created_at", "total_messages")[:21],
+            "list_conversations search": lambda: Conversation.objects.filter(user=user, title__icontains="topic 7")
+            .order_by("-created_at", "-id").values("id", "title", "created_at", "total_messages")[:21],
+            "messages newest page": lambda: ChatMessage.objects.filter(conversation=conversation)
+            .order_by("-timestamp", "-id").values("id", "role", "content", "timestamp")[:51],
+            "messages since": lambda: ChatMessage.objects.filter(conversation=conversation, id__gt=since_id)
+            .order_by("timestamp", "id").values("id", "role", "content", "timestamp")[:51],
+            "context window": lambda: ChatMessage.objects.filter(conversation=conversation)
+            .order_by("-timestamp", "-id")[:200],
+            "regenerate last model message": lambda: ChatMessage.objects.filter(conversation=conversation, role="model")
+            .order_by("-timestamp")[:1],
+        }
+
+        self.stdout.write(self.style.MIGRATE_HEADING("Without hot-path indexes"))
+        self.drop_indexes()
+        try:
+            self.measure(queries, options["repeat"])
+        finally:
+            self.create_indexes()
+        self.stdout.write(self.style.MIGRATE_HEADING("With hot-path indexes"))
+        self.measure(queries, options["repeat"])
+
+    def seed(self, user, conversation_count, message_count):
+        Conversation.objects.filter(user=user).delete()
+        start = timezone.now() - timedelta(days=365)
+        conversations = Conversation.objects.bulk_create(
+            [
+                Conversation(user=user, title=f"Topic {i}", created_at=start + timedelta(minutes=i))
+                for i in range(conversation_count)
+            ],
+            batch_size=5000,
+        )
+
+        # Skewed like real traffic: a tenth of the conversations hold most messages.
+        heavy = conversations[: max(conversation_count // 10, 1)]
+        batch = []
+        for i in range(message_count):
+            conversation = heavy[i % len(heavy)] if i % 5 else conversations[i % conversation_count]
+            batch.append(ChatMessage(
+                conversation=conversation,
+                role="user" if i % 2 else "model",
+                content=f"seed message {i}",
+                timestamp=start + timedelta(seconds=i),
+            ))
+            if len(batch) == 10000:
+                ChatMessage.objects.bulk_create(batch)
+                batch = []
+                self.stdout.write(f"\rseeded {i + 1} messages", ending="")
+        ChatMessage.objects.bulk_create(batch)
+        self.stdout.write("")
+
+        for conversation in conversations:
+            Conversation.objects.filter(id=conversation.id).update(total_messages=conversation.messages.count())
+
+    def hot_path_indexes(self):
+        return [(model, index) for model in (Conversation, ChatMessage) for index in model._meta.indexes]
+
+    def drop_indexes(self):
+        with connection.schema_editor() as schema_editor:
+            for model, index in self.hot_path_indexes():
+                schema_editor.remove_index(model, index)
+            title_search_indexes.drop_title_search_index(None, schema_editor)
+
+    def create_indexes(self):
+        with connection.schema_editor() as schema_editor:
+            for model, index in self.hot_path_indexes():
+                schema_editor.add_index(model, index)
+            title_search_indexes.create_title_search_index(None, schema_editor)
+
+    def measure(self, queries, repeat):
+        for name, build in queries.items():
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                list(build())
+                timings.append(time.perf_counter() - started)
+            self.stdout.write(self.style.SUCCESS(f"{name}: median {statistics.median(timings) * 1000:.2f} ms"))
+            self.stdout.write(f"  {build().explain()}")
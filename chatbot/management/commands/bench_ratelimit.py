@@ -0,0 +1,42 @@
+import asyncio
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory, override_settings
+
+from chatbot.ratelimit import acheck_quotas, check_quotas
+
+
+class Command(BaseCommand):
+    help = "Measure the per-request overhead of the sliding-window rate limiter on the configured cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=20000)
+        parser.add_argument("--rates", nargs="+", default=["10/m", "50/d"])
+
+    def handle(self, *args, **options):
+        iterations = options["iterations"]
+        factory = RequestFactory()
+        requests = [factory.post("/api/chat/", REMOTE_ADDR=f"10.0.0.{i}") for i in range(100)]
+        user = AnonymousUser()
+
+        async def run_async():
+            for i in range(iterations):
+                await acheck_quotas("bench", user, requests[i % 100], False)
+
+        with override_settings(RATE_LIMITS={"bench": options["rates"]}):
+            started = time.perf_counter()
+            for i in range(iterations):
+                check_quotas("bench", user, requests[i % 100], False)
+            sync_elapsed = time.perf_counter() - started
+
+            started = time.perf_counter()
+            asyncio.run(run_async())
+            async_elapsed = time.perf_counter() - started
+
+        self.stdout.write(f"cache backend: {settings.CACHES['default']['BACKEND']}")
+        self.stdout.write(f"rates per request: {len(options['rates'])}")
+        self.stdout.write(f"sync view:  {sync_elapsed / iterations * 1e6:.1f} us/request")
+        self.stdout.write(f"async view: {async_elapsed / iterations * 1e6:.1f} us/request")
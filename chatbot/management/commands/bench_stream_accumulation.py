@@ -0,0 +1,76 @@
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+
+def concatenate(chunks):
+    # The only reference to the running text is the local, so CPython
+    # resizes it in place instead of copying (what stream_turn does).
+    text = ""
+    for chunk in chunks:
+        text += chunk
+    return text
+
+
+def joined(chunks):
+    received = []
+    for chunk in chunks:
+        received.append(chunk)
+    return "".join(received)
+
+
+class Holder:
+    text = ""
+
+
+def concatenate_attribute(chunks):
+    # += on an attribute (or with any second reference) copies the whole
+    # text on every append.
+    holder = Holder()
+    for chunk in chunks:
+        holder.text += chunk
+    return holder.text
+
+
+class Command(BaseCommand):
+    help = "Compare ways of accumulating a long streamed reply: local +=, a chunk list, and += on an attribute."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tokens", type=int, default=100_000)
+        parser.add_argument("--tokens-per-chunk", type=int, default=1)
+
+    def measure(self, accumulate, chunks):
+        # Timed and traced in separate runs: tracemalloc slows every resize.
+        started = time.process_time()
+        text = accumulate(chunks)
+        elapsed = time.process_time() - started
+        tracemalloc.start()
+        accumulate(chunks)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return text, elapsed, peak
+
+    def handle(self, *args, **options):
+        per_chunk = options["tokens_per_chunk"]
+        # Roughly four characters per token, as in context.estimate_tokens.
+        chunks = [
+            "tok " * per_chunk
+            for _ in range(max(1, options["tokens"] // per_chunk))
+        ]
+        reply_bytes = sum(len(c) for c in chunks)
+
+        self.stdout.write(f"reply: {options['tokens']} tokens in {len(chunks)} chunks ({reply_bytes / 1e6:.2f} MB)")
+        results = {}
+        for name, accumulate in [
+            ("local +=", concatenate),
+            ("list + join", joined),
+            ("attribute +=", concatenate_attribute),
+        ]:
+            text, elapsed, peak = self.measure(accumulate, chunks)
+            results[name] = text
+            self.stdout.write(
+                f"{name:14} cpu {elapsed / len(chunks) * 1e9:8.0f} ns/chunk  "
+                f"peak memory {peak / 1e6:7.2f} MB"
+            )
+        assert len(set(results.values())) == 1
@@ -0,0 +1,80 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a stand-in Gemini REST server with fixed latency. Point the app at it "
+        "with GEMINI_BASE_URL=http://127.0.0.1:<port> to load test without the network."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--latency", type=float, default=1.0, help="Seconds per generateContent call.")
+        parser.add_argument("--chunks", type=int, default=10, help="Chunks per streamed reply.")
+
+    def handle(self, *args, **options):
+        self.latency = options["latency"]
+        self.chunks = options["chunks"]
+        self.stdout.write(f"Stand-in Gemini listening on http://{options['host']}:{options['port']}")
+        asyncio.run(self.serve(options["host"], options["port"]))
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                path = request_line.decode().split(" ")[1]
+
+                content_length = 0
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header.decode().partition(":")
+                    if name.lower() == "content-length":
+                        content_length = int(value.strip())
+                await reader.readexactly(content_length)
+
+                if ":streamGenerateContent" in path:
+                    await self.write_stream(writer)
+                else:
+                    await asyncio.sleep(self.latency)
+                    self.write_json(writer, self.payload("Stand-in reply."))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def payload(self, text):
+        return {
+            "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}],
+            "usageMetadata": {"promptTokenCount": 10, "candidatesTokenCount": 3, "totalTokenCount": 13},
+        }
+
+    def write_json(self, writer, data):
+        body = json.dumps(data).encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+            + f"Content-Length: {len(body)}\r\n\r\n".encode()
+            + body
+        )
+
+    async def write_stream(self, writer):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+        for i in range(self.chunks):
+            await asyncio.sleep(self.latency / self.chunks)
+            event = f"data: {json.dumps(self.payload(f'chunk {i} '))}\r\n\r\n".encode()
+            writer.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from chatbot.tasks import reap_guest_sessions
+
+
+class Command(BaseCommand):
+    help = "Delete expired guest users with their conversations and files."
+
+    def handle(self, *args, **options):
+        reaped = reap_guest_sessions()
+        self.stdout.write(f"reaped {reaped} guest sessions")
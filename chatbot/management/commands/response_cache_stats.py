@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from chatbot import response_cache
+
+
+class Command(BaseCommand):
+    help = "Print response cache hit/miss counters (each hit is a model call saved)."
+
+    def handle(self, *args, **options):
+        stats = response_cache.stats()
+        self.stdout.write(f"hits:     {stats['hits']}")
+        self.stdout.write(f"misses:   {stats['misses']}")
+        self.stdout.write(f"hit rate: {stats['hit_rate']:.1%}")
@@ -0,0 +1,169 @@
+"""
+Retrieval memory: older messages relevant to the new one, pulled back into
+the prompt next to the recent window.
+
+Each message gets an embedding stored in MessageEmbedding as float32 bytes.
+Messages are embedded in batches together with the query of a later turn,
+once the conversation has outgrown its recent window (until then nothing
+can be retrieved), so a turn makes at most one embedding call. The search
+is one NumPy matrix product over the vectors of the scope (the
+conversation, or all of the user's conversations with MEMORY_SCOPE="user"),
+kept per process and extended with new rows, never reloaded whole.
+context.abuild_history caps the result at MEMORY_TOP_K messages and
+MEMORY_TOKEN_BUDGET tokens, so prompt size stays fixed however long the
+history grows.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import metrics, resilience
+from .exceptions import ModelError
+from .models import ChatMessage, MessageEmbedding
+from .providers import get_provider
+
+
+logger = logging.getLogger(__name__)
+
+
+def to_bytes(vector):
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+class VectorIndex:
+    """
+    Per-process cache of each scope's vectors as one normalized matrix.
+
+    A search only loads embedding rows added since the previous one; the
+    least recently searched scopes are dropped past ``max_scopes``.
+    """
+
+    def __init__(self, max_scopes=256):
+        self.max_scopes = max_scopes
+        self.scopes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, scope, embeddings, dimensions):
+        with self.lock:
+            message_ids, matrix, last_id = self.scopes.pop(
+                scope, (np.empty(0, dtype=np.int64), np.empty((0, dimensions), dtype=np.float32), 0)
+            )
+
+        rows = [
+            (row_id, message_id, vector)
+            for row_id, message_id, vector in embeddings.filter(id__gt=last_id).order_by("id").values_list(
+                "id", "message_id", "vector"
+            )
+            # Vectors from an older EMBEDDING_DIMENSIONS setting are skipped.
+            if len(vector) == dimensions * 4
+        ]
+        if rows:
+            added = np.frombuffer(b"".join(bytes(r[2]) for r in rows), dtype=np.float32)
+            matrix = np.vstack([matrix, normalize(added.reshape(len(rows), dimensions))])
+            message_ids = np.concatenate([message_ids, np.array([r[1] for r in rows], dtype=np.int64)])
+            last_id = rows[-1][0]
+
+        with self.lock:
+            self.scopes[scope] = (message_ids, matrix, last_id)
+            while len(self.scopes) > self.max_scopes:
+                self.scopes.popitem(last=False)
+        return message_ids, matrix
+
+    def search(self, scope, embeddings, query, exclude=(), k=4):
+        """Message ids of the ``k`` vectors closest to ``query``, best first."""
+        query = normalize(np.asarray(query, dtype=np.float32))
+        message_ids, matrix = self.load(scope, embeddings, len(query))
+        if not len(message_ids):
+            return []
+
+        scores = matrix @ query
+        if exclude:
+            scores[np.isin(message_ids, list(exclude))] = -np.inf
+        k = min(k, int(np.isfinite(scores).sum()))
+        if k <= 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [int(message_ids[i]) for i in best]
+
+
+index = VectorIndex()
+
+
+def scope_of(conversation):
+    """Index key and embedding queryset for the configured MEMORY_SCOPE."""
+    # The creation time keeps a reused id (e.g. SQLite) from matching stale rows.
+    if settings.MEMORY_SCOPE == "user":
+        user = conversation.user
+        return f"user:{user.id}:{user.date_joined.timestamp()}", MessageEmbedding.objects.filter(
+            conversation__user_id=user.id
+        )
+    return f"conversation:{conversation.id}:{conversation.created_at.timestamp()}", MessageEmbedding.objects.filter(
+        conversation_id=conversation.id
+    )
+
+
+def pending_messages(conversation):
+    """The oldest messages of the conversation that have no embedding yet."""
+    return list(
+        ChatMessage.objects.filter(conversation=conversation, embedding__isnull=True)
+        .exclude(content__isnull=True)
+        .exclude(content="")
+        .order_by("id")[:settings.MEMORY_EMBED_BATCH]
+    )
+
+
+def store_embeddings(conversation, messages, vectors):
+    MessageEmbedding.objects.bulk_create(
+        [
+            MessageEmbedding(message_id=message.id, conversation_id=conversation.id, vector=to_bytes(vector))
+            for message, vector in zip(messages, vectors)
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def relevant_messages(conversation, query_vector, exclude):
+    scope, embeddings = scope_of(conversation)
+    ids = index.search(scope, embeddings, query_vector, exclude=exclude, k=settings.MEMORY_TOP_K)
+    found = ChatMessage.objects.in_bulk(ids)
+    # Keep relevance order; messages deleted since they were indexed drop out.
+    return [found[i] for i in ids if i in found]
+
+
+async def arecall(conversation, query, window_ids):
+    """
+    Return the older messages most relevant to ``query``, best first.
+
+    ``window_ids`` are the messages already in the prompt. Memory is best
+    effort: if embedding fails the turn goes ahead without it.
+    """
+    if not settings.MEMORY_TOP_K or not query:
+        return []
+    searches_other_conversations = settings.MEMORY_SCOPE == "user"
+    if conversation.total_messages <= len(window_ids) and not searches_other_conversations:
+        return []
+
+    pending = await sync_to_async(pending_messages)(conversation)
+    try:
+        with metrics.model_call("embed"):
+            vectors = await resilience.acall(get_provider().aembed, [query] + [m.content for m in pending], hedge=True)
+    except ModelError:
+        logger.exception("Embedding failed for conversation %s", conversation.id)
+        return []
+
+    def store_and_search():
+        store_embeddings(conversation, pending, vectors[1:])
+        return relevant_messages(conversation, vectors[0], window_ids)
+
+    return await sync_to_async(store_and_search)()
@@ -0,0 +1,292 @@
+"""
+Request-level performance metrics in the Prometheus text format.
+
+``metrics_middleware`` times every request and, through a connection
+execute wrapper, counts its DB queries and their time. Hooks in gemini.py
+and memory.py time model calls (total latency, time to first token of
+streams, output tokens per second); the caches and the rate limiter count
+hits, misses and rejections. Everything is labelled with the endpoint (the
+matched URL route, or "background" for work outside a request) and served
+at /metrics.
+
+Series live in memory, per process, and cost a lock and a few additions
+per observation. Each worker process reports its own numbers, so scrape
+every worker (or sum them in Prometheus). METRICS_ENABLED = False turns it
+all off; with METRICS_TOKEN set, /metrics wants "Authorization: Bearer
+<token>", and with METRICS_REQUIRE_TOKEN (the default on Render) it is not
+served at all until a token is set.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from django.utils.decorators import sync_and_async_middleware
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNTS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+RATES = (5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"))
+        for name, value in labels
+    )
+    return "{" + pairs + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            series = sorted(self.series.items())
+        for key, value in series:
+            lines.extend(self.render_series(list(zip(self.labels, key)), value))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.series.get(self.key(labels), 0)
+
+    def render_series(self, labels, value):
+        return [f"{self.name}{format_labels(labels)} {format_value(value)}"]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=SECONDS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.series.get(key)
+            if counts is None:
+                # One count per bucket, +Inf, then the sum.
+                counts = self.series[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, **labels):
+        counts = self.series.get(self.key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def total(self, **labels):
+        counts = self.series.get(self.key(labels))
+        return counts[-1] if counts else 0
+
+    def render_series(self, labels, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            le = bound if bound == "+Inf" else format_value(bound)
+            lines.append(f"{self.name}_bucket{format_labels(labels + [('le', le)])} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(counts[-1])}")
+        lines.append(f"{self.name}_count{format_labels(labels)} {cumulative}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram(
+    "chatbot_request_duration_seconds", "Request time, to the end of streamed bodies.", ("endpoint", "method"),
+)
+DB_QUERIES = Histogram("chatbot_request_db_queries", "DB queries per request.", ("endpoint",), buckets=COUNTS)
+DB_SECONDS = Histogram("chatbot_request_db_seconds", "Time spent in DB queries per request.", ("endpoint",))
+MODEL_SECONDS = Histogram("chatbot_model_latency_seconds", "Model call time, retries included.", ("endpoint", "operation"))
+MODEL_TTFT = Histogram("chatbot_model_ttft_seconds", "Time to the first chunk of a streamed reply.", ("endpoint",))
+MODEL_TOKENS_PER_SECOND = Histogram(
+    "chatbot_model_tokens_per_second", "Output tokens per second of generation.", ("endpoint", "operation"),
+    buckets=RATES,
+)
+MODEL_ERRORS = Counter("chatbot_model_errors_total", "Failed model calls by HTTP-style status.", ("endpoint", "operation", "status"))
+CACHE_LOOKUPS = Counter("chatbot_cache_lookups_total", "Cache lookups by cache and result.", ("endpoint", "cache", "result"))
+RATE_LIMITED = Counter("chatbot_rate_limit_rejections_total", "Requests rejected by a rate limit.", ("endpoint", "scope"))
+
+REGISTRY = [
+    REQUEST_SECONDS, DB_QUERIES, DB_SECONDS, MODEL_SECONDS, MODEL_TTFT, MODEL_TOKENS_PER_SECOND,
+    MODEL_ERRORS, CACHE_LOOKUPS, RATE_LIMITED,
+]
+
+
+def render():
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+# ----------------------------------------
+# REQUESTS
+# ----------------------------------------
+class RequestStats:
+    def __init__(self, request):
+        self.request = request
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+
+    @property
+    def endpoint(self):
+        match = self.request.resolver_match
+        return (match.route or "/") if match is not None else "unmatched"
+
+    def finish(self):
+        endpoint = self.endpoint
+        REQUEST_SECONDS.observe(time.perf_counter() - self.started, endpoint=endpoint, method=self.request.method)
+        DB_QUERIES.observe(self.queries, endpoint=endpoint)
+        DB_SECONDS.observe(self.db_seconds, endpoint=endpoint)
+
+
+# Visible to sync_to_async threads and tasks spawned by the request.
+current_request = ContextVar("chatbot_metrics_request", default=None)
+
+
+def endpoint():
+    stats = current_request.get()
+    return stats.endpoint if stats is not None else "background"
+
+
+def record_query(execute, sql, params, many, context):
+    stats = current_request.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.db_seconds += time.perf_counter() - started
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    # Sent again whenever the wrapper reconnects (or takes a pooled connection).
+    if settings.METRICS_ENABLED and record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """Record each request's duration and DB queries once its response is closed."""
+    if not settings.METRICS_ENABLED:
+        raise MiddlewareNotUsed
+
+    def start(request):
+        stats = RequestStats(request)
+        current_request.set(stats)
+        return stats
+
+    def track(stats, response):
+        # Closing happens after the last chunk of a streamed body is sent.
+        response._resource_closers.append(stats.finish)
+        return response
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            stats = start(request)
+            return track(stats, await get_response(request))
+    else:
+        def middleware(request):
+            stats = start(request)
+            return track(stats, get_response(request))
+    return middleware
+
+
+# ----------------------------------------
+# HOOKS
+# ----------------------------------------
+def record_cache(cache, hit):
+    if settings.METRICS_ENABLED:
+        CACHE_LOOKUPS.inc(endpoint=endpoint(), cache=cache, result="hit" if hit else "miss")
+
+
+def record_rejection(scope):
+    if settings.METRICS_ENABLED:
+        RATE_LIMITED.inc(endpoint=endpoint(), scope=scope)
+
+
+def record_model_error(operation, error):
+    if settings.METRICS_ENABLED:
+        # Model calls raise ModelErrors (chatbot/resilience.py); anything else is a bug.
+        status = getattr(error, "status_code", 500)
+        MODEL_ERRORS.inc(endpoint=endpoint(), operation=operation, status=status)
+
+
+def record_model_call(operation, seconds, usage=None, generating=None):
+    """
+    Record a finished model call taking ``seconds``.
+
+    Tokens per second are the reply tokens in ``usage`` over ``generating``
+    seconds (the whole call unless given, e.g. from the first chunk on).
+    """
+    if not settings.METRICS_ENABLED:
+        return
+    label = endpoint()
+    MODEL_SECONDS.observe(seconds, endpoint=label, operation=operation)
+    generating = seconds if generating is None else generating
+    if usage is not None and usage.candidate_tokens and generating > 0:
+        MODEL_TOKENS_PER_SECOND.observe(usage.candidate_tokens / generating, endpoint=label, operation=operation)
+
+
+@contextmanager
+def model_call(operation, usage=None):
+    """Time the model call in the ``with`` block; failures count as errors."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as exc:
+        record_model_error(operation, exc)
+        raise
+    record_model_call(operation, time.perf_counter() - started, usage)
+
+
+def record_first_chunk(seconds):
+    if settings.METRICS_ENABLED:
+        MODEL_TTFT.observe(seconds, endpoint=endpoint())
+
+
+def metrics_view(request):
+    if not settings.METRICS_ENABLED or (settings.METRICS_REQUIRE_TOKEN and not settings.METRICS_TOKEN):
+        return HttpResponse(status=404)
+    if settings.METRICS_TOKEN:
+        expected = f"Bearer {settings.METRICS_TOKEN}"
+        if not constant_time_compare(request.headers.get("Authorization", ""), expected):
+            return HttpResponseForbidden()
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
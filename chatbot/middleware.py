@@ -0,0 +1,22 @@
+from asgiref.sync import iscoroutinefunction
+from django.utils.decorators import sync_and_async_middleware
+
+from .authentication import GUEST_HEADER
+
+
+@sync_and_async_middleware
+def guest_session_middleware(get_response):
+    """Send a newly issued guest token (authentication.get_guest_user) back in X-Guest-Token."""
+    def add_guest_token(request, response):
+        token = getattr(request, "guest_token", None)
+        if token is not None:
+            response[GUEST_HEADER] = token
+        return response
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            return add_guest_token(request, await get_response(request))
+    else:
+        def middleware(request):
+            return add_guest_token(request, get_response(request))
+    return middleware
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.10 on 2026-10-18 13:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0006_conversation_user_created_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
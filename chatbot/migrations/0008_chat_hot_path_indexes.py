@@ -0,0 +1,47 @@
+# Generated by Django 5.2.10 on 2026-10-18 13:35
+
+from django.db import migrations, models
+
+
+def create_title_search_index(apps, schema_editor):
+    # icontains compiles to UPPER(title) LIKE UPPER(%s) on PostgreSQL, which a
+    # trigram GIN index on the same expression can serve. Other databases
+    # get a covering (user, title) index so a per-user search scans the
+    # index instead of the table.
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS conversation_title_trgm_idx "
+            "ON chatbot_conversation USING gin (UPPER(title) gin_trgm_ops)"
+        )
+    else:
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS conversation_user_title_idx "
+            "ON chatbot_conversation (user_id, title)"
+        )
+
+
+def drop_title_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute("DROP INDEX IF EXISTS conversation_title_trgm_idx")
+    else:
+        schema_editor.execute("DROP INDEX IF EXISTS conversation_user_title_idx")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0007_conversation_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['conversation', 'timestamp', 'id'], name='message_conv_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['conversation', 'role', '-timestamp'], name='message_conv_role_ts_idx'),
+        ),
+        migrations.RunPython(create_title_search_index, drop_title_search_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.10 on 2026-10-18 13:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0010_retrieval_memory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='summary_levels',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
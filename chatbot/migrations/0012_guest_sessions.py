@@ -0,0 +1,23 @@
+# Generated by Django 5.2.10 on 2026-10-18 13:58
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('chatbot', '0011_summary_levels'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GuestSession',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='guest_session', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
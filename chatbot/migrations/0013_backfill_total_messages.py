@@ -0,0 +1,31 @@
+from django.db import migrations
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_total_messages(apps, schema_editor):
+    # Conversations from before the counter was kept up to date (the old
+    # stream view never touched it) may show 0 and be taken for a first turn.
+    Conversation = apps.get_model("chatbot", "Conversation")
+    ChatMessage = apps.get_model("chatbot", "ChatMessage")
+    counts = (
+        ChatMessage.objects.filter(conversation=OuterRef("pk"))
+        .order_by()
+        .values("conversation")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    Conversation.objects.update(
+        total_messages=Coalesce(Subquery(counts, output_field=IntegerField()), 0)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0012_guest_sessions'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_total_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations
+from django.utils import timezone
+
+
+def expire_legacy_guest(apps, schema_editor):
+    # Before guest sessions every anonymous caller shared the "ella_guest"
+    # user. An expired session hands it, with its conversations and files,
+    # to tasks.reap_guest_sessions.
+    User = apps.get_model("auth", "User")
+    GuestSession = apps.get_model("chatbot", "GuestSession")
+    user = User.objects.filter(username="ella_guest", guest_session__isnull=True).first()
+    if user is not None:
+        GuestSession.objects.create(user=user, expires_at=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0013_backfill_total_messages'),
+    ]
+
+    operations = [
+        migrations.RunPython(expire_legacy_guest, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import F
 from django.contrib.auth.models import User
 from django.utils import timezone
 
@@ -12,11 +13,60 @@ class Conversation(models.Model):
     title = models.CharField(max_length=255)
     created_at = models.DateTimeField(default=timezone.now)
     summary = models.TextField(blank=True, null=True)
+    # Segments behind ``summary``, by level; see chatbot/summaries.py.
+    summary_levels = models.JSONField(default=list, blank=True)
+    # Id of the newest message already folded into ``summary``.
+    summary_until = models.BigIntegerField(default=0)
     total_messages = models.IntegerField(default=0)
     total_tokens = models.IntegerField(default=0)
+    # Bumped on every message or title change; drives message ETags.
+    version = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination and title search in list_conversations.
+            # Migration 0008 also adds a trigram index on UPPER(title) on
+            # PostgreSQL (what icontains compiles to) and a covering
+            # (user, title) index elsewhere.
+            models.Index(fields=["user", "-created_at", "-id"], name="conversation_user_created_idx"),
+        ]
+
     def __str__(self):
         return f"{self.user.username} - {self.title}"
 
+    @classmethod
+    def bump_version(cls, conversation_id, added_messages=0):
+        cls.objects.filter(id=conversation_id).update(
+            version=F("version") + 1,
+            total_messages=F("total_messages") + added_messages,
+        )
+
+    @classmethod
+    async def abump_version(cls, conversation_id, added_messages=0):
+        await cls.objects.filter(id=conversation_id).aupdate(
+            version=F("version") + 1,
+            total_messages=F("total_messages") + added_messages,
+        )
+
+
+class FileBlob(models.Model):
+    """
+    One stored copy of an uploaded file, addressed by its sha256.
+
+    Messages that attach the same content share the blob; ref_count is the
+    number of them and the blob (and its file) goes away at zero, see
+    chatbot/blobs.py.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to="chat_blobs/")
+    size = models.BigIntegerField()
+    mime_type = models.CharField(max_length=255)
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.mime_type}, {self.ref_count} refs)"
+
 
 class ChatMessage(models.Model):
     conversation = models.ForeignKey(
@@ -43,12 +93,85 @@ class ChatMessage(models.Model):
         null=True
     )
 
+    # Deduplicated storage behind ``file`` for uploads since blobs existed
+    blob = models.ForeignKey(
+        FileBlob,
+        on_delete=models.PROTECT,
+        related_name="messages",
+        blank=True,
+        null=True
+    )
+
     timestamp = models.DateTimeField(default=timezone.now)
 
+    # Token usage reported by the model for the call that produced this message
+    prompt_tokens = models.IntegerField(default=0)
+    candidate_tokens = models.IntegerField(default=0)
+    cached_tokens = models.IntegerField(default=0)
+
     class Meta:
         ordering = ["timestamp"]
+        indexes = [
+            # Transcript reads, keyset paging and the context window.
+            models.Index(fields=["conversation", "timestamp", "id"], name="message_conv_timestamp_idx"),
+            # Latest message of a role (regenerate_response).
+            models.Index(fields=["conversation", "role", "-timestamp"], name="message_conv_role_ts_idx"),
+        ]
 
     def __str__(self):
         if self.content:
             return f"{self.conversation.title} ({self.role})"
         return f"{self.conversation.title} ({self.role} - file)"
+
+
+class MessageEmbedding(models.Model):
+    """Retrieval vector of one message, as float32 bytes (chatbot/memory.py)."""
+    message = models.OneToOneField(
+        ChatMessage,
+        on_delete=models.CASCADE,
+        related_name="embedding"
+    )
+    conversation = models.ForeignKey(
+        Conversation,
+        on_delete=models.CASCADE,
+        related_name="embeddings"
+    )
+    vector = models.BinaryField()
+
+    def __str__(self):
+        return f"embedding of message {self.message_id}"
+
+
+class UserTokenUsage(models.Model):
+    """Lifetime token usage per user, rolled up with F() updates."""
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        related_name="token_usage"
+    )
+    prompt_tokens = models.BigIntegerField(default=0)
+    candidate_tokens = models.BigIntegerField(default=0)
+    cached_tokens = models.BigIntegerField(default=0)
+    total_tokens = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.user.username} - {self.total_tokens} tokens"
+
+
+class GuestSession(models.Model):
+    """
+    Marks an anonymous user issued to one client (chatbot/authentication.py).
+
+    tasks.reap_guest_sessions deletes the user and everything it owns once
+    expires_at has passed.
+    """
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="guest_session"
+    )
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.user.username} until {self.expires_at}"
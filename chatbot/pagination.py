@@ -0,0 +1,51 @@
+"""
+Keyset (cursor) pagination over (timestamp, id) pairs.
+
+A cursor is the url-safe base64 of "<iso timestamp>|<id>" for the last row
+a client has seen. Filtering on the pair instead of OFFSET keeps every page
+an index range scan, however deep the client pages.
+"""
+import base64
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+def encode_cursor(timestamp, pk):
+    raw = f"{timestamp.isoformat()}|{pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Return (timestamp, id) for a cursor; raise ValueError if it is malformed."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, pk = base64.urlsafe_b64decode(padded.encode()).decode().split("|")
+        parsed = parse_datetime(timestamp)
+        pk = int(pk)
+    except (ValueError, UnicodeError, TypeError):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    if parsed is None:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    return parsed, pk
+
+
+def before(field, cursor):
+    """Rows strictly older than the cursor position, as a Q."""
+    timestamp, pk = decode_cursor(cursor)
+    return Q(**{f"{field}__lt": timestamp}) | Q(**{field: timestamp, "id__lt": pk})
+
+
+def after(field, cursor):
+    """Rows strictly newer than the cursor position, as a Q."""
+    timestamp, pk = decode_cursor(cursor)
+    return Q(**{f"{field}__gt": timestamp}) | Q(**{field: timestamp, "id__gt": pk})
+
+
+def page_limit(value, default=20, maximum=100):
+    """Parse a ?limit= value, clamped to [1, maximum]."""
+    try:
+        limit = int(value) if value else default
+    except ValueError:
+        limit = default
+    return max(1, min(limit, maximum))
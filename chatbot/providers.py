@@ -0,0 +1,428 @@
+import asyncio
+import hashlib
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from google import genai
+from google.genai import types
+
+
+PLAIN_TEXT_INSTRUCTION = "Reply in plain text only. Do not use markdown formatting like **bold** or *italics*."
+
+
+@dataclass
+class Usage:
+    """
+    Token usage of one model call, filled in by the provider.
+
+    Callers pass an instance as ``usage=`` and read it after the call (or
+    after the stream is exhausted); the return values stay plain text.
+    """
+
+    prompt_tokens: int = 0
+    candidate_tokens: int = 0
+    cached_tokens: int = 0
+
+    @property
+    def total_tokens(self):
+        return self.prompt_tokens + self.candidate_tokens
+
+    def add(self, other):
+        self.prompt_tokens += other.prompt_tokens
+        self.candidate_tokens += other.candidate_tokens
+        self.cached_tokens += other.cached_tokens
+
+    def set_from_metadata(self, metadata):
+        # Thinking tokens are billed as output, so they count as candidates.
+        self.prompt_tokens = metadata.prompt_token_count or 0
+        self.candidate_tokens = (metadata.candidates_token_count or 0) + (metadata.thoughts_token_count or 0)
+        self.cached_tokens = metadata.cached_content_token_count or 0
+
+
+@dataclass
+class RemoteFile:
+    """
+    A file already stored with the provider (e.g. the Gemini Files API).
+
+    Pass it to analyze_file in place of the bytes to reference the upload
+    instead of sending it again.
+    """
+
+    name: str
+    uri: str
+    mime_type: str
+
+
+class LLMProvider:
+    """
+    Interface for a chat model backend.
+
+    ``messages`` is always a list of ``{"role": ..., "content": ...}`` dicts.
+    Every operation has a sync and an async flavour so both the DRF views and
+    the async chat views can share one provider instance. Generation methods
+    fill the optional ``usage`` (a Usage) with the call's token counts.
+    ``analyze_file`` takes either the file's bytes or a RemoteFile returned
+    by ``upload_file`` (which reads from a path or binary stream). ``embed``
+    returns one vector of ``embedding_dimensions`` floats per text.
+    """
+
+    model = None
+    embedding_dimensions = None
+
+    def generate(self, messages, temperature=0.7, usage=None):
+        raise NotImplementedError
+
+    def stream(self, messages, temperature=0.7, usage=None):
+        raise NotImplementedError
+
+    def analyze_file(self, file_bytes, prompt, mime_type, usage=None):
+        raise NotImplementedError
+
+    def upload_file(self, source, mime_type):
+        raise NotImplementedError
+
+    def embed(self, texts):
+        raise NotImplementedError
+
+    def count_tokens(self, messages):
+        raise NotImplementedError
+
+    async def agenerate(self, messages, temperature=0.7, usage=None):
+        raise NotImplementedError
+
+    async def astream(self, messages, temperature=0.7, usage=None):
+        raise NotImplementedError
+        yield
+
+    async def aanalyze_file(self, file_bytes, prompt, mime_type, usage=None):
+        raise NotImplementedError
+
+    async def aupload_file(self, source, mime_type):
+        raise NotImplementedError
+
+    async def aembed(self, texts):
+        raise NotImplementedError
+
+    async def acount_tokens(self, messages):
+        raise NotImplementedError
+
+
+class GeminiProvider(LLMProvider):
+    def __init__(self, api_key, model, base_url=None, embedding_model=None, embedding_dimensions=256, timeout=None):
+        # base_url lets load tests point the client at a local stand-in server.
+        # Retries are left to chatbot/resilience.py; timeout is in seconds.
+        http_options = types.HttpOptions(
+            base_url=base_url,
+            timeout=int(timeout * 1000) if timeout else None,
+        )
+        self.client = genai.Client(api_key=api_key, http_options=http_options)
+        self.model = model
+        self.embedding_model = embedding_model
+        self.embedding_dimensions = embedding_dimensions
+
+    @property
+    def embed_config(self):
+        return types.EmbedContentConfig(output_dimensionality=self.embedding_dimensions)
+
+    @staticmethod
+    def format_contents(messages):
+        return [
+            types.Content(
+                role=msg["role"],
+                parts=[types.Part.from_text(text=msg["content"])]
+            )
+            for msg in messages
+        ]
+
+    @staticmethod
+    def file_part(file, mime_type):
+        if isinstance(file, RemoteFile):
+            return types.Part.from_uri(file_uri=file.uri, mime_type=file.mime_type)
+        return types.Part.from_bytes(data=file, mime_type=mime_type)
+
+    @classmethod
+    def file_contents(cls, file, prompt, mime_type):
+        return [
+            types.Content(
+                role="user",
+                parts=[
+                    cls.file_part(file, mime_type),
+                    types.Part.from_text(text=prompt),
+                ]
+            )
+        ]
+
+    @staticmethod
+    def remote_file(uploaded):
+        return RemoteFile(name=uploaded.name, uri=uploaded.uri, mime_type=uploaded.mime_type)
+
+    def record_usage(self, usage, metadata, messages, text):
+        if usage is None:
+            return
+        if metadata is not None:
+            usage.set_from_metadata(metadata)
+            return
+        # No usage metadata (e.g. a stand-in server): fall back to count_tokens.
+        usage.prompt_tokens = self.count_tokens(messages)
+        usage.candidate_tokens = self.count_tokens([{"role": "model", "content": text or ""}])
+
+    async def arecord_usage(self, usage, metadata, messages, text):
+        if usage is None:
+            return
+        if metadata is not None:
+            usage.set_from_metadata(metadata)
+            return
+        usage.prompt_tokens = await self.acount_tokens(messages)
+        usage.candidate_tokens = await self.acount_tokens([{"role": "model", "content": text or ""}])
+
+    def generate(self, messages, temperature=0.7, usage=None):
+        response = self.client.models.generate_content(
+            model=self.model,
+            contents=self.format_contents(messages),
+            config=types.GenerateContentConfig(temperature=temperature),
+        )
+        self.record_usage(usage, response.usage_metadata, messages, response.text)
+        return response.text
+
+    def stream(self, messages, temperature=0.7, usage=None):
+        stream = self.client.models.generate_content_stream(
+            model=self.model,
+            contents=self.format_contents(messages),
+            config=types.GenerateContentConfig(temperature=temperature),
+        )
+        metadata = None
+        chunks = []
+        for chunk in stream:
+            # Every chunk carries running totals; the last one is final.
+            metadata = chunk.usage_metadata or metadata
+            if chunk.text:
+                chunks.append(chunk.text)
+                yield chunk.text
+        self.record_usage(usage, metadata, messages, "".join(chunks))
+
+    def analyze_file(self, file_bytes, prompt, mime_type, usage=None):
+        response = self.client.models.generate_content(
+            model=self.model,
+            config=types.GenerateContentConfig(system_instruction=PLAIN_TEXT_INSTRUCTION),
+            contents=self.file_contents(file_bytes, prompt, mime_type),
+        )
+        if usage is not None and response.usage_metadata is not None:
+            usage.set_from_metadata(response.usage_metadata)
+        return response.text
+
+    def upload_file(self, source, mime_type):
+        uploaded = self.client.files.upload(file=source, config=types.UploadFileConfig(mime_type=mime_type))
+        return self.remote_file(uploaded)
+
+    def embed(self, texts):
+        response = self.client.models.embed_content(
+            model=self.embedding_model, contents=list(texts), config=self.embed_config
+        )
+        return [embedding.values for embedding in response.embeddings]
+
+    def count_tokens(self, messages):
+        response = self.client.models.count_tokens(
+            model=self.model,
+            contents=self.format_contents(messages),
+        )
+        return response.total_tokens
+
+    async def agenerate(self, messages, temperature=0.7, usage=None):
+        response = await self.client.aio.models.generate_content(
+            model=self.model,
+            contents=self.format_contents(messages),
+            config=types.GenerateContentConfig(temperature=temperature),
+        )
+        await self.arecord_usage(usage, response.usage_metadata, messages, response.text)
+        return response.text
+
+    async def astream(self, messages, temperature=0.7, usage=None):
+        stream = await self.client.aio.models.generate_content_stream(
+            model=self.model,
+            contents=self.format_contents(messages),
+            config=types.GenerateContentConfig(temperature=temperature),
+        )
+        metadata = None
+        chunks = []
+        async for chunk in stream:
+            metadata = chunk.usage_metadata or metadata
+            if chunk.text:
+                chunks.append(chunk.text)
+                yield chunk.text
+        await self.arecord_usage(usage, metadata, messages, "".join(chunks))
+
+    async def aanalyze_file(self, file_bytes, prompt, mime_type, usage=None):
+        response = await self.client.aio.models.generate_content(
+            model=self.model,
+            config=types.GenerateContentConfig(system_instruction=PLAIN_TEXT_INSTRUCTION),
+            contents=self.file_contents(file_bytes, prompt, mime_type),
+        )
+        if usage is not None and response.usage_metadata is not None:
+            usage.set_from_metadata(response.usage_metadata)
+        return response.text
+
+    async def aupload_file(self, source, mime_type):
+        uploaded = await self.client.aio.files.upload(file=source, config=types.UploadFileConfig(mime_type=mime_type))
+        return self.remote_file(uploaded)
+
+    async def aembed(self, texts):
+        response = await self.client.aio.models.embed_content(
+            model=self.embedding_model, contents=list(texts), config=self.embed_config
+        )
+        return [embedding.values for embedding in response.embeddings]
+
+    async def acount_tokens(self, messages):
+        response = await self.client.aio.models.count_tokens(
+            model=self.model,
+            contents=self.format_contents(messages),
+        )
+        return response.total_tokens
+
+
+class FakeProvider(LLMProvider):
+    """
+    Deterministic in-process provider for tests and load benchmarks.
+
+    The reply depends only on the prompt, so repeated runs are comparable.
+    ``latency`` is the delay before the first token and ``tokens_per_second``
+    throttles streaming (0 means unthrottled).
+    """
+
+    model = "fake"
+
+    def __init__(self, latency=0.0, tokens_per_second=0.0, reply_words=12, embedding_dimensions=256):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.reply_words = reply_words
+        self.embedding_dimensions = embedding_dimensions
+
+    def reply_for(self, text):
+        digest = hashlib.sha256((text or "").encode()).hexdigest()
+        return " ".join(f"tok{digest[i % len(digest)]}{i}" for i in range(self.reply_words))
+
+    def last_content(self, messages):
+        return messages[-1]["content"] if messages else ""
+
+    @property
+    def token_delay(self):
+        return 1 / self.tokens_per_second if self.tokens_per_second else 0
+
+    def record_usage(self, usage, messages, reply):
+        if usage is not None:
+            usage.prompt_tokens = self.count_tokens(messages)
+            usage.candidate_tokens = len(reply.split())
+
+    def generate(self, messages, temperature=0.7, usage=None):
+        time.sleep(self.latency + self.token_delay * self.reply_words)
+        reply = self.reply_for(self.last_content(messages))
+        self.record_usage(usage, messages, reply)
+        return reply
+
+    def stream(self, messages, temperature=0.7, usage=None):
+        time.sleep(self.latency)
+        reply = self.reply_for(self.last_content(messages))
+        for word in reply.split():
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            yield word + " "
+        self.record_usage(usage, messages, reply)
+
+    @staticmethod
+    def file_id(file):
+        if isinstance(file, RemoteFile):
+            return file.name.removeprefix("files/")
+        return hashlib.sha256(file).hexdigest()
+
+    def analyze_file(self, file_bytes, prompt, mime_type, usage=None):
+        time.sleep(self.latency)
+        reply = self.reply_for(prompt + self.file_id(file_bytes))
+        self.record_usage(usage, [{"role": "user", "content": prompt}], reply)
+        return reply
+
+    def upload_file(self, source, mime_type):
+        digest = hashlib.sha256()
+        stream = open(source, "rb") if isinstance(source, str) else source
+        try:
+            for block in iter(lambda: stream.read(64 * 1024), b""):
+                digest.update(block)
+        finally:
+            if stream is not source:
+                stream.close()
+        name = digest.hexdigest()
+        return RemoteFile(name=f"files/{name}", uri=f"fake://files/{name}", mime_type=mime_type)
+
+    def embed(self, texts):
+        # Hashed bag of words: texts sharing words get similar vectors.
+        vectors = []
+        for text in texts:
+            vector = [0.0] * self.embedding_dimensions
+            for word in (text or "").lower().split():
+                digest = hashlib.sha256(word.strip(".,!?").encode()).digest()
+                vector[int.from_bytes(digest[:4], "big") % self.embedding_dimensions] += 1.0
+            vectors.append(vector)
+        return vectors
+
+    def count_tokens(self, messages):
+        return sum(len((m["content"] or "").split()) for m in messages)
+
+    async def agenerate(self, messages, temperature=0.7, usage=None):
+        await asyncio.sleep(self.latency + self.token_delay * self.reply_words)
+        reply = self.reply_for(self.last_content(messages))
+        self.record_usage(usage, messages, reply)
+        return reply
+
+    async def astream(self, messages, temperature=0.7, usage=None):
+        await asyncio.sleep(self.latency)
+        reply = self.reply_for(self.last_content(messages))
+        for word in reply.split():
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            yield word + " "
+        self.record_usage(usage, messages, reply)
+
+    async def aanalyze_file(self, file_bytes, prompt, mime_type, usage=None):
+        await asyncio.sleep(self.latency)
+        reply = self.reply_for(prompt + self.file_id(file_bytes))
+        self.record_usage(usage, [{"role": "user", "content": prompt}], reply)
+        return reply
+
+    async def aupload_file(self, source, mime_type):
+        return self.upload_file(source, mime_type)
+
+    async def aembed(self, texts):
+        return self.embed(texts)
+
+    async def acount_tokens(self, messages):
+        return self.count_tokens(messages)
+
+
+@lru_cache(maxsize=None)
+def get_provider():
+    """Return the process-wide provider selected by settings.LLM_BACKEND."""
+    if settings.LLM_BACKEND == "fake":
+        return FakeProvider(
+            latency=settings.FAKE_LLM_LATENCY,
+            tokens_per_second=settings.FAKE_LLM_TOKENS_PER_SECOND,
+            embedding_dimensions=settings.EMBEDDING_DIMENSIONS,
+        )
+    if settings.LLM_BACKEND == "gemini":
+        return GeminiProvider(
+            api_key=settings.GEMINI_API_KEY,
+            model=settings.GEMINI_MODEL,
+            base_url=settings.GEMINI_BASE_URL,
+            embedding_model=settings.GEMINI_EMBEDDING_MODEL,
+            embedding_dimensions=settings.EMBEDDING_DIMENSIONS,
+            timeout=settings.MODEL_TIMEOUT,
+        )
+    raise ValueError(f"Unknown LLM_BACKEND: {settings.LLM_BACKEND!r}")
+
+
+@receiver(setting_changed)
+def reset_provider(setting, **kwargs):
+    # Lets override_settings(LLM_BACKEND=...) take effect in tests.
+    if setting.startswith(("LLM_", "GEMINI_", "FAKE_LLM_", "EMBEDDING_", "MODEL_TIMEOUT")):
+        get_provider.cache_clear()
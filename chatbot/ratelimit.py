@@ -0,0 +1,164 @@
+"""
+Sliding-window rate limiting for the model endpoints.
+
+Quotas are checked before any model work. Each rate ("20/m", "500/d") uses
+a sliding-window counter: two fixed buckets moved with atomic cache.add /
+cache.incr, with the previous bucket weighted by how much of it is still
+inside the window. Callers are keyed by user id when they send a valid
+token and by client IP otherwise; the IP is REMOTE_ADDR, or behind
+TRUSTED_PROXY_COUNT proxies the X-Forwarded-For entry the outermost one
+added (earlier entries come from the client). A daily token quota
+(DAILY_TOKEN_QUOTA) is checked against the counter, kept per caller the
+same way, that usage.record_usage increments.
+"""
+import inspect
+import math
+import time
+from datetime import timedelta
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse
+from django.utils import timezone
+
+from . import metrics
+from .authentication import aauthenticate_token
+
+
+PERIODS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_rate(rate):
+    """'20/m' -> (20, 60)."""
+    limit, period = rate.split("/")
+    return int(limit), PERIODS[period[0]]
+
+
+def client_ip(request):
+    proxies = settings.TRUSTED_PROXY_COUNT
+    if proxies:
+        forwarded = [ip.strip() for ip in request.META.get("HTTP_X_FORWARDED_FOR", "").split(",") if ip.strip()]
+        if len(forwarded) >= proxies:
+            return forwarded[-proxies]
+    return request.META.get("REMOTE_ADDR", "")
+
+
+def identity(user, request):
+    if user is not None and user.is_authenticated:
+        return f"user:{user.id}"
+    return f"ip:{client_ip(request)}"
+
+
+def bucket_keys(scope, ident, period, now):
+    window = int(now // period)
+    prefix = f"rl:{scope}:{ident}:{period}"
+    return f"{prefix}:{window}", f"{prefix}:{window - 1}", now - window * period
+
+
+def retry_after(limit, period, count, previous, elapsed):
+    """Seconds until the weighted count drops back under the limit."""
+    remaining = period - elapsed
+    if count >= limit or not previous:
+        return max(1, math.ceil(remaining))
+    return max(1, math.ceil(remaining - (limit - count) * period / previous))
+
+
+def evaluate(limit, period, count, previous, elapsed):
+    weighted = previous * (period - elapsed) / period + count
+    if weighted > limit:
+        return retry_after(limit, period, count, previous, elapsed)
+    return None
+
+
+def check_rate(scope, ident, rate, now=None):
+    """Count one hit; return None if allowed or the Retry-After seconds if not."""
+    limit, period = parse_rate(rate)
+    now = time.time() if now is None else now
+    current_key, previous_key, elapsed = bucket_keys(scope, ident, period, now)
+    cache.add(current_key, 0, timeout=period * 2)
+    count = cache.incr(current_key)
+    previous = cache.get(previous_key, 0)
+    return evaluate(limit, period, count, previous, elapsed)
+
+
+def daily_tokens_key(ident):
+    return f"tokens:{ident}:{timezone.now():%Y%m%d}"
+
+
+def seconds_until_midnight():
+    now = timezone.now()
+    midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return max(1, math.ceil((midnight - now).total_seconds()))
+
+
+def add_daily_tokens(ident, tokens):
+    key = daily_tokens_key(ident)
+    cache.add(key, 0, timeout=86400)
+    try:
+        cache.incr(key, tokens)
+    except ValueError:
+        cache.set(key, tokens, timeout=86400)
+
+
+def rejection(scope, seconds, message):
+    metrics.record_rejection(scope)
+    response = JsonResponse({"error": message, "scope": scope}, status=429)
+    response["Retry-After"] = str(seconds)
+    return response
+
+
+def check_quotas(scope, user, request, tokens):
+    """Return a 429 response if any quota for ``scope`` is exhausted, else None."""
+    ident = identity(user, request)
+    # The view charges the turn's tokens to the same caller (quota_identity).
+    request.quota_identity = ident
+    for rate in settings.RATE_LIMITS.get(scope, []):
+        seconds = check_rate(scope, ident, rate)
+        if seconds is not None:
+            return rejection(scope, seconds, "Rate limit exceeded")
+
+    if tokens and settings.DAILY_TOKEN_QUOTA:
+        if cache.get(daily_tokens_key(ident), 0) >= settings.DAILY_TOKEN_QUOTA:
+            return rejection(scope, seconds_until_midnight(), "Daily limit reached")
+    return None
+
+
+def quota_identity(request):
+    """Who rate_limit charged for ``request``: "user:<id>", "ip:<address>" or None."""
+    return getattr(request, "quota_identity", None)
+
+
+# Django's async cache methods are thread hops around the sync ones, so the
+# async path runs the whole check in a single hop instead of one per call.
+acheck_quotas = sync_to_async(check_quotas)
+
+
+def rate_limit(scope, tokens=False):
+    """
+    Reject over-quota callers with 429 + Retry-After before the view runs.
+
+    ``scope`` names an entry of settings.RATE_LIMITS (a list of rates);
+    ``tokens=True`` also enforces settings.DAILY_TOKEN_QUOTA. Works on
+    async views and on sync DRF views (place it under @api_view).
+    """
+    def decorator(view):
+        if inspect.iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                user = await aauthenticate_token(request)
+                rejected = await acheck_quotas(scope, user, request, tokens)
+                if rejected is not None:
+                    return rejected
+                return await view(request, *args, **kwargs)
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            rejected = check_quotas(scope, getattr(request, "user", None), request, tokens)
+            if rejected is not None:
+                return rejected
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,231 @@
+"""
+Resilience layer around model calls (used by chatbot/gemini.py).
+
+Provider errors become typed ModelErrors (chatbot/exceptions.py). Calls
+that fail with a timeout, a 429/5xx or a connection error are retried up
+to MODEL_RETRY_ATTEMPTS times with exponential backoff and full jitter;
+streams only until their first chunk, since a partial reply cannot be
+taken back. A process-wide circuit breaker opens after
+MODEL_BREAKER_FAILURES consecutive failures and fails calls fast with
+CircuitOpen for MODEL_BREAKER_RESET seconds before letting one trial call
+through. Idempotent, latency-sensitive async calls may be hedged: if no
+answer came after MODEL_HEDGE_DELAY seconds a second identical request
+starts and the first answer wins. The per-request timeout, MODEL_TIMEOUT,
+is enforced by the provider's HTTP client.
+"""
+import asyncio
+import logging
+import math
+import random
+import threading
+import time
+from contextlib import aclosing
+from functools import lru_cache
+
+import httpx
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from google.genai import errors as genai_errors
+
+from .exceptions import CircuitOpen, ModelError, ModelRejected, ModelTimeout, ModelUnavailable
+
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+def classify(exc):
+    """The ModelError for an exception raised by a provider call."""
+    if isinstance(exc, ModelError):
+        return exc
+    if isinstance(exc, (TimeoutError, httpx.TimeoutException)):
+        return ModelTimeout()
+    if isinstance(exc, genai_errors.APIError):
+        if exc.code in RETRYABLE_STATUS or exc.code >= 500:
+            return ModelUnavailable()
+        return ModelRejected()
+    if isinstance(exc, httpx.TransportError):
+        return ModelUnavailable()
+    return ModelError()
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: closed, open for ``reset_timeout``, then half-open."""
+
+    def __init__(self, failures, reset_timeout, clock=time.monotonic):
+        self.threshold = failures
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        """Raise CircuitOpen unless a call may go ahead now."""
+        with self.lock:
+            if self.opened_at is None:
+                return
+            remaining = self.reset_timeout - (self.clock() - self.opened_at)
+            if remaining > 0:
+                raise CircuitOpen(retry_after=max(1, math.ceil(remaining)))
+            # Half-open: this call is the trial. Re-arming the timer keeps
+            # others failing fast, and allows a new trial should this one
+            # never report back.
+            self.opened_at = self.clock()
+
+    def record(self, error=None):
+        """Record a call's outcome; only retryable errors mean the provider is unhealthy."""
+        with self.lock:
+            if error is None or not error.retryable:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning("Model circuit breaker opened after %s failures", self.failures)
+                self.opened_at = self.clock()
+
+
+@lru_cache(maxsize=None)
+def get_breaker():
+    return CircuitBreaker(settings.MODEL_BREAKER_FAILURES, settings.MODEL_BREAKER_RESET)
+
+
+@receiver(setting_changed)
+def reset_breaker(setting, **kwargs):
+    if setting.startswith("MODEL_BREAKER_"):
+        get_breaker.cache_clear()
+
+
+def backoff(attempt):
+    """Seconds to wait before retry ``attempt`` (0-based): full jitter."""
+    cap = min(settings.MODEL_RETRY_MAX_DELAY, settings.MODEL_RETRY_BASE_DELAY * 2 ** attempt)
+    return random.uniform(0, cap)
+
+
+def failed(breaker, exc, attempt):
+    """Record a failed attempt; return the ModelError to raise, or None to retry."""
+    error = classify(exc)
+    if not isinstance(error, CircuitOpen):
+        breaker.record(error)
+    if error.retryable and attempt + 1 < settings.MODEL_RETRY_ATTEMPTS:
+        logger.info("Model call failed (%s), retrying", exc)
+        return None
+    return error
+
+
+def call(func, *args, **kwargs):
+    """``func(*args, **kwargs)`` with retries and the circuit breaker."""
+    breaker = get_breaker()
+    for attempt in range(settings.MODEL_RETRY_ATTEMPTS):
+        try:
+            breaker.before_call()
+            result = func(*args, **kwargs)
+        except Exception as exc:
+            error = failed(breaker, exc, attempt)
+            if error is not None:
+                raise error from exc
+            time.sleep(backoff(attempt))
+        else:
+            breaker.record()
+            return result
+
+
+def stream(open_stream):
+    """Yield from ``open_stream()``, retrying (a fresh stream) until the first chunk."""
+    breaker = get_breaker()
+    for attempt in range(settings.MODEL_RETRY_ATTEMPTS):
+        started = False
+        try:
+            breaker.before_call()
+            for chunk in open_stream():
+                if not started:
+                    started = True
+                    breaker.record()
+                yield chunk
+        except Exception as exc:
+            if started:
+                error = classify(exc)
+                breaker.record(error)
+                raise error from exc
+            error = failed(breaker, exc, attempt)
+            if error is not None:
+                raise error from exc
+            time.sleep(backoff(attempt))
+        else:
+            if not started:
+                breaker.record()
+            return
+
+
+async def hedged(make_call, delay):
+    """Await ``make_call()``, starting a second copy if the first takes over ``delay`` seconds."""
+    first = asyncio.ensure_future(make_call())
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done:
+        return first.result()
+
+    pending = {first, asyncio.ensure_future(make_call())}
+    try:
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+            if not pending:
+                # Both failed: raise the last error.
+                return task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def acall(func, *args, hedge=False, **kwargs):
+    """Async ``call``; ``hedge=True`` hedges each attempt when MODEL_HEDGE_DELAY is set."""
+    breaker = get_breaker()
+    for attempt in range(settings.MODEL_RETRY_ATTEMPTS):
+        try:
+            breaker.before_call()
+            if hedge and settings.MODEL_HEDGE_DELAY:
+                result = await hedged(lambda: func(*args, **kwargs), settings.MODEL_HEDGE_DELAY)
+            else:
+                result = await func(*args, **kwargs)
+        except Exception as exc:
+            error = failed(breaker, exc, attempt)
+            if error is not None:
+                raise error from exc
+            await asyncio.sleep(backoff(attempt))
+        else:
+            breaker.record()
+            return result
+
+
+async def astream(open_stream):
+    """Async ``stream``."""
+    breaker = get_breaker()
+    for attempt in range(settings.MODEL_RETRY_ATTEMPTS):
+        started = False
+        try:
+            breaker.before_call()
+            async with aclosing(open_stream()) as chunks:
+                async for chunk in chunks:
+                    if not started:
+                        started = True
+                        breaker.record()
+                    yield chunk
+        except Exception as exc:
+            if started:
+                error = classify(exc)
+                breaker.record(error)
+                raise error from exc
+            error = failed(breaker, exc, attempt)
+            if error is not None:
+                raise error from exc
+            await asyncio.sleep(backoff(attempt))
+        else:
+            if not started:
+                breaker.record()
+            return
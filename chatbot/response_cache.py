@@ -0,0 +1,107 @@
+"""
+Content-addressed cache for model replies.
+
+Keys are a hash of (model, temperature, normalized messages), so identical
+one-shot prompts such as greetings or FAQ questions are answered once and
+served from the ``responses`` cache alias afterwards. File analyses are
+keyed by (model, file sha256, prompt) the same way. Expiry comes from
+RESPONSE_CACHE_TTL and eviction from the cache backend (LocMemCache culls
+least-recently-used entries past MAX_ENTRIES; configure Redis with
+``maxmemory-policy allkeys-lru``).
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+
+
+HITS_KEY = "stats:hits"
+MISSES_KEY = "stats:misses"
+
+
+def get_cache():
+    return caches["responses"]
+
+
+def is_enabled(use_cache):
+    return use_cache and settings.RESPONSE_CACHE_TTL > 0
+
+
+def normalize(text):
+    return " ".join((text or "").split())
+
+
+def cache_key(model, temperature, messages):
+    payload = json.dumps(
+        [model, temperature, [[m["role"], normalize(m["content"])] for m in messages]],
+        separators=(",", ":"),
+    )
+    return "reply:" + hashlib.sha256(payload.encode()).hexdigest()
+
+
+def file_cache_key(model, digest, prompt):
+    """Key for the analysis of a file (by content sha256) with ``prompt``."""
+    payload = json.dumps([model, digest, normalize(prompt)], separators=(",", ":"))
+    return "file:" + hashlib.sha256(payload.encode()).hexdigest()
+
+
+def increment(counter):
+    cache = get_cache()
+    cache.add(counter, 0, timeout=None)
+    try:
+        cache.incr(counter)
+    except ValueError:
+        # Evicted between add() and incr(); losing one sample is fine.
+        pass
+
+
+async def aincrement(counter):
+    cache = get_cache()
+    await cache.aadd(counter, 0, timeout=None)
+    try:
+        await cache.aincr(counter)
+    except ValueError:
+        pass
+
+
+def cache_name(key):
+    # "reply" or "file", for chatbot/metrics.py.
+    return key.split(":", 1)[0]
+
+
+def lookup(key):
+    reply = get_cache().get(key)
+    metrics.record_cache(cache_name(key), reply is not None)
+    increment(HITS_KEY if reply is not None else MISSES_KEY)
+    return reply
+
+
+async def alookup(key):
+    reply = await get_cache().aget(key)
+    metrics.record_cache(cache_name(key), reply is not None)
+    await aincrement(HITS_KEY if reply is not None else MISSES_KEY)
+    return reply
+
+
+def store(key, reply):
+    get_cache().set(key, reply, timeout=settings.RESPONSE_CACHE_TTL)
+
+
+async def astore(key, reply):
+    await get_cache().aset(key, reply, timeout=settings.RESPONSE_CACHE_TTL)
+
+
+def stats():
+    """Return hit/miss counters; every hit is a paid model call saved."""
+    counters = get_cache().get_many([HITS_KEY, MISSES_KEY])
+    hits = counters.get(HITS_KEY, 0)
+    misses = counters.get(MISSES_KEY, 0)
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / total if total else 0.0,
+    }
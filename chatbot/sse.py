@@ -0,0 +1,120 @@
+"""
+Server-Sent Events framing for the streaming chat endpoints.
+
+A streamed turn is a sequence of typed events:
+
+    token  {"delta": "..."}                    one chunk of the reply
+    usage  {"prompt_tokens": ..., ...}         token counts once the reply ends
+    title  {"title": "..."}                    title of a new conversation
+    error  {"error": "...", "status": ...}     the model call failed (HTTP-style status)
+    progress {"stage": ..., "done": ..., ...}  steps of a long document upload
+    done   {"message_id": ...}                 the reply is saved
+
+Token events carry the id "<turn>:<offset>", where turn is the id of the
+user message being answered and offset the number of reply characters sent
+so far; a client reconnecting with Last-Event-ID gets the rest of the reply.
+Idle streams send a comment every SSE_HEARTBEAT_INTERVAL seconds so proxies
+neither buffer nor time them out.
+"""
+import asyncio
+import json
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
+
+CONTENT_TYPE = "text/event-stream"
+HEARTBEAT = ": keep-alive\n\n"
+
+
+def wants_sse(request):
+    """True when the client asked for text/event-stream (Accept or ?format=sse)."""
+    return CONTENT_TYPE in request.headers.get("Accept", "") or request.GET.get("format") == "sse"
+
+
+def event_id(turn, offset):
+    return f"{turn}:{offset}"
+
+
+def parse_event_id(value):
+    """Return (turn, offset) for a Last-Event-ID value; raise ValueError if malformed."""
+    try:
+        turn, offset = (value or "").split(":")
+        turn, offset = int(turn), int(offset)
+    except ValueError:
+        raise ValueError(f"Invalid event id: {value!r}")
+    if offset < 0:
+        raise ValueError(f"Invalid event id: {value!r}")
+    return turn, offset
+
+
+def format_event(name, data, id=None):
+    lines = []
+    if id is not None:
+        lines.append(f"id: {id}")
+    lines.append(f"event: {name}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+async def encode(events, turn=None, offset=0):
+    """
+    Render (name, data) pairs as SSE frames.
+
+    Token events are numbered from ``offset`` when ``turn`` is given, so the
+    stream can be resumed; without a turn (e.g. the public endpoint) there
+    is nothing to resume and frames carry no id.
+    """
+    async for name, data in events:
+        id = None
+        if name == "token" and turn is not None:
+            offset += len(data["delta"])
+            id = event_id(turn, offset)
+        yield format_event(name, data, id=id)
+
+
+async def plain_text(events):
+    """Render (name, data) pairs as the legacy text/plain stream."""
+    async for name, data in events:
+        if name == "token":
+            yield data["delta"]
+        elif name == "error":
+            yield f"Error: {data['error']}"
+
+
+async def next_item(iterator):
+    try:
+        return False, await anext(iterator)
+    except StopAsyncIteration:
+        return True, None
+
+
+async def with_heartbeats(frames, interval):
+    """Pass ``frames`` through, adding a HEARTBEAT whenever none came for ``interval`` seconds."""
+    iterator = aiter(frames)
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(next_item(iterator))
+            done, _ = await asyncio.wait({pending}, timeout=interval)
+            if not done:
+                yield HEARTBEAT
+                continue
+            finished, frame = pending.result()
+            pending = None
+            if finished:
+                return
+            yield frame
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+def response(events, turn=None, offset=0):
+    """A text/event-stream StreamingHttpResponse for (name, data) pairs."""
+    frames = with_heartbeats(encode(events, turn, offset), settings.SSE_HEARTBEAT_INTERVAL)
+    response = StreamingHttpResponse(frames, content_type=CONTENT_TYPE)
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
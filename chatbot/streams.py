@@ -0,0 +1,259 @@
+"""
+Buffers for in-flight streamed replies.
+
+A streamed turn is generated by a task that is not tied to the HTTP
+response: it appends every token to a buffer keyed by conversation and
+turn (the user message being answered) and saves the reply whether or not
+anyone is still listening. Responses follow the buffer, so a client that
+drops can reconnect, and a second tab can attach, and replay from any
+character offset.
+
+MemoryStreamBuffer is per process; CacheStreamBuffer keeps the stream in
+the default cache (Redis in production) so any worker can serve a follower.
+STREAM_BUFFER picks one ("memory", "cache", or "auto": cache when REDIS_URL
+is set). Producers run on the event loop, so this needs the ASGI server.
+"""
+import asyncio
+import logging
+import time
+from functools import lru_cache
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.db import close_old_connections
+from django.dispatch import receiver
+
+from .exceptions import stream_error_payload
+
+
+logger = logging.getLogger(__name__)
+
+# Strong references to running producers; the event loop only keeps weak ones.
+RUNNING = set()
+
+
+def stream_key(conversation_id, turn):
+    return f"{conversation_id}:{turn}"
+
+
+class StreamBuffer:
+    """
+    Interface shared by the buffer implementations.
+
+    A stream holds text chunks in order and, once the producer is done, a
+    trailer of (event, data) pairs (usage/title/done or error). Subclasses
+    implement open/append/close/read/wait; follow() is shared.
+    """
+
+    async def open(self, key):
+        """Start (or restart) the stream for ``key``."""
+        raise NotImplementedError
+
+    async def append(self, key, delta):
+        raise NotImplementedError
+
+    async def close(self, key, trailer):
+        raise NotImplementedError
+
+    async def read(self, key, start):
+        """Return (found, chunks from index ``start``, trailer or None)."""
+        raise NotImplementedError
+
+    async def wait(self, key, start):
+        """Return once the stream has more than ``start`` chunks or is closed."""
+        raise NotImplementedError
+
+    async def exists(self, key):
+        found, _, _ = await self.read(key, 0)
+        return found
+
+    async def follow(self, key, offset=0):
+        """Yield ("token", ...) events from character ``offset``, then the trailer."""
+        index = 0
+        skip = offset
+        while True:
+            found, chunks, trailer = await self.read(key, index)
+            if not found:
+                return
+            for chunk in chunks:
+                index += 1
+                if skip >= len(chunk):
+                    skip -= len(chunk)
+                    continue
+                yield "token", {"delta": chunk[skip:]}
+                skip = 0
+            if trailer is not None:
+                for event in trailer:
+                    yield event
+                return
+            await self.wait(key, index)
+
+
+class MemoryStream:
+    def __init__(self):
+        self.chunks = []
+        self.trailer = None
+        self.expires = None
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class MemoryStreamBuffer(StreamBuffer):
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.streams = {}
+
+    def prune(self):
+        now = time.monotonic()
+        for key in [k for k, s in self.streams.items() if s.expires is not None and s.expires < now]:
+            del self.streams[key]
+
+    async def open(self, key):
+        self.prune()
+        self.streams[key] = MemoryStream()
+
+    async def append(self, key, delta):
+        stream = self.streams[key]
+        stream.chunks.append(delta)
+        stream.notify()
+
+    async def close(self, key, trailer):
+        stream = self.streams[key]
+        stream.trailer = list(trailer)
+        stream.expires = time.monotonic() + self.ttl
+        stream.notify()
+
+    async def read(self, key, start):
+        stream = self.streams.get(key)
+        if stream is None:
+            return False, [], None
+        return True, stream.chunks[start:], stream.trailer
+
+    async def wait(self, key, start):
+        stream = self.streams.get(key)
+        while stream is not None and len(stream.chunks) <= start and stream.trailer is None:
+            await stream.changed.wait()
+
+
+class CacheStreamBuffer(StreamBuffer):
+    """
+    Stream kept in the cache as one key per chunk plus a chunk count.
+
+    The single producer writes a chunk before publishing the new count, so
+    readers never see a count ahead of its chunks. Followers poll every
+    STREAM_POLL_INTERVAL seconds; every key expires STREAM_BUFFER_TTL
+    seconds after its last write.
+    """
+
+    def __init__(self, ttl, poll_interval):
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.counts = {}
+
+    @staticmethod
+    def keys(key):
+        prefix = f"stream:{key}"
+        return f"{prefix}:count", f"{prefix}:trailer", f"{prefix}:chunk"
+
+    def open_sync(self, key):
+        count_key, trailer_key, _ = self.keys(key)
+        cache.delete(trailer_key)
+        cache.set(count_key, 0, timeout=self.ttl)
+
+    def append_sync(self, key, index, delta):
+        count_key, _, chunk_key = self.keys(key)
+        cache.set(f"{chunk_key}:{index}", delta, timeout=self.ttl)
+        cache.set(count_key, index + 1, timeout=self.ttl)
+
+    def close_sync(self, key, trailer):
+        _, trailer_key, _ = self.keys(key)
+        cache.set(trailer_key, list(trailer), timeout=self.ttl)
+
+    def read_sync(self, key, start):
+        count_key, trailer_key, chunk_key = self.keys(key)
+        # Read the trailer first: if it is set, the count is final.
+        trailer = cache.get(trailer_key)
+        count = cache.get(count_key)
+        if count is None:
+            return False, [], None
+        wanted = [f"{chunk_key}:{i}" for i in range(start, count)]
+        found = cache.get_many(wanted)
+        return True, [found.get(k, "") for k in wanted], trailer
+
+    async def open(self, key):
+        self.counts[key] = 0
+        await sync_to_async(self.open_sync)(key)
+
+    async def append(self, key, delta):
+        index = self.counts[key]
+        self.counts[key] = index + 1
+        await sync_to_async(self.append_sync)(key, index, delta)
+
+    async def close(self, key, trailer):
+        self.counts.pop(key, None)
+        await sync_to_async(self.close_sync)(key, trailer)
+
+    async def read(self, key, start):
+        return await sync_to_async(self.read_sync)(key, start)
+
+    async def wait(self, key, start):
+        await asyncio.sleep(self.poll_interval)
+
+
+@lru_cache(maxsize=None)
+def get_stream_buffer():
+    """Return the process-wide buffer selected by settings.STREAM_BUFFER."""
+    backend = settings.STREAM_BUFFER
+    if backend == "auto":
+        backend = "cache" if settings.REDIS_URL else "memory"
+    if backend == "memory":
+        return MemoryStreamBuffer(ttl=settings.STREAM_BUFFER_TTL)
+    if backend == "cache":
+        return CacheStreamBuffer(ttl=settings.STREAM_BUFFER_TTL, poll_interval=settings.STREAM_POLL_INTERVAL)
+    raise ValueError(f"Unknown STREAM_BUFFER: {settings.STREAM_BUFFER!r}")
+
+
+@receiver(setting_changed)
+def reset_stream_buffer(setting, **kwargs):
+    if setting.startswith("STREAM_") or setting == "REDIS_URL":
+        get_stream_buffer.cache_clear()
+
+
+async def produce(buffer, key, events):
+    """Drain ``events`` into the buffer: tokens as chunks, the rest as the trailer."""
+    trailer = []
+    try:
+        async for name, data in events:
+            if name == "token":
+                await buffer.append(key, data["delta"])
+            else:
+                trailer.append((name, data))
+    except Exception as e:
+        logger.exception("Stream %s failed", key)
+        trailer.append(("error", stream_error_payload(e)))
+    finally:
+        await buffer.close(key, trailer)
+        # The producer outlives the request, so request_finished never
+        # releases the connection its ORM calls used (back to the pool, or
+        # closed without one).
+        await sync_to_async(close_old_connections)()
+
+
+async def start(key, events):
+    """
+    Open a stream for ``key`` and run ``events`` into it in the background.
+
+    The producer outlives the request, so the reply is generated and saved
+    even if every follower disconnects. Returns the buffer to follow.
+    """
+    buffer = get_stream_buffer()
+    await buffer.open(key)
+    task = asyncio.ensure_future(produce(buffer, key, events))
+    RUNNING.add(task)
+    task.add_done_callback(RUNNING.discard)
+    return buffer
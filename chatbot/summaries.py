@@ -0,0 +1,51 @@
+"""
+Hierarchical rolling summary of a conversation.
+
+Conversation.summary_levels is a list of levels, each a list of summary
+segments, oldest first. Every compaction adds one segment to level 0
+summarizing only the messages that aged out since the last one. A level
+holding more than SUMMARY_LEVEL_TOKENS is merged into a single segment on
+the next level (the top level, SUMMARY_MAX_LEVELS - 1, is merged in
+place). Each model call therefore sees a bounded amount of text, however
+long the conversation gets. Conversation.summary keeps the rendered text
+for context.abuild_history.
+"""
+from django.conf import settings
+
+from .context import estimate_tokens
+
+
+def level_tokens(level):
+    return sum(estimate_tokens(segment) for segment in level)
+
+
+def add_segment(levels, segment, merge):
+    """
+    Return ``levels`` with ``segment`` added and oversized levels merged.
+
+    ``merge`` turns a list of segments into one, or returns None on
+    failure, in which case the level is left as it is for a later run.
+    """
+    levels = [list(level) for level in levels] or [[]]
+    levels[0].append(segment)
+    top = settings.SUMMARY_MAX_LEVELS - 1
+    for depth in range(len(levels)):
+        level = levels[depth]
+        if len(level) < 2 or level_tokens(level) <= settings.SUMMARY_LEVEL_TOKENS:
+            continue
+        merged = merge(level)
+        if merged is None:
+            break
+        if depth >= top:
+            levels[depth] = [merged]
+            break
+        levels[depth] = []
+        if depth + 1 == len(levels):
+            levels.append([])
+        levels[depth + 1].append(merged)
+    return levels
+
+
+def render(levels):
+    """Summary text, most condensed (oldest) level first."""
+    return "\n\n".join(segment for level in reversed(levels) for segment in level)
@@ -0,0 +1,155 @@
+"""
+Background jobs that must not add latency to a chat request.
+
+Jobs run on a process-local thread pool (BACKGROUND_TASK_WORKERS threads).
+Each job opens its own DB connection and closes it when done, and must be
+safe to run twice: triggers can race across requests and workers, and a
+job that loses its DB connection is run again (db.db_retry).
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from . import summaries
+from .db import db_retry
+from .exceptions import ModelError
+from .gemini import merge_summaries, summarize_conversation
+from .models import ChatMessage, Conversation, GuestSession
+from .providers import Usage
+from .usage import record_usage
+
+
+logger = logging.getLogger(__name__)
+
+# Compress once a conversation holds more than this many messages...
+MEMORY_COMPRESSION_THRESHOLD = 30
+# ...by folding this many of the oldest messages into Conversation.summary.
+MEMORY_COMPRESSION_BATCH = 20
+
+
+@lru_cache(maxsize=None)
+def get_executor():
+    return ThreadPoolExecutor(
+        max_workers=settings.BACKGROUND_TASK_WORKERS,
+        thread_name_prefix="chatbot-task",
+    )
+
+
+def run_task(func, *args):
+    close_old_connections()
+    try:
+        # Jobs are idempotent, so a dropped connection just means another go.
+        db_retry(func)(*args)
+    except Exception:
+        logger.exception("Background task %s failed", func.__name__)
+    finally:
+        close_old_connections()
+
+
+def submit(func, *args):
+    """Queue ``func(*args)`` on the background pool and return immediately."""
+    return get_executor().submit(run_task, func, *args)
+
+
+def compress_conversation_memory(conversation_id):
+    """
+    Fold the oldest unsummarized messages into the conversation's rolling summary.
+
+    Only those messages are summarized (chatbot/summaries.py keeps the
+    summary itself bounded). Messages are kept: Conversation.summary_until
+    marks the last one folded in, and older messages stay reachable
+    through retrieval memory.
+    """
+    lock_key = f"memory_compression_{conversation_id}"
+    if not cache.add(lock_key, True, timeout=300):
+        return
+
+    try:
+        conversation = Conversation.objects.filter(id=conversation_id).first()
+        if conversation is None:
+            return
+        unsummarized = conversation.messages.filter(id__gt=conversation.summary_until)
+        if unsummarized.count() <= MEMORY_COMPRESSION_THRESHOLD:
+            return
+
+        old_messages = list(
+            unsummarized.order_by("id").values("id", "role", "content")[:MEMORY_COMPRESSION_BATCH]
+        )
+        usage = Usage()
+        try:
+            segment = summarize_conversation(old_messages, usage=usage)
+        except ModelError:
+            logger.warning("Could not summarize conversation %s", conversation_id, exc_info=True)
+            return
+
+        def merge(segments):
+            try:
+                return merge_summaries(segments, usage=usage)
+            except ModelError:
+                return None
+
+        levels = conversation.summary_levels
+        if not levels and conversation.summary:
+            # Summaries written before levels existed.
+            levels = [[conversation.summary]]
+        levels = summaries.add_segment(levels, segment, merge)
+        record_usage(conversation_id, conversation.user_id, usage)
+
+        # A no-op when another run already folded these messages in.
+        Conversation.objects.filter(id=conversation_id, summary_until=conversation.summary_until).update(
+            summary=summaries.render(levels),
+            summary_levels=levels,
+            summary_until=old_messages[-1]["id"],
+        )
+    finally:
+        cache.delete(lock_key)
+
+
+def submit_guest_reaper():
+    """Queue reap_guest_sessions at most once per GUEST_REAP_INTERVAL seconds (0 = never)."""
+    interval = settings.GUEST_REAP_INTERVAL
+    if interval and cache.add("guest_reaper", True, timeout=interval):
+        submit(reap_guest_sessions)
+
+
+def reap_guest_sessions():
+    """
+    Delete expired guest users with their conversations, messages and files.
+
+    Users go GUEST_REAP_BATCH at a time, each batch in one queryset delete;
+    blob references are released by the usual post_delete receiver and
+    files from before blobs existed are removed once the batch commits.
+    Returns the number of guests removed.
+    """
+    reaped = 0
+    while True:
+        user_ids = list(
+            GuestSession.objects.filter(expires_at__lte=timezone.now())
+            .order_by("expires_at")
+            .values_list("user_id", flat=True)[:settings.GUEST_REAP_BATCH]
+        )
+        if not user_ids:
+            return reaped
+
+        with transaction.atomic():
+            legacy_files = list(
+                ChatMessage.objects.filter(conversation__user_id__in=user_ids, blob__isnull=True)
+                .exclude(file="")
+                .exclude(file__isnull=True)
+                .values_list("file", flat=True)
+            )
+            User.objects.filter(id__in=user_ids).delete()
+            transaction.on_commit(lambda files=legacy_files: delete_files(files))
+        reaped += len(user_ids)
+
+
+def delete_files(names):
+    for name in names:
+        default_storage.delete(name)
@@ -1,3 +1,1398 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import importlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps as django_apps
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache, caches
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import OperationalError
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from google.genai import errors as genai_errors
+from rest_framework.authtoken.models import Token
+
+from . import authentication, context, db, documents, memory, metrics, ratelimit, resilience, response_cache, sse, streams, summaries, uploads, views
+from .context import abuild_history, estimate_tokens
+from .exceptions import CircuitOpen, ModelUnavailable
+from .gemini import aask_gemini, amap_reduce_document, ask_gemini, ask_gemini_stream
+from .models import ChatMessage, Conversation, FileBlob, GuestSession, MessageEmbedding
+from .providers import get_provider
+from .tasks import compress_conversation_memory, reap_guest_sessions
+
+
+@override_settings(LLM_BACKEND="fake", AUTH_CACHE_TTL=60)
+class ChatViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        caches["responses"].clear()
+        self.user = User.objects.create_user(username="alice", password="secret")
+        self.token = Token.objects.create(user=self.user)
+        self.conversation = Conversation.objects.create(user=self.user, title="New Chat")
+        self.auth = {"HTTP_AUTHORIZATION": f"Token {self.token.key}"}
+
+    def post_json(self, path, payload):
+        return self.client.post(path, payload, content_type="application/json", **self.auth)
+
+    def test_chat_saves_both_turns(self):
+        response = self.post_json("/api/chat/", {"message": "hello", "conversation_id": self.conversation.id})
+
+        self.assertEqual(response.status_code, 200)
+        expected = get_provider().reply_for("hello")
+        self.assertEqual(response.json()["reply"], expected)
+        self.assertEqual(
+            list(self.conversation.messages.values_list("role", "content")),
+            [("user", "hello"), ("model", expected)],
+        )
+
+    def test_chat_records_token_usage(self):
+        self.post_json("/api/chat/", {"message": "hello there", "conversation_id": self.conversation.id})
+
+        reply = ChatMessage.objects.get(conversation=self.conversation, role="model")
+        self.assertEqual(reply.prompt_tokens, 2)
+        self.assertEqual(reply.candidate_tokens, 12)
+        self.conversation.refresh_from_db()
+        # The reply plus the first-turn title call.
+        self.assertGreater(self.conversation.total_tokens, reply.prompt_tokens + reply.candidate_tokens)
+        self.assertEqual(self.user.token_usage.total_tokens, self.conversation.total_tokens)
+
+    @override_settings(RATE_LIMITS={"chat": ["2/m"]})
+    def test_chat_rate_limited_before_model_call(self):
+        payload = {"message": "hello", "conversation_id": self.conversation.id}
+        self.post_json("/api/chat/", payload)
+        self.post_json("/api/chat/", payload)
+
+        with mock.patch("chatbot.views.aask_gemini") as ask:
+            response = self.post_json("/api/chat/", payload)
+
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response.headers)
+        ask.assert_not_called()
+        self.assertEqual(self.conversation.messages.filter(role="user").count(), 2)
+
+    def test_chat_turn_statement_count(self):
+        payload = {"message": "hello", "conversation_id": self.conversation.id}
+        self.post_json("/api/chat/", payload)
+
+        # Conversation (the token is cached), then one transaction:
+        # savepoint, bulk insert, conversation F() update, user usage F()
+        # update, release.
+        with self.assertNumQueries(6):
+            self.post_json("/api/chat/", payload)
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.total_messages, 4)
+        self.assertEqual(self.conversation.version, 2)
+
+    def test_first_turn_sets_title_from_counter(self):
+        self.post_json("/api/chat/", {"message": "hello", "conversation_id": self.conversation.id})
+        self.conversation.refresh_from_db()
+        first_title = self.conversation.title
+
+        self.post_json("/api/chat/", {"message": "something else", "conversation_id": self.conversation.id})
+        self.conversation.refresh_from_db()
+
+        self.assertNotEqual(first_title, "New Chat")
+        self.assertEqual(self.conversation.title, first_title)
+
+    @override_settings(TITLE_GENERATION_TIMEOUT=0.01)
+    def test_slow_title_falls_back_to_heuristic(self):
+        async def slow_title(*args, **kwargs):
+            await asyncio.sleep(1)
+            return "Never Used"
+
+        with mock.patch("chatbot.views.agenerate_conversation_title", slow_title):
+            response = self.post_json("/api/chat/", {"message": "how do vectors work?", "conversation_id": self.conversation.id})
+
+        self.assertEqual(response.json()["title"], "How do vectors work")
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.title, "How do vectors work")
+
+    def test_title_runs_alongside_reply(self):
+        title_started = asyncio.Event()
+
+        async def title(*args, **kwargs):
+            title_started.set()
+            return "Vector Basics"
+
+        async def reply(*args, **kwargs):
+            # Only finishes if the title call is already in flight.
+            await asyncio.wait_for(title_started.wait(), timeout=1)
+            return "an answer"
+
+        with mock.patch("chatbot.views.agenerate_conversation_title", title), \
+                mock.patch("chatbot.views.aask_gemini", reply):
+            response = self.post_json("/api/chat/", {"message": "vectors?", "conversation_id": self.conversation.id})
+
+        self.assertEqual(response.json()["title"], "Vector Basics")
+
+    async def test_title_is_cancelled_when_the_turn_fails(self):
+        started = []
+
+        def start(*args):
+            started.append(real_start(*args))
+            return started[-1]
+
+        real_start = views.start_title_generation
+        with mock.patch("chatbot.views.start_title_generation", start), \
+                mock.patch("chatbot.views.abuild_history", side_effect=RuntimeError("boom")), \
+                self.assertRaises(RuntimeError):
+            await self.async_client.post(
+                "/api/chat/", {"message": "hello", "conversation_id": self.conversation.id},
+                content_type="application/json", headers={"Authorization": f"Token {self.token.key}"},
+            )
+
+        await asyncio.sleep(0)
+        self.assertTrue(started[0].cancelled())
+
+    def test_chat_rejects_other_users_conversation(self):
+        other = Conversation.objects.create(user=User.objects.create_user(username="bob"), title="x")
+
+        response = self.post_json("/api/chat/", {"message": "hello", "conversation_id": other.id})
+
+        self.assertEqual(response.status_code, 404)
+
+    async def test_stream_persists_reply(self):
+        response = await self.async_client.post(
+            "/api/chat/stream/",
+            {"message": "hello", "conversation_id": self.conversation.id},
+            content_type="application/json",
+            headers={"Authorization": f"Token {self.token.key}"},
+        )
+
+        body = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        self.assertEqual(body.strip(), get_provider().reply_for("hello"))
+        self.assertEqual(await ChatMessage.objects.filter(conversation=self.conversation, role="model").acount(), 1)
+
+    async def test_stream_saves_reply_after_client_disconnects(self):
+        response = await self.async_client.post(
+            "/api/chat/stream/",
+            {"message": "hello", "conversation_id": self.conversation.id},
+            content_type="application/json",
+            headers={"Authorization": f"Token {self.token.key}"},
+        )
+        content = aiter(response.streaming_content)
+        await anext(content)
+        await content.aclose()
+
+        await asyncio.gather(*streams.RUNNING)
+
+        reply = await ChatMessage.objects.aget(conversation=self.conversation, role="model")
+        self.assertEqual(reply.content.strip(), get_provider().reply_for("hello"))
+
+    async def read_sse(self, path, method="post", payload=None, **headers):
+        send = getattr(self.async_client, method)
+        response = await send(
+            path,
+            payload,
+            content_type="application/json",
+            headers={"Authorization": f"Token {self.token.key}", "Accept": "text/event-stream", **headers},
+        )
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        body = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        frames = []
+        for block in body.strip().split("\n\n"):
+            fields = dict(line.split(": ", 1) for line in block.splitlines())
+            frames.append((fields.get("id"), fields["event"], json.loads(fields["data"])))
+        return frames
+
+    async def test_sse_stream_sends_typed_events(self):
+        frames = await self.read_sse("/api/chat/stream/", payload={"message": "hello", "conversation_id": self.conversation.id})
+
+        events = [name for _, name, _ in frames]
+        self.assertEqual(events[-4:], ["token", "usage", "title", "done"])
+        reply = "".join(data["delta"] for _, name, data in frames if name == "token")
+        self.assertEqual(reply.strip(), get_provider().reply_for("hello"))
+
+        saved = await ChatMessage.objects.aget(conversation=self.conversation, role="model")
+        self.assertEqual(frames[-1][2], {"message_id": saved.id, "truncated": False})
+        user_message = await ChatMessage.objects.aget(conversation=self.conversation, role="user")
+        self.assertEqual(frames[-4][0], f"{user_message.id}:{len(reply)}")
+
+    @override_settings(STREAM_MAX_REPLY_CHARS=20)
+    async def test_stream_stops_at_reply_cap(self):
+        frames = await self.read_sse("/api/chat/stream/", payload={"message": "hello", "conversation_id": self.conversation.id})
+
+        reply = "".join(data["delta"] for _, name, data in frames if name == "token")
+        self.assertEqual(reply, get_provider().reply_for("hello")[:20])
+        self.assertTrue(frames[-1][2]["truncated"])
+        saved = await ChatMessage.objects.aget(conversation=self.conversation, role="model")
+        self.assertEqual(saved.content, reply)
+
+    async def test_reply_exactly_at_cap_is_not_truncated(self):
+        # The fake model streams each word followed by a space.
+        reply = get_provider().reply_for("hello") + " "
+
+        with self.settings(STREAM_MAX_REPLY_CHARS=len(reply)):
+            frames = await self.read_sse("/api/chat/stream/", payload={"message": "hello", "conversation_id": self.conversation.id})
+
+        self.assertEqual("".join(data["delta"] for _, name, data in frames if name == "token"), reply)
+        self.assertFalse(frames[-1][2]["truncated"])
+
+    @override_settings(MODEL_RETRY_BASE_DELAY=0)
+    async def test_sse_stream_reports_errors_without_saving(self):
+        async def failing(*args, **kwargs):
+            raise server_error()
+            yield
+
+        with mock.patch.object(get_provider(), "astream", failing):
+            frames = await self.read_sse("/api/chat/stream/", payload={"message": "hello", "conversation_id": self.conversation.id})
+
+        self.assertEqual(frames, [(None, "error", {"error": str(ModelUnavailable()), "status": 503})])
+        self.assertFalse(await ChatMessage.objects.filter(conversation=self.conversation, role="model").aexists())
+
+    async def test_sse_resume_sends_rest_of_reply(self):
+        frames = await self.read_sse("/api/chat/stream/", payload={"message": "hello", "conversation_id": self.conversation.id})
+        first_id = frames[0][0]
+        reply = "".join(data["delta"] for _, name, data in frames if name == "token")
+
+        resumed = await self.read_sse(
+            f"/api/chat/stream/{self.conversation.id}/", method="get", **{"Last-Event-ID": first_id}
+        )
+
+        offset = int(first_id.split(":")[1])
+        self.assertEqual("".join(data["delta"] for _, name, data in resumed if name == "token"), reply[offset:])
+        self.assertEqual(resumed[-1][1], "done")
+
+        # Once the buffer has expired the saved reply is replayed instead.
+        streams.get_stream_buffer().streams.clear()
+        resumed = await self.read_sse(
+            f"/api/chat/stream/{self.conversation.id}/", method="get", **{"Last-Event-ID": first_id}
+        )
+        self.assertEqual(resumed[0][2], {"delta": reply[offset:]})
+
+
+def server_error(code=503):
+    return genai_errors.ServerError(code, {"error": {"code": code, "message": "overloaded", "status": "UNAVAILABLE"}})
+
+
+@override_settings(
+    LLM_BACKEND="fake", MODEL_RETRY_BASE_DELAY=0, MODEL_BREAKER_FAILURES=3, MODEL_BREAKER_RESET=30, MEMORY_TOP_K=0
+)
+class ResilienceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        caches["responses"].clear()
+        resilience.get_breaker.cache_clear()
+        self.provider = get_provider()
+        self.user = User.objects.create_user(username="alice")
+        self.token = Token.objects.create(user=self.user)
+        # Not a first turn, so no title call is made alongside the reply.
+        self.conversation = Conversation.objects.create(user=self.user, title="Greetings", total_messages=2)
+        self.headers = {"Authorization": f"Token {self.token.key}"}
+
+    async def chat(self):
+        return await self.async_client.post(
+            "/api/chat/",
+            {"message": "hello", "conversation_id": self.conversation.id},
+            content_type="application/json",
+            headers=self.headers,
+        )
+
+    async def test_retries_transient_errors(self):
+        errors = [server_error(), server_error(429)]
+        agenerate = self.provider.agenerate
+
+        async def flaky(messages, **kwargs):
+            if errors:
+                raise errors.pop(0)
+            return await agenerate(messages, **kwargs)
+
+        with mock.patch.object(self.provider, "agenerate", side_effect=flaky) as call:
+            reply = await aask_gemini([{"role": "user", "content": "hi"}])
+
+        self.assertEqual(call.call_count, 3)
+        self.assertEqual(reply, self.provider.reply_for("hi"))
+
+    async def regenerate(self):
+        await ChatMessage.objects.acreate(conversation=self.conversation, role="user", content="hello")
+        old = await ChatMessage.objects.acreate(conversation=self.conversation, role="model", content="old answer")
+        response = await self.async_client.post(
+            "/api/chat/regenerate/",
+            {"conversation_id": self.conversation.id},
+            content_type="application/json",
+            headers=self.headers,
+        )
+        return response, old
+
+    @override_settings(MEMORY_TOP_K=0)
+    async def test_failed_regenerate_keeps_the_old_reply(self):
+        with mock.patch.object(self.provider, "agenerate", side_effect=server_error()):
+            response, old = await self.regenerate()
+
+        self.assertEqual(response.status_code, 503)
+        self.assertTrue(await ChatMessage.objects.filter(id=old.id).aexists())
+        await self.conversation.arefresh_from_db()
+        self.assertEqual(self.conversation.total_messages, 2)
+
+    @override_settings(MEMORY_TOP_K=0)
+    async def test_regenerate_replaces_the_reply_unseen(self):
+        with mock.patch.object(self.provider, "agenerate", wraps=self.provider.agenerate) as call:
+            response, old = await self.regenerate()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("old answer", [m["content"] for m in call.call_args.args[0]])
+        replies = [m async for m in ChatMessage.objects.filter(conversation=self.conversation, role="model")]
+        self.assertEqual([m.content for m in replies], [response.json()["new_ai_response"]])
+        await self.conversation.arefresh_from_db()
+        self.assertEqual(self.conversation.total_messages, 2)
+
+    async def test_failed_turn_returns_status_and_saves_nothing(self):
+        with mock.patch.object(self.provider, "agenerate", side_effect=server_error()) as call:
+            response = await self.chat()
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(call.call_count, 3)
+        self.assertFalse(await ChatMessage.objects.filter(conversation=self.conversation).aexists())
+        conversation = await Conversation.objects.aget(id=self.conversation.id)
+        self.assertEqual(conversation.total_messages, 2)
+
+    async def test_rejected_request_is_not_retried(self):
+        rejected = genai_errors.ClientError(400, {"error": {"code": 400, "message": "bad", "status": "INVALID_ARGUMENT"}})
+        with mock.patch.object(self.provider, "agenerate", side_effect=rejected) as call:
+            response = await self.chat()
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(call.call_count, 1)
+
+    async def test_open_circuit_fails_fast(self):
+        with mock.patch.object(self.provider, "agenerate", side_effect=server_error()) as call:
+            await self.chat()
+            response = await self.chat()
+
+        # Three failures opened the breaker; the second turn never reached the model.
+        self.assertEqual(call.call_count, 3)
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response.headers)
+
+    def test_breaker_lets_a_trial_through_after_reset(self):
+        now = [0.0]
+        breaker = resilience.CircuitBreaker(failures=2, reset_timeout=10, clock=lambda: now[0])
+        breaker.record(ModelUnavailable())
+        breaker.record(ModelUnavailable())
+
+        with self.assertRaises(CircuitOpen):
+            breaker.before_call()
+        now[0] = 11
+        breaker.before_call()
+        with self.assertRaises(CircuitOpen):
+            # Only one trial at a time.
+            breaker.before_call()
+        breaker.record()
+        breaker.before_call()
+
+    @override_settings(MODEL_HEDGE_DELAY=0.01)
+    async def test_hedged_call_takes_the_first_answer(self):
+        calls = []
+
+        async def generate(messages, **kwargs):
+            calls.append(len(calls))
+            if len(calls) == 1:
+                await asyncio.sleep(5)
+                return "slow"
+            return "fast"
+
+        with mock.patch.object(self.provider, "agenerate", generate):
+            reply = await aask_gemini([{"role": "user", "content": "hi"}], hedge=True)
+
+        self.assertEqual(reply, "fast")
+        self.assertEqual(len(calls), 2)
+
+    def test_stream_retries_only_before_first_chunk(self):
+        attempts = []
+
+        def flaky(messages, **kwargs):
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise server_error()
+            yield "first "
+            raise server_error()
+
+        with mock.patch.object(self.provider, "stream", flaky):
+            received = []
+            with self.assertRaises(ModelUnavailable):
+                for chunk in ask_gemini_stream([{"role": "user", "content": "hi"}], use_cache=False):
+                    received.append(chunk)
+
+        self.assertEqual(received, ["first "])
+        self.assertEqual(len(attempts), 2)
+
+
+class RateLimitIdentityTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+
+    def test_ignores_forwarded_for_without_trusted_proxies(self):
+        request = self.factory.post("/api/chat/", REMOTE_ADDR="10.0.0.1", HTTP_X_FORWARDED_FOR="1.2.3.4")
+
+        with self.settings(TRUSTED_PROXY_COUNT=0):
+            self.assertEqual(ratelimit.client_ip(request), "10.0.0.1")
+
+    def test_takes_the_address_the_trusted_proxy_saw(self):
+        # The client sent "1.2.3.4"; the proxy appended the real address.
+        request = self.factory.post("/api/chat/", REMOTE_ADDR="10.0.0.1", HTTP_X_FORWARDED_FOR="1.2.3.4, 5.6.7.8")
+
+        with self.settings(TRUSTED_PROXY_COUNT=1):
+            self.assertEqual(ratelimit.client_ip(request), "5.6.7.8")
+
+    @override_settings(DAILY_TOKEN_QUOTA=50, RATE_LIMITS={}, TRUSTED_PROXY_COUNT=0)
+    def test_daily_token_quota_applies_to_guests_by_ip(self):
+        ratelimit.add_daily_tokens("ip:10.0.0.1", 60)
+
+        blocked = self.factory.post("/api/chat/", REMOTE_ADDR="10.0.0.1")
+        other = self.factory.post("/api/chat/", REMOTE_ADDR="10.0.0.2")
+
+        self.assertEqual(ratelimit.check_quotas("chat", AnonymousUser(), blocked, True).status_code, 429)
+        self.assertEqual(ratelimit.quota_identity(blocked), "ip:10.0.0.1")
+        self.assertIsNone(ratelimit.check_quotas("chat", AnonymousUser(), other, True))
+
+
+class StreamBufferTests(SimpleTestCase):
+    async def check_fan_out(self, buffer):
+        await buffer.open("1:1")
+        first = buffer.follow("1:1")
+        second = buffer.follow("1:1", offset=3)
+
+        async def produce():
+            for delta in ["abc", "def", "gh"]:
+                await buffer.append("1:1", delta)
+                await asyncio.sleep(0)
+            await buffer.close("1:1", [("done", {"message_id": 7})])
+
+        results = await asyncio.gather(produce(), collect(first), collect(second))
+
+        self.assertEqual(results[1], [
+            ("token", {"delta": "abc"}), ("token", {"delta": "def"}), ("token", {"delta": "gh"}),
+            ("done", {"message_id": 7}),
+        ])
+        self.assertEqual("".join(d["delta"] for name, d in results[2] if name == "token"), "defgh")
+
+        late = await collect(buffer.follow("1:1", offset=4))
+        self.assertEqual(late, [("token", {"delta": "ef"}), ("token", {"delta": "gh"}), ("done", {"message_id": 7})])
+
+    async def test_memory_buffer(self):
+        await self.check_fan_out(streams.MemoryStreamBuffer(ttl=60))
+
+    async def test_cache_buffer(self):
+        await self.check_fan_out(streams.CacheStreamBuffer(ttl=60, poll_interval=0.001))
+
+    async def test_unexpected_failure_sends_generic_error(self):
+        buffer = streams.MemoryStreamBuffer(ttl=60)
+        await buffer.open("1:1")
+
+        async def events():
+            yield "token", {"delta": "abc"}
+            raise RuntimeError("password=hunter2")
+
+        with self.assertLogs("chatbot.streams", "ERROR"):
+            await streams.produce(buffer, "1:1", events())
+
+        received = await collect(buffer.follow("1:1"))
+        self.assertEqual(received[-1], ("error", {"error": "The reply could not be completed. Please try again.", "status": 500}))
+
+    async def test_producer_releases_its_connection(self):
+        buffer = streams.MemoryStreamBuffer(ttl=60)
+        await buffer.open("1:1")
+
+        async def events():
+            yield "done", {"message_id": 7}
+
+        with mock.patch("chatbot.streams.close_old_connections") as release:
+            await streams.produce(buffer, "1:1", events())
+
+        release.assert_called_once_with()
+
+    async def test_unknown_stream(self):
+        buffer = streams.MemoryStreamBuffer(ttl=60)
+        self.assertFalse(await buffer.exists("missing"))
+        self.assertEqual(await collect(buffer.follow("missing")), [])
+
+
+async def collect(events):
+    return [event async for event in events]
+
+
+class SSETests(SimpleTestCase):
+    async def test_heartbeats_fill_idle_gaps(self):
+        async def slow():
+            await asyncio.sleep(0.05)
+            yield "frame"
+
+        frames = [frame async for frame in sse.with_heartbeats(slow(), interval=0.01)]
+
+        self.assertEqual(frames[-1], "frame")
+        self.assertIn(sse.HEARTBEAT, frames)
+
+    def test_parse_event_id(self):
+        self.assertEqual(sse.parse_event_id("12:40"), (12, 40))
+        with self.assertRaises(ValueError):
+            sse.parse_event_id("nope")
+
+
+@override_settings(LLM_BACKEND="fake")
+class FileUploadTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        caches["responses"].clear()
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        settings_override = override_settings(MEDIA_ROOT=media)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user(username="alice", password="secret")
+        self.token = Token.objects.create(user=self.user)
+        self.conversation = Conversation.objects.create(user=self.user, title="New Chat")
+
+    def upload(self, name, content, content_type="application/octet-stream", prompt="Summarize"):
+        return self.client.post(
+            "/api/chat/upload/",
+            {
+                "conversation_id": self.conversation.id,
+                "prompt": prompt,
+                "file": SimpleUploadedFile(name, content, content_type=content_type),
+            },
+            HTTP_AUTHORIZATION=f"Token {self.token.key}",
+        )
+
+    def test_pdf_is_sniffed_from_content(self):
+        pdf = b"%PDF-1.4 fake document"
+        with mock.patch.object(type(get_provider()), "aanalyze_file", autospec=True, return_value="ok") as analyze:
+            response = self.upload("report.bin", pdf)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(analyze.call_args.args[1:4], (pdf, "Summarize", "application/pdf"))
+        self.assertEqual(self.conversation.messages.count(), 2)
+
+    def test_unsupported_type_is_rejected(self):
+        response = self.upload("archive.pdf", b"\x00\x01\x02binary", content_type="application/pdf")
+
+        self.assertEqual(response.status_code, 415)
+        self.assertFalse(self.conversation.messages.exists())
+
+    @override_settings(UPLOAD_INLINE_MAX_BYTES=10)
+    def test_large_files_reuse_remote_handle(self):
+        pdf = b"%PDF-1.4 " + b"x" * 100
+        provider_class = type(get_provider())
+        with mock.patch.object(provider_class, "upload_file", autospec=True, side_effect=provider_class.upload_file) as upload:
+            first = self.upload("a.pdf", pdf)
+            second = self.upload("b.pdf", pdf, prompt="List the key points")
+
+        self.assertEqual(upload.call_count, 1)
+        digest = hashlib.sha256(pdf).hexdigest()
+        self.assertEqual(first.json()["analysis"], get_provider().reply_for("Summarize" + digest))
+        self.assertEqual(second.json()["analysis"], get_provider().reply_for("List the key points" + digest))
+
+    @override_settings(DOCUMENT_CHUNK_TOKENS=50)
+    async def test_long_document_streams_progress(self):
+        text = "\n".join(f"line {i} " + "word " * 15 for i in range(40)).encode()
+
+        response = await self.async_client.post(
+            "/api/chat/upload/",
+            {"conversation_id": self.conversation.id, "prompt": "Summarize", "file": SimpleUploadedFile("notes.txt", text)},
+            headers={"Authorization": f"Token {self.token.key}", "Accept": "text/event-stream"},
+        )
+
+        body = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        events = [line.removeprefix("event: ") for line in body.splitlines() if line.startswith("event: ")]
+        self.assertIn("progress", events)
+        self.assertEqual(events[-3:], ["token", "usage", "done"])
+        self.assertEqual(await self.conversation.messages.filter(role="model").acount(), 1)
+
+    def test_repeat_upload_is_stored_and_analysed_once(self):
+        pdf = b"%PDF-1.4 same content"
+        with mock.patch.object(type(get_provider()), "aanalyze_file", autospec=True, return_value="ok") as analyze:
+            self.upload("a.pdf", pdf)
+            response = self.upload("copy-of-a.pdf", pdf)
+
+        self.assertEqual(response.json()["analysis"], "ok")
+        self.assertEqual(analyze.call_count, 1)
+        blob = FileBlob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        files = [m.file.name for m in ChatMessage.objects.filter(role="user")]
+        self.assertEqual(files, [blob.file.name, blob.file.name])
+
+    def test_failed_upload_leaves_no_file(self):
+        pdf = b"%PDF-1.4 never saved"
+        with mock.patch.object(ChatMessage.objects, "create", side_effect=OperationalError("gone")):
+            self.upload("a.pdf", pdf)
+
+        self.assertFalse(FileBlob.objects.exists())
+        digest = hashlib.sha256(pdf).hexdigest()
+        self.assertFalse(default_storage.exists(f"chat_blobs/{digest[:2]}/{digest}"))
+
+    def test_blob_deleted_with_last_reference(self):
+        pdf = b"%PDF-1.4 shared"
+        other = Conversation.objects.create(user=self.user, title="Other")
+        self.upload("a.pdf", pdf)
+        self.conversation, first = other, self.conversation
+        self.upload("a.pdf", pdf)
+        blob = FileBlob.objects.get()
+        path = blob.file.path
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            other.delete()
+        self.assertFalse(FileBlob.objects.exists())
+        self.assertFalse(os.path.exists(path))
+
+
+@override_settings(LLM_BACKEND="fake", DOCUMENT_CHUNK_TOKENS=50, DOCUMENT_MAP_CONCURRENCY=2)
+class DocumentMapReduceTests(SimpleTestCase):
+    def setUp(self):
+        caches["responses"].clear()
+
+    def test_split_text_respects_budget(self):
+        text = "\n".join(f"paragraph {i} " + "word " * 20 for i in range(30))
+
+        chunks = documents.split_text(text, 50)
+
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(estimate_tokens(chunk) <= 50 for chunk in chunks))
+        self.assertEqual("\n".join(chunks), text)
+
+    def test_docx_text(self):
+        body = (
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+            "<w:p><w:r><w:t>Hello </w:t></w:r><w:r><w:t>world</w:t></w:r></w:p>"
+            "<w:p><w:r><w:t>Second</w:t></w:r></w:p>"
+            "</w:body></w:document>"
+        )
+        docx = io.BytesIO()
+        with zipfile.ZipFile(docx, "w") as archive:
+            archive.writestr("word/document.xml", body)
+
+        text = documents.extract_text(SimpleUploadedFile("a.docx", docx.getvalue()), uploads.DOCX)
+
+        self.assertEqual(text, "Hello world\nSecond")
+
+    async def test_map_calls_are_bounded(self):
+        running = 0
+        peak = 0
+
+        async def ask(messages, **kwargs):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            return "partial"
+
+        progress = []
+
+        async def record(step):
+            progress.append(step)
+
+        with mock.patch("chatbot.gemini.aask_gemini", ask):
+            answer = await amap_reduce_document(["a", "b", "c", "d", "e"], "Summarize", progress=record)
+
+        self.assertEqual(answer, "partial")
+        self.assertEqual(peak, 2)
+        self.assertEqual(progress[4], {"stage": "map", "done": 5, "total": 5})
+        self.assertEqual(progress[-1]["stage"], "reduce")
+
+
+class SniffMimeTypeTests(SimpleTestCase):
+    def sniff(self, content):
+        return uploads.sniff_mime_type(SimpleUploadedFile("upload", content))
+
+    def test_signatures(self):
+        self.assertEqual(self.sniff(b"\x89PNG\r\n\x1a\n...."), "image/png")
+        self.assertEqual(self.sniff(b"RIFF\x00\x00\x00\x00WEBPVP8 "), "image/webp")
+        self.assertEqual(self.sniff(b'  {"a": 1}'), "application/json")
+        self.assertEqual(self.sniff("héllo".encode()), "text/plain")
+
+    def test_docx_needs_word_document(self):
+        docx = io.BytesIO()
+        with zipfile.ZipFile(docx, "w") as archive:
+            archive.writestr("word/document.xml", "<w:document/>")
+        plain_zip = io.BytesIO()
+        with zipfile.ZipFile(plain_zip, "w") as archive:
+            archive.writestr("notes.txt", "hi")
+
+        self.assertEqual(self.sniff(docx.getvalue()), uploads.DOCX)
+        self.assertIsNone(self.sniff(plain_zip.getvalue()))
+
+
+@override_settings(LLM_BACKEND="fake")
+class ResponseCacheTests(SimpleTestCase):
+    def setUp(self):
+        caches["responses"].clear()
+
+    def test_identical_prompts_hit_cache(self):
+        with mock.patch.object(type(get_provider()), "generate", autospec=True, return_value="hi there") as generate:
+            ask_gemini([{"role": "user", "content": "hello"}])
+            ask_gemini([{"role": "user", "content": "  hello "}])
+
+        self.assertEqual(generate.call_count, 1)
+        self.assertEqual(response_cache.stats()["hits"], 1)
+        self.assertEqual(response_cache.stats()["misses"], 1)
+
+    def test_opt_out_and_temperature_bypass_cache(self):
+        with mock.patch.object(type(get_provider()), "generate", autospec=True, return_value="hi there") as generate:
+            ask_gemini([{"role": "user", "content": "hello"}])
+            ask_gemini([{"role": "user", "content": "hello"}], use_cache=False)
+            ask_gemini([{"role": "user", "content": "hello"}], temperature=0.2)
+
+        self.assertEqual(generate.call_count, 3)
+
+
+@override_settings(CONTEXT_TOKEN_BUDGET=30)
+class ContextBuilderTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.conversation = Conversation.objects.create(
+            user=User.objects.create_user(username="alice"), title="New Chat"
+        )
+        for i in range(10):
+            ChatMessage.objects.create(conversation=self.conversation, role="user", content=f"message number {i:02d} " * 2)
+
+    async def test_keeps_newest_messages_within_budget(self):
+        history = await abuild_history(self.conversation)
+
+        self.assertLess(len(history), 10)
+        self.assertTrue(history[-1]["content"].startswith("message number 09"))
+        self.assertEqual([m["content"] for m in history], sorted(m["content"] for m in history))
+
+    async def test_prepends_summary(self):
+        self.conversation.summary = "Earlier we talked about Django."
+
+        history = await abuild_history(self.conversation)
+
+        self.assertIn("Earlier we talked about Django.", history[0]["content"])
+        self.assertTrue(history[-1]["content"].startswith("message number 09"))
+
+    async def test_concurrent_appends_keep_every_message(self):
+        await abuild_history(self.conversation)
+        first = await ChatMessage.objects.acreate(conversation=self.conversation, role="model", content="first reply")
+        second = await ChatMessage.objects.acreate(conversation=self.conversation, role="model", content="second reply")
+        aget = cache.aget
+        interleaved = []
+
+        async def read_then_let_second_append(key, *args, **kwargs):
+            value = await aget(key, *args, **kwargs)
+            if key == context.window_key(self.conversation.id) and not interleaved:
+                # The second append runs between the first one's read and write.
+                interleaved.append(True)
+                await context.aappend_message(second)
+            return value
+
+        with mock.patch.object(cache, "aget", read_then_let_second_append):
+            await context.aappend_message(first)
+
+        contents = [m["content"] for m in await abuild_history(self.conversation)]
+        self.assertIn("first reply", contents)
+        self.assertIn("second reply", contents)
+
+
+@override_settings(LLM_BACKEND="fake", CONTEXT_TOKEN_BUDGET=40, MEMORY_TOP_K=2)
+class RetrievalMemoryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.conversation = Conversation.objects.create(
+            user=User.objects.create_user(username="alice"), title="New Chat"
+        )
+        topics = ["my cat is called Pixel", "the weather is rainy today"] + [
+            f"filler message number {i:02d}" for i in range(20)
+        ]
+        for topic in topics:
+            ChatMessage.objects.create(conversation=self.conversation, role="user", content=topic)
+        self.conversation.total_messages = len(topics)
+
+    async def test_recalls_relevant_old_message(self):
+        history = await abuild_history(
+            self.conversation, pending=[{"role": "user", "content": "what is my cat called"}]
+        )
+
+        self.assertIn("Relevant earlier messages", history[0]["content"])
+        self.assertIn("my cat is called Pixel", history[0]["content"])
+        self.assertEqual(history[-1]["content"], "what is my cat called")
+        self.assertLessEqual(sum(estimate_tokens(m["content"]) for m in history), 40)
+        self.assertEqual(await MessageEmbedding.objects.filter(conversation=self.conversation).acount(), 22)
+
+    async def test_embedding_failure_falls_back_to_window(self):
+        with mock.patch.object(get_provider(), "aembed", side_effect=RuntimeError("down")):
+            history = await abuild_history(
+                self.conversation, pending=[{"role": "user", "content": "what is my cat called"}]
+            )
+
+        self.assertNotIn("Relevant earlier messages", history[0]["content"])
+        self.assertEqual(history[-1]["content"], "what is my cat called")
+
+    async def test_short_conversation_skips_embedding(self):
+        self.conversation.total_messages = 1
+
+        with mock.patch.object(get_provider(), "aembed") as embed:
+            await abuild_history(self.conversation)
+
+        embed.assert_not_called()
+
+
+class VectorIndexTests(TestCase):
+    def test_search_is_incremental_and_excludes_window(self):
+        conversation = Conversation.objects.create(user=User.objects.create_user(username="alice"))
+        vectors = [[1, 0, 0], [0, 1, 0], [0.9, 0.1, 0]]
+        messages = [
+            ChatMessage.objects.create(conversation=conversation, role="user", content=str(i))
+            for i in range(len(vectors))
+        ]
+        memory.store_embeddings(conversation, messages[:2], vectors[:2])
+        index = memory.VectorIndex()
+        embeddings = MessageEmbedding.objects.filter(conversation=conversation)
+
+        self.assertEqual(index.search("c", embeddings, [1, 0, 0], k=1), [messages[0].id])
+
+        memory.store_embeddings(conversation, messages[2:], vectors[2:])
+        with self.assertNumQueries(1):
+            found = index.search("c", embeddings, [1, 0, 0], exclude=[messages[0].id], k=2)
+        self.assertEqual(found, [messages[2].id, messages[1].id])
+
+
+@override_settings(LLM_BACKEND="fake")
+class MemoryCompressionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.conversation = Conversation.objects.create(
+            user=User.objects.create_user(username="alice"), title="New Chat"
+        )
+        for i in range(31):
+            ChatMessage.objects.create(conversation=self.conversation, role="user", content=f"message {i}")
+
+    def test_writes_summary_instead_of_fake_message(self):
+        compress_conversation_memory(self.conversation.id)
+        compress_conversation_memory(self.conversation.id)
+
+        self.conversation.refresh_from_db()
+        self.assertTrue(self.conversation.summary)
+        self.assertEqual(self.conversation.summary, summaries.render(self.conversation.summary_levels))
+        self.assertFalse(self.conversation.messages.filter(content__startswith="[Memory Summary]").exists())
+
+    def test_summarizes_only_aged_out_messages(self):
+        self.conversation.summary = "Legacy summary."
+        self.conversation.save()
+        prompts = []
+        generate = get_provider().generate
+
+        def record(messages, **kwargs):
+            prompts.append(messages[0]["content"])
+            return generate(messages, **kwargs)
+
+        with mock.patch.object(get_provider(), "generate", side_effect=record):
+            compress_conversation_memory(self.conversation.id)
+
+        self.assertEqual(len(prompts), 1)
+        self.assertNotIn("Legacy summary.", prompts[0])
+        self.assertIn("message 19", prompts[0])
+        self.assertNotIn("message 20", prompts[0])
+        self.conversation.refresh_from_db()
+        self.assertTrue(self.conversation.summary.startswith("Legacy summary."))
+
+    def test_keeps_messages_and_marks_progress(self):
+        compress_conversation_memory(self.conversation.id)
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.messages.count(), 31)
+        folded = self.conversation.messages.order_by("id")[19]
+        self.assertEqual(self.conversation.summary_until, folded.id)
+
+        # 11 unsummarized messages are under the threshold.
+        compress_conversation_memory(self.conversation.id)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.summary_until, folded.id)
+
+
+@override_settings(SUMMARY_LEVEL_TOKENS=8, SUMMARY_MAX_LEVELS=3)
+class SummaryLevelsTests(SimpleTestCase):
+    def merge(self, segments):
+        self.merged.append(list(segments))
+        return f"({' + '.join(segments)})"
+
+    def setUp(self):
+        self.merged = []
+
+    def test_oversized_levels_move_up(self):
+        levels = []
+        for i in range(4):
+            levels = summaries.add_segment(levels, f"segment number {i}", self.merge)
+
+        # Any two segments exceed 8 tokens, so pairs are condensed upwards.
+        self.assertEqual(levels, [[], [], ["((segment number 0 + segment number 1) + (segment number 2 + segment number 3))"]])
+        self.assertTrue(summaries.render(levels).startswith("((segment number 0"))
+        self.assertTrue(all(len(call) == 2 for call in self.merged))
+
+    def test_top_level_is_merged_in_place(self):
+        levels = [[], [], ["old summary text here", "more summary text"]]
+
+        levels = summaries.add_segment(levels, "tiny", self.merge)
+
+        self.assertEqual(levels, [["tiny"], [], ["(old summary text here + more summary text)"]])
+
+    def test_failed_merge_keeps_level(self):
+        levels = summaries.add_segment([["first segment text"]], "second segment text", lambda segments: None)
+
+        self.assertEqual(levels, [["first segment text", "second segment text"]])
+
+
+class BackfillTotalMessagesTests(TestCase):
+    def test_counts_existing_messages(self):
+        user = User.objects.create_user(username="alice")
+        stale = Conversation.objects.create(user=user, title="My renamed chat")
+        ChatMessage.objects.create(conversation=stale, role="user", content="hi")
+        ChatMessage.objects.create(conversation=stale, role="model", content="hello")
+        empty = Conversation.objects.create(user=user, title="New Chat", total_messages=3)
+
+        backfill = importlib.import_module("chatbot.migrations.0013_backfill_total_messages")
+        backfill.backfill_total_messages(django_apps, None)
+
+        stale.refresh_from_db()
+        empty.refresh_from_db()
+        self.assertEqual(stale.total_messages, 2)
+        self.assertEqual(empty.total_messages, 0)
+
+
+@override_settings(GUEST_REAP_INTERVAL=0)
+class LegacyGuestTests(TestCase):
+    def test_shared_guest_is_reaped(self):
+        legacy = User.objects.create_user(username="ella_guest")
+        Conversation.objects.create(user=legacy, title="Anonymous chat")
+        regular = User.objects.create_user(username="alice")
+
+        migration = importlib.import_module("chatbot.migrations.0014_expire_legacy_guest")
+        migration.expire_legacy_guest(django_apps, None)
+
+        self.assertEqual(reap_guest_sessions(), 1)
+        self.assertFalse(User.objects.filter(id=legacy.id).exists())
+        self.assertFalse(Conversation.objects.filter(user_id=legacy.id).exists())
+        self.assertTrue(User.objects.filter(id=regular.id).exists())
+
+
+@override_settings(AUTH_CACHE_TTL=60)
+class ConversationListTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="alice")
+        self.token = Token.objects.create(user=self.user)
+        self.auth = {"HTTP_AUTHORIZATION": f"Token {self.token.key}"}
+        for i in range(25):
+            Conversation.objects.create(user=self.user, title=f"Topic {i}", total_messages=i)
+
+    def test_pages_with_cursor(self):
+        first = self.client.get("/api/conversations/", {"limit": 10}, **self.auth).json()
+        second = self.client.get("/api/conversations/", {"limit": 10, "cursor": first["next_cursor"]}, **self.auth).json()
+        third = self.client.get("/api/conversations/", {"limit": 10, "cursor": second["next_cursor"]}, **self.auth).json()
+
+        ids = [c["id"] for page in (first, second, third) for c in page["conversations"]]
+        self.assertEqual(len(ids), 25)
+        self.assertEqual(len(set(ids)), 25)
+        self.assertEqual(first["conversations"][0]["title"], "Topic 24")
+        self.assertEqual(first["conversations"][0]["total_messages"], 24)
+        self.assertEqual([page["count"] for page in (first, second, third)], [10, 10, 5])
+        self.assertNotIn("total", first)
+        self.assertIsNone(third["next_cursor"])
+
+    def test_query_count_is_constant(self):
+        # Token lookup + conversation page, regardless of how many rows exist.
+        with self.assertNumQueries(2):
+            self.client.get("/api/conversations/", {"search": "Topic"}, **self.auth)
+
+        for i in range(100):
+            Conversation.objects.create(user=self.user, title=f"More {i}")
+
+        # The token is cached now.
+        with self.assertNumQueries(1):
+            self.client.get("/api/conversations/", **self.auth)
+
+    def test_invalid_cursor(self):
+        response = self.client.get("/api/conversations/", {"cursor": "garbage"}, **self.auth)
+
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(DB_RETRY_ATTEMPTS=3, DB_RETRY_BASE_DELAY=0, GUEST_REAP_INTERVAL=0)
+class DBRetryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="alice")
+        self.token = Token.objects.create(user=self.user)
+        self.auth = {"HTTP_AUTHORIZATION": f"Token {self.token.key}"}
+
+    def flaky(self, failures):
+        calls = []
+
+        def operation():
+            calls.append(1)
+            if len(calls) <= failures:
+                raise OperationalError("server closed the connection unexpectedly")
+            return "ok"
+
+        return operation, calls
+
+    def test_decorator_retries_connection_errors(self):
+        operation, calls = self.flaky(failures=2)
+
+        with mock.patch.object(db, "in_transaction", return_value=False):
+            self.assertEqual(db.db_retry(operation)(), "ok")
+        self.assertEqual(len(calls), 3)
+
+    def test_decorator_gives_up_after_the_last_attempt(self):
+        operation, calls = self.flaky(failures=5)
+
+        with mock.patch.object(db, "in_transaction", return_value=False), self.assertRaises(OperationalError):
+            db.db_retry(operation)()
+        self.assertEqual(len(calls), 3)
+
+    def test_decorator_does_not_retry_inside_a_transaction(self):
+        operation, calls = self.flaky(failures=1)
+
+        # TestCase runs each test in a transaction already.
+        with self.assertRaises(OperationalError):
+            db.db_retry(operation)()
+        self.assertEqual(len(calls), 1)
+
+    async def test_async_decorator(self):
+        calls = []
+
+        async def operation():
+            calls.append(1)
+            if len(calls) == 1:
+                raise OperationalError("server closed the connection unexpectedly")
+            return "ok"
+
+        with mock.patch.object(db, "in_transaction", return_value=False):
+            self.assertEqual(await db.db_retry(operation)(), "ok")
+        self.assertEqual(len(calls), 2)
+
+    def test_middleware_reruns_reads(self):
+        Conversation.objects.create(user=self.user, title="Kept")
+        conversations = Conversation.objects.filter(user=self.user)
+        with mock.patch.object(
+            Conversation.objects, "filter",
+            side_effect=[OperationalError("server closed the connection unexpectedly"), conversations],
+        ) as patched:
+            response = self.client.get("/api/conversations/", **self.auth)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["conversations"][0]["title"], "Kept")
+        self.assertEqual(patched.call_count, 2)
+
+    def test_middleware_does_not_rerun_writes(self):
+        with mock.patch.object(
+            Conversation.objects, "create", side_effect=OperationalError("server closed the connection unexpectedly"),
+        ) as patched:
+            response = self.client.post("/api/conversations/create/", {"title": "Lost"}, **self.auth)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(patched.call_count, 1)
+
+
+@override_settings(LLM_BACKEND="fake", GUEST_REAP_INTERVAL=0, AUTH_CACHE_TTL=60, METRICS_TOKEN="", METRICS_REQUIRE_TOKEN=False)
+class MetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        caches["responses"].clear()
+        self.user = User.objects.create_user(username="alice")
+        self.token = Token.objects.create(user=self.user)
+        self.conversation = Conversation.objects.create(user=self.user, title="Chat", total_messages=2)
+        self.auth = {"HTTP_AUTHORIZATION": f"Token {self.token.key}"}
+        self.headers = {"Authorization": f"Token {self.token.key}"}
+
+    def test_records_request_time_and_db_queries(self):
+        endpoint = "api/conversations/"
+        requests = metrics.REQUEST_SECONDS.count(endpoint=endpoint, method="GET")
+        queries = metrics.DB_QUERIES.total(endpoint=endpoint)
+
+        # Token lookup + conversation page.
+        with self.assertNumQueries(2):
+            self.client.get("/api/conversations/", **self.auth)
+
+        self.assertEqual(metrics.REQUEST_SECONDS.count(endpoint=endpoint, method="GET"), requests + 1)
+        self.assertEqual(metrics.DB_QUERIES.total(endpoint=endpoint), queries + 2)
+
+    def test_counts_cache_lookups(self):
+        misses = metrics.CACHE_LOOKUPS.value(endpoint="api/conversations/", cache="auth_token", result="miss")
+        hits = metrics.CACHE_LOOKUPS.value(endpoint="api/conversations/", cache="auth_token", result="hit")
+
+        self.client.get("/api/conversations/", **self.auth)
+        self.client.get("/api/conversations/", **self.auth)
+
+        self.assertEqual(metrics.CACHE_LOOKUPS.value(endpoint="api/conversations/", cache="auth_token", result="miss"), misses + 1)
+        self.assertEqual(metrics.CACHE_LOOKUPS.value(endpoint="api/conversations/", cache="auth_token", result="hit"), hits + 1)
+
+    @override_settings(MEMORY_TOP_K=0)
+    async def test_records_model_latency_and_ttft(self):
+        calls = metrics.MODEL_SECONDS.count(endpoint="api/chat/stream/", operation="stream")
+        ttfts = metrics.MODEL_TTFT.count(endpoint="api/chat/stream/")
+        rates = metrics.MODEL_TOKENS_PER_SECOND.count(endpoint="api/chat/stream/", operation="stream")
+
+        response = await self.async_client.post(
+            "/api/chat/stream/", {"message": "hello", "conversation_id": self.conversation.id},
+            content_type="application/json", headers=self.headers,
+        )
+        b"".join([chunk async for chunk in response.streaming_content])
+
+        self.assertEqual(metrics.MODEL_SECONDS.count(endpoint="api/chat/stream/", operation="stream"), calls + 1)
+        self.assertEqual(metrics.MODEL_TTFT.count(endpoint="api/chat/stream/"), ttfts + 1)
+        self.assertEqual(metrics.MODEL_TOKENS_PER_SECOND.count(endpoint="api/chat/stream/", operation="stream"), rates + 1)
+
+    @override_settings(MEMORY_TOP_K=0, MODEL_RETRY_ATTEMPTS=1)
+    def test_counts_model_errors(self):
+        errors = metrics.MODEL_ERRORS.value(endpoint="api/chat/", operation="generate", status=503)
+
+        with mock.patch.object(get_provider(), "agenerate", side_effect=ModelUnavailable()):
+            response = self.client.post(
+                "/api/chat/", {"message": "hello", "conversation_id": self.conversation.id},
+                content_type="application/json", **self.auth,
+            )
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(metrics.MODEL_ERRORS.value(endpoint="api/chat/", operation="generate", status=503), errors + 1)
+
+    @override_settings(RATE_LIMITS={"chat": ["1/m"]}, MEMORY_TOP_K=0)
+    def test_counts_rate_limit_rejections(self):
+        rejected = metrics.RATE_LIMITED.value(endpoint="api/chat/", scope="chat")
+        payload = {"message": "hello", "conversation_id": self.conversation.id}
+
+        for _ in range(2):
+            self.client.post("/api/chat/", payload, content_type="application/json", **self.auth)
+
+        self.assertEqual(metrics.RATE_LIMITED.value(endpoint="api/chat/", scope="chat"), rejected + 1)
+
+    def test_metrics_endpoint(self):
+        self.client.get("/api/conversations/", **self.auth)
+
+        response = self.client.get("/metrics")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], metrics.CONTENT_TYPE)
+        body = response.content.decode()
+        self.assertIn("# TYPE chatbot_request_duration_seconds histogram", body)
+        self.assertIn('chatbot_request_duration_seconds_bucket{endpoint="api/conversations/",method="GET",le="+Inf"}', body)
+
+    @override_settings(METRICS_TOKEN="scrape")
+    def test_metrics_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer scrape").status_code, 200)
+
+    @override_settings(METRICS_REQUIRE_TOKEN=True)
+    def test_hosted_metrics_need_a_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 404)
+        with self.settings(METRICS_TOKEN="scrape"):
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer scrape").status_code, 200)
+
+    def test_counter_samples_match_their_family(self):
+        counter = metrics.Counter("test_events_total", "Test.", ("endpoint",))
+        counter.inc(endpoint="chat")
+
+        self.assertEqual(counter.render(), [
+            "# HELP test_events_total Test.",
+            "# TYPE test_events_total counter",
+            'test_events_total{endpoint="chat"} 1',
+        ])
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram("test_seconds", "Test.", ("endpoint",), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, endpoint='say "hi"')
+
+        self.assertEqual(histogram.render()[2:], [
+            'test_seconds_bucket{endpoint="say \\"hi\\"",le="0.1"} 2',
+            'test_seconds_bucket{endpoint="say \\"hi\\"",le="1"} 3',
+            'test_seconds_bucket{endpoint="say \\"hi\\"",le="+Inf"} 4',
+            'test_seconds_sum{endpoint="say \\"hi\\""} 3.65',
+            'test_seconds_count{endpoint="say \\"hi\\""} 4',
+        ])
+
+
+@override_settings(LLM_BACKEND="fake", GUEST_REAP_INTERVAL=0, AUTH_CACHE_TTL=60)
+class AuthCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="alice")
+        self.token = Token.objects.create(user=self.user)
+        self.auth = {"HTTP_AUTHORIZATION": f"Token {self.token.key}"}
+
+    def test_deleted_token_is_rejected_at_once(self):
+        self.assertEqual(self.client.get("/api/conversations/", **self.auth).status_code, 200)
+
+        self.token.delete()
+        Token.objects.create(user=self.user)
+
+        # Lenient views treat the caller as an anonymous guest.
+        response = self.client.get("/api/conversations/", **self.auth)
+        self.assertIsNone(response.json()["user"])
+
+    def test_deactivated_user_is_rejected_at_once(self):
+        self.client.get("/api/conversations/", **self.auth)
+
+        self.user.is_active = False
+        self.user.save()
+
+        response = self.client.get("/api/conversations/", **self.auth)
+        self.assertIsNone(response.json()["user"])
+
+    async def test_async_views_share_the_cache(self):
+        conversation = await Conversation.objects.acreate(user=self.user, title="New Chat")
+        headers = {"Authorization": f"Token {self.token.key}"}
+        payload = {"message": "hello", "conversation_id": conversation.id}
+        await self.async_client.post("/api/chat/", payload, content_type="application/json", headers=headers)
+
+        await self.token.adelete()
+        response = await self.async_client.post("/api/chat/", payload, content_type="application/json", headers=headers)
+
+        # The conversation is no longer the caller's.
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(AUTH_CACHE_TTL=0)
+    def test_tokens_are_not_cached_without_a_ttl(self):
+        self.client.get("/api/conversations/", **self.auth)
+
+        # Token lookup + conversation page, every time.
+        with self.assertNumQueries(2):
+            self.client.get("/api/conversations/", **self.auth)
+        self.assertIsNone(cache.get(authentication.token_cache_key(self.token.key)))
+
+
+
+@override_settings(LLM_BACKEND="fake", GUEST_REAP_INTERVAL=0, AUTH_CACHE_TTL=60)
+class GuestSessionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def create_conversation(self, **headers):
+        return self.client.post("/api/conversations/create/", {}, **headers)
+
+    def test_cors_preflight_allows_the_guest_token(self):
+        response = self.client.options(
+            "/api/conversations/",
+            HTTP_ORIGIN="https://app.example.com",
+            HTTP_ACCESS_CONTROL_REQUEST_METHOD="GET",
+            HTTP_ACCESS_CONTROL_REQUEST_HEADERS="x-guest-token",
+        )
+
+        self.assertIn("x-guest-token", response["Access-Control-Allow-Headers"])
+
+    def test_reads_do_not_create_guests(self):
+        listing = self.client.get("/api/conversations/")
+        messages = self.client.get("/api/conversations/1/messages/")
+
+        self.assertEqual(listing.json()["conversations"], [])
+        self.assertEqual(messages.status_code, 404)
+        self.assertNotIn(authentication.GUEST_HEADER, listing.headers)
+        self.assertFalse(GuestSession.objects.exists())
+
+    def test_each_client_gets_its_own_guest(self):
+        first = self.create_conversation()
+        second = self.create_conversation()
+
+        self.assertIn(authentication.GUEST_HEADER, first.headers)
+        self.assertNotEqual(first.headers[authentication.GUEST_HEADER], second.headers[authentication.GUEST_HEADER])
+        self.assertEqual(GuestSession.objects.count(), 2)
+
+    def test_guest_token_keeps_the_same_user(self):
+        token = self.create_conversation().headers[authentication.GUEST_HEADER]
+        headers = {"HTTP_X_GUEST_TOKEN": token}
+        self.create_conversation(**headers)
+
+        # The conversation page only: the guest user is cached.
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/conversations/", **headers)
+        self.assertEqual(response.json()["count"], 2)
+        self.assertNotIn(authentication.GUEST_HEADER, response.headers)
+
+    def test_forged_or_expired_token_gets_a_new_guest(self):
+        token = self.create_conversation().headers[authentication.GUEST_HEADER]
+
+        forged = self.create_conversation(HTTP_X_GUEST_TOKEN=token + "x")
+        with override_settings(GUEST_SESSION_TTL=-1):
+            expired = self.create_conversation(HTTP_X_GUEST_TOKEN=token)
+
+        self.assertIn(authentication.GUEST_HEADER, forged.headers)
+        self.assertIn(authentication.GUEST_HEADER, expired.headers)
+        self.assertEqual(User.objects.filter(guest_session__isnull=False).count(), 3)
+
+    async def test_async_chat_uses_guest_token(self):
+        created = await self.async_client.post("/api/conversations/create/", {})
+        headers = {authentication.GUEST_HEADER: created.headers[authentication.GUEST_HEADER]}
+        payload = {"message": "hello", "conversation_id": created.json()["conversation_id"]}
+
+        response = await self.async_client.post("/api/chat/", payload, content_type="application/json", headers=headers)
+        stranger = await self.async_client.post("/api/chat/", payload, content_type="application/json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(stranger.status_code, 404)
+        self.assertNotIn(authentication.GUEST_HEADER, stranger.headers)
+
+    def test_reaper_deletes_expired_guests_and_files(self):
+        fresh = authentication.create_guest_user()
+        expired = authentication.create_guest_user()
+        GuestSession.objects.filter(user=expired).update(expires_at=timezone.now() - timedelta(seconds=1))
+        conversation = Conversation.objects.create(user=expired, title="Old")
+        ChatMessage.objects.create(conversation=conversation, role="user", content="hi")
+        with tempfile.TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media):
+            name = default_storage.save("chat_files/old.txt", io.BytesIO(b"old upload"))
+            ChatMessage.objects.create(conversation=conversation, role="user", content="file", file=name)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(reap_guest_sessions(), 1)
+
+            self.assertFalse(default_storage.exists(name))
+        self.assertFalse(User.objects.filter(id=expired.id).exists())
+        self.assertFalse(Conversation.objects.filter(id=conversation.id).exists())
+        self.assertTrue(User.objects.filter(id=fresh.id).exists())
+
+
+@override_settings(AUTH_CACHE_TTL=60)
+class ConversationMessagesTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="alice")
+        self.token = Token.objects.create(user=self.user)
+        self.auth = {"HTTP_AUTHORIZATION": f"Token {self.token.key}"}
+        self.conversation = Conversation.objects.create(user=self.user, title="New Chat")
+        self.messages = [
+            ChatMessage.objects.create(conversation=self.conversation, role="user", content=f"message {i}")
+            for i in range(12)
+        ]
+        self.url = f"/api/conversations/{self.conversation.id}/messages/"
+
+    def test_full_transcript_by_default(self):
+        data = self.client.get(self.url, **self.auth).json()
+
+        self.assertEqual([m["id"] for m in data["messages"]], [m.id for m in self.messages])
+
+    def test_before_pages_towards_older_messages(self):
+        newest = self.client.get(self.url, {"limit": 5}, **self.auth).json()
+        older = self.client.get(self.url, {"limit": 5, "before": newest["cursors"]["before"]}, **self.auth).json()
+
+        self.assertEqual([m["content"] for m in newest["messages"]], [f"message {i}" for i in range(7, 12)])
+        self.assertEqual([m["content"] for m in older["messages"]], [f"message {i}" for i in range(2, 7)])
+        self.assertTrue(older["has_more"])
+
+    def test_since_returns_only_new_messages(self):
+        data = self.client.get(self.url, {"since": self.messages[9].id}, **self.auth).json()
+
+        self.assertEqual([m["content"] for m in data["messages"]], ["message 10", "message 11"])
+
+    def test_etag_returns_304_until_version_changes(self):
+        first = self.client.get(self.url, **self.auth)
+
+        # Just the version check: the token is cached.
+        with self.assertNumQueries(1):
+            cached = self.client.get(self.url, HTTP_IF_NONE_MATCH=first["ETag"], **self.auth)
+        self.assertEqual(cached.status_code, 304)
+
+        Conversation.bump_version(self.conversation.id)
+        changed = self.client.get(self.url, HTTP_IF_NONE_MATCH=first["ETag"], **self.auth)
+        self.assertEqual(changed.status_code, 200)
@@ -0,0 +1,111 @@
+"""
+Upload handling for FileUploadChatView.
+
+Django already receives multipart bodies in chunks and spills files larger
+than FILE_UPLOAD_MAX_MEMORY_SIZE to a temporary file; this module keeps it
+that way: the type is sniffed from the leading bytes, the digest is
+computed chunk by chunk, and only files up to UPLOAD_INLINE_MAX_BYTES are
+ever read into memory. Larger ones go to the model's Files API from disk.
+"""
+import codecs
+import hashlib
+import zipfile
+
+from django.conf import settings
+
+
+SNIFF_BYTES = 2048
+
+DOCX = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+SUPPORTED_TYPES = {
+    "application/pdf",
+    "image/jpeg",
+    "image/png",
+    "image/webp",
+    "text/plain",
+    "application/json",
+    DOCX,
+}
+
+# Leading bytes -> MIME type, checked in order.
+SIGNATURES = [
+    (b"%PDF-", "application/pdf"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "application/msword"),
+]
+
+
+def read_head(file, size=SNIFF_BYTES):
+    file.seek(0)
+    head = file.read(size)
+    file.seek(0)
+    return head
+
+
+def is_docx(file):
+    try:
+        with zipfile.ZipFile(file) as archive:
+            return "word/document.xml" in archive.namelist()
+    except zipfile.BadZipFile:
+        return False
+    finally:
+        file.seek(0)
+
+
+def sniff_text(head):
+    try:
+        # Incremental, so a character cut off at the end of the sample is fine.
+        text = codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+    except UnicodeDecodeError:
+        return None
+    if "\x00" in text:
+        return None
+    if text.lstrip()[:1] in ("{", "["):
+        return "application/json"
+    return "text/plain"
+
+
+def sniff_mime_type(file):
+    """MIME type of an uploaded file judged by its content, or None if unknown."""
+    head = read_head(file)
+    for signature, mime_type in SIGNATURES:
+        if head.startswith(signature):
+            return mime_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head.startswith(b"PK\x03\x04"):
+        return DOCX if is_docx(file) else None
+    if not head:
+        return None
+    return sniff_text(head)
+
+
+def file_digest(file):
+    """sha256 of an uploaded file, read chunk by chunk."""
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in file.chunks():
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def is_inline(file):
+    return file.size <= settings.UPLOAD_INLINE_MAX_BYTES
+
+
+def read_bytes(file):
+    file.seek(0)
+    data = file.read()
+    file.seek(0)
+    return data
+
+
+def upload_source(file):
+    """A path or binary stream the Files API client can read from."""
+    if hasattr(file, "temporary_file_path"):
+        return file.temporary_file_path()
+    file.seek(0)
+    return file.file
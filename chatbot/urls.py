@@ -3,6 +3,7 @@ from .views import (
     FileUploadChatView,
     chat,
     chat_stream,
+    resume_chat_stream,
     delete_conversation,
     login,
     regenerate_response,
@@ -26,6 +27,7 @@ urlpatterns = [
     path("conversations/<int:conversation_id>/rename/", rename_conversation),
     path("chat/regenerate/", regenerate_response),
     path("chat/stream/", chat_stream),
+    path("chat/stream/<int:conversation_id>/", resume_chat_stream),
     path("chat/upload/", FileUploadChatView.as_view(), name="chat-upload")
 
 ]
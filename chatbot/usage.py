@@ -0,0 +1,82 @@
+"""
+Token accounting: per-conversation and per-user rollups of provider Usage.
+
+All counters move with F() expressions so concurrent turns never overwrite
+each other's increments.
+"""
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .models import Conversation, UserTokenUsage
+from .providers import Usage
+from .ratelimit import add_daily_tokens
+
+
+def message_usage_fields(usage):
+    """Keyword arguments that store ``usage`` on a ChatMessage."""
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "candidate_tokens": usage.candidate_tokens,
+        "cached_tokens": usage.cached_tokens,
+    }
+
+
+def combine(usages):
+    """Sum several Usage objects into one."""
+    return Usage(
+        prompt_tokens=sum(u.prompt_tokens for u in usages),
+        candidate_tokens=sum(u.candidate_tokens for u in usages),
+        cached_tokens=sum(u.cached_tokens for u in usages),
+    )
+
+
+def record_user_usage(user_id, usage, identity=None):
+    """
+    Add ``usage`` to the user's lifetime and daily totals.
+
+    ``identity`` (ratelimit.quota_identity) picks the daily quota charged;
+    guests are charged by IP, so that a new guest does not get a new quota.
+    """
+    if not usage.total_tokens:
+        return
+
+    # Feeds the DAILY_TOKEN_QUOTA check in ratelimit.rate_limit.
+    add_daily_tokens(identity or f"user:{user_id}", usage.total_tokens)
+
+    increments = {
+        "prompt_tokens": F("prompt_tokens") + usage.prompt_tokens,
+        "candidate_tokens": F("candidate_tokens") + usage.candidate_tokens,
+        "cached_tokens": F("cached_tokens") + usage.cached_tokens,
+        "total_tokens": F("total_tokens") + usage.total_tokens,
+    }
+    if UserTokenUsage.objects.filter(user_id=user_id).update(**increments):
+        return
+
+    try:
+        with transaction.atomic():
+            UserTokenUsage.objects.create(
+                user_id=user_id,
+                prompt_tokens=usage.prompt_tokens,
+                candidate_tokens=usage.candidate_tokens,
+                cached_tokens=usage.cached_tokens,
+                total_tokens=usage.total_tokens,
+            )
+    except IntegrityError:
+        # A concurrent turn created the row first.
+        UserTokenUsage.objects.filter(user_id=user_id).update(**increments)
+
+
+def record_usage(conversation_id, user_id, *usages, identity=None):
+    """Add the given Usage objects to the conversation and user totals."""
+    usage = combine(usages)
+    if not usage.total_tokens:
+        return
+
+    Conversation.objects.filter(id=conversation_id).update(
+        total_tokens=F("total_tokens") + usage.total_tokens
+    )
+    record_user_usage(user_id, usage, identity)
+
+
+arecord_usage = sync_to_async(record_usage)
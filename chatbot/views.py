@@ -1,29 +1,44 @@
-from django.core.cache import cache
 from pyexpat.errors import messages
-from django.db.utils import OperationalError, ProgrammingError, DatabaseError
-from django.db import close_old_connections, connections
+from django.db.utils import OperationalError, ProgrammingError, DatabaseError, InterfaceError
+from django.db import transaction
+from django.db.models import F
 from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.authentication import TokenAuthentication
-from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.authtoken.models import Token
+from django.conf import settings
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
+from asgiref.sync import sync_to_async
 from datetime import datetime
-
+from contextlib import aclosing
+from functools import wraps
+import asyncio
+import string
+
+from .authentication import LenientTokenAuthentication, aget_chat_user, get_chat_user
+from .blobs import attach_upload
+from .context import aappend_message, abuild_history, ainvalidate_window
+from .db import db_retry
+from .exceptions import ModelError, database_error_response, model_error_payload, model_error_response
 from .models import Conversation, ChatMessage
-from .gemini import ask_gemini, generate_conversation_title
-from django.http import StreamingHttpResponse
-from .gemini import ask_gemini_stream
-from rest_framework.views import APIView
+from . import pagination, sse, streams, uploads
+from .providers import Usage
+from .ratelimit import quota_identity, rate_limit
+from .tasks import MEMORY_COMPRESSION_THRESHOLD, compress_conversation_memory, submit
+from .usage import arecord_usage, combine, message_usage_fields, record_user_usage
+from .gemini import aask_gemini, aask_gemini_stream, aask_gemini_upload, agenerate_conversation_title
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.http import parse_etags, quote_etag
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from rest_framework import serializers
 
 
 from rest_framework.decorators import api_view, permission_classes, authentication_classes
 from rest_framework.permissions import AllowAny
-from django.http import StreamingHttpResponse
-from .gemini import ask_gemini_stream
+import hashlib
 import json
 
 
@@ -35,28 +50,6 @@ def serialize_user(user):
     }
 
 
-class LenientTokenAuthentication(TokenAuthentication):
-    def authenticate(self, request):
-        try:
-            return super().authenticate(request)
-        except AuthenticationFailed:
-            return None
-
-
-def get_chat_user(request):
-    if request.user and request.user.is_authenticated:
-        return request.user
-
-    guest_user, created = User.objects.get_or_create(
-        username="ella_guest",
-        defaults={"email": "guest@ella.local"},
-    )
-    if created:
-        guest_user.set_unusable_password()
-        guest_user.save(update_fields=["password"])
-    return guest_user
-
-
 def clean_conversation_title(raw_title, fallback):
     title = (raw_title or '').replace('"', '').replace("'", '').replace('*', '').replace('\n', ' ').strip()
     title = title.replace('Here are a few options:', '').replace('Title:', '').strip(' -:')
@@ -68,21 +61,86 @@ def clean_conversation_title(raw_title, fallback):
     return title[:60]
 
 
-def run_with_db_retry(operation, retries=1):
-    """Retry once after resetting stale DB connections."""
-    last_error = None
-    for _ in range(retries + 1):
+def heuristic_title(message):
+    """Cheap local title from the first words of the message."""
+    words = [w.strip(string.punctuation) for w in (message or "").split()]
+    title = " ".join(w for w in words if w)[:60]
+    if len(title) < 3:
+        return "New Chat"
+    return title[0].upper() + title[1:]
+
+
+def start_title_generation(message, usage):
+    """
+    Ask the model for a title in the background, bounded by
+    TITLE_GENERATION_TIMEOUT, so it runs alongside the reply.
+    """
+    return asyncio.ensure_future(asyncio.wait_for(
+        agenerate_conversation_title(message, usage=usage),
+        timeout=settings.TITLE_GENERATION_TIMEOUT,
+    ))
+
+
+def discard_title(title_task):
+    """Cancel a title nobody will await; a title that already failed has its error retrieved."""
+    if title_task is None:
+        return
+    if not title_task.done():
+        title_task.cancel()
+    elif not title_task.cancelled():
+        title_task.exception()
+
+
+async def await_title(title_task, message):
+    """The generated title, or heuristic_title() if the model timed out or failed."""
+    fallback = heuristic_title(message)
+    try:
+        raw_title = await title_task
+    except (asyncio.TimeoutError, ModelError):
+        return fallback
+    return clean_conversation_title(raw_title, fallback)
+
+
+# ----------------------------------------
+# ASYNC VIEW HELPERS
+# ----------------------------------------
+# The model-bound endpoints (chat, regenerate, stream, upload) are native
+# async views served through backend/asgi.py, so a Gemini round-trip no longer
+# pins a worker. DRF's APIView is sync-only, so these helpers cover the small
+# part of it those views relied on: request.data and DB errors (token auth
+# lives in authentication.py), plus failed model calls.
+def parse_request_data(request):
+    """Return the JSON or form body of the request, or None if it is malformed."""
+    if request.content_type == "application/json":
         try:
-            return operation()
-        except OperationalError as exc:
-            last_error = exc
-            close_old_connections()
+            return json.loads(request.body or b"{}")
+        except ValueError:
+            return None
+    return request.POST
+
+
+def async_api_view(methods):
+    """Decorator for async views: method check, request.data and DB errors as JSON."""
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return JsonResponse({"detail": f'Method "{request.method}" not allowed.'}, status=405)
+
+            request.data = parse_request_data(request)
+            if request.data is None:
+                return JsonResponse({"detail": "JSON parse error"}, status=400)
+
             try:
-                connections["default"].connect()
-            except Exception:
-                # Reconnection may still fail if DB is genuinely unavailable.
-                pass
-    raise last_error
+                return await view(request, *args, **kwargs)
+            except (DatabaseError, InterfaceError) as exc:
+                return database_error_response(exc)
+            except ModelError as exc:
+                # Raised before anything was saved for the turn.
+                return model_error_response(exc)
+
+        return csrf_exempt(wrapper)
+    return decorator
 
 # ----------------------------------------
 # INFO
@@ -104,6 +162,8 @@ def chat_info(request):
 @permission_classes([AllowAny])
 def register(request):
     try:
+        # Safe to retry: the user and its token are created together or not at all.
+        @db_retry
         def perform_register():
             username = (request.data.get("username") or request.data.get("email") or "").strip()
             email = (request.data.get("email") or username).strip()
@@ -118,11 +178,12 @@ def register(request):
             if email and User.objects.filter(email=email).exists():
                 return Response({"error": "Email already exists"}, status=400)
 
-            user = User.objects.create_user(username=username, email=email, password=password)
-            token, _ = Token.objects.get_or_create(user=user)
+            with transaction.atomic():
+                user = User.objects.create_user(username=username, email=email, password=password)
+                token, _ = Token.objects.get_or_create(user=user)
             return Response({"message": "User created", "token": token.key, "user": serialize_user(user)}, status=201)
 
-        return run_with_db_retry(perform_register)
+        return perform_register()
     except ProgrammingError:
         return Response(
             {"error": "Database schema is not ready. Run migrations and retry."},
@@ -143,6 +204,7 @@ def register(request):
 @permission_classes([AllowAny])
 def login(request):
     try:
+        @db_retry
         def perform_login():
             identifier = (request.data.get("username") or request.data.get("email") or "").strip()
             password = request.data.get("password")
@@ -168,7 +230,7 @@ def login(request):
             token, _ = Token.objects.get_or_create(user=user)
             return Response({"token": token.key, "user": serialize_user(user)})
 
-        return run_with_db_retry(perform_login)
+        return perform_login()
     except ProgrammingError:
         return Response(
             {"error": "Database schema is not ready. Run migrations and retry."},
@@ -192,7 +254,7 @@ def create_conversation(request):
         title = request.data.get("title", "New Chat")
 
         conversation = Conversation.objects.create(
-            user=get_chat_user(request),
+            user=get_chat_user(request, create=True),
             title=title
         )
 
@@ -220,111 +282,138 @@ def create_conversation(request):
 @authentication_classes([LenientTokenAuthentication])
 @permission_classes([AllowAny])
 def list_conversations(request):
-    conversations = Conversation.objects.filter(user=get_chat_user(request))
-
-    data = [
-        {
-            "id": c.id,
-            "title": c.title,
-            "created_at": c.created_at,
-            "total_messages": c.messages.count(),
-        }
-        for c in conversations
-    ]
+    """
+    Newest-first conversations, one keyset page at a time.
+
+    ?search= filters titles, ?limit= sets the page size (max 100) and
+    ?cursor= takes the previous page's next_cursor. A page is one query on
+    the (user, created_at, id) index, using the denormalized total_messages.
+    """
+    chat_user = get_chat_user(request)
+    search_query = request.GET.get("search")
+    cursor = request.GET.get("cursor")
+    limit = pagination.page_limit(request.GET.get("limit"))
+
+    # An anonymous caller without a guest token has no conversations yet.
+    if chat_user is None:
+        return Response({"user": None, "count": 0, "conversations": [], "next_cursor": None})
+
+    conversations = Conversation.objects.filter(user=chat_user)
+
+    if search_query:
+        conversations = conversations.filter(title__icontains=search_query)
+
+    if cursor:
+        try:
+            conversations = conversations.filter(pagination.before("created_at", cursor))
+        except ValueError:
+            return Response({"error": "Invalid cursor"}, status=400)
+
+    rows = list(
+        conversations.order_by("-created_at", "-id")
+        .values("id", "title", "created_at", "total_messages")[:limit + 1]
+    )
+    data = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = pagination.encode_cursor(data[-1]["created_at"], data[-1]["id"])
 
     return Response({
-        "user": get_chat_user(request).username,
-        "conversations": data
+        "user": chat_user.username,
+        "count": len(data),
+        "conversations": data,
+        "next_cursor": next_cursor,
     })
 
 
 # ----------------------------------------
 # CHAT (SEND MESSAGE)
 # ----------------------------------------
-@api_view(['POST'])
-@authentication_classes([LenientTokenAuthentication])
-@permission_classes([AllowAny])
-def chat(request):
+def persist_turn(conversation, chat_user, message, ai_response, usage, title_usage, title=None, identity=None):
+    """
+    Save one chat turn as a single atomic unit.
+
+    Both messages go in with one bulk insert and the conversation counters,
+    version and (first turn) title move in one F() update, so a turn costs
+    one commit instead of several.
+    """
+    with transaction.atomic():
+        user_message, model_message = ChatMessage.objects.bulk_create([
+            ChatMessage(conversation=conversation, role="user", content=message),
+            ChatMessage(conversation=conversation, role="model", content=ai_response, **message_usage_fields(usage)),
+        ])
+
+        turn_usage = combine([usage, title_usage])
+        updates = {
+            "total_messages": F("total_messages") + 2,
+            "total_tokens": F("total_tokens") + turn_usage.total_tokens,
+            "version": F("version") + 1,
+        }
+        if title:
+            updates["title"] = title
+        Conversation.objects.filter(id=conversation.id).update(**updates)
+        record_user_usage(chat_user.id, turn_usage, identity)
+
+    return user_message, model_message
+
+
+apersist_turn = sync_to_async(persist_turn)
+
+
+@async_api_view(['POST'])
+@rate_limit("chat", tokens=True)
+async def chat(request):
     # 1. Get initial data
     message = request.data.get("message")
     conversation_id = request.data.get("conversation_id")
-    file = request.FILES.get("file") # Handling files if needed
 
     # 2. Basic Validation
     if not message:
-        return Response({"error": "Message is required"}, status=400)
+        return JsonResponse({"error": "Message is required"}, status=400)
     if not conversation_id:
-        return Response({"error": "conversation_id is required"}, status=400)
+        return JsonResponse({"error": "conversation_id is required"}, status=400)
 
     # 3. Retrieve Conversation (and verify owner)
+    chat_user = await aget_chat_user(request)
     try:
-        conversation = Conversation.objects.get(id=conversation_id, user=get_chat_user(request))
+        conversation = await Conversation.objects.aget(id=conversation_id, user=chat_user)
     except Conversation.DoesNotExist:
-        return Response({"error": "Conversation not found"}, status=404)
+        return JsonResponse({"error": "Conversation not found"}, status=404)
 
-    # 4. Save User Message
-    ChatMessage.objects.create(
-        conversation=conversation,
-        role="user",
-        content=message
-    )
-    
+    # 4. New conversations: title the first message while the reply runs
+    title_usage = Usage()
+    title_task = None
+    if conversation.total_messages == 0:
+        title_task = start_title_generation(message, title_usage)
 
     # 5. Get AI Response (using your gemini.py function)
-    # We fetch history to provide context to the AI
-    history = list(conversation.messages.values('role', 'content'))
-    ai_response = ask_gemini(history) 
-
-    # 6. Update Token Count & Stats
-    # Note: len(split) is an estimate. Gemini API usage_metadata is more accurate.
-    conversation.total_tokens += len(ai_response.split())
-    
-    # 7. Generate Title for new conversations
-    if conversation.messages.filter(role="user").count() == 1:
-        short_title = generate_conversation_title(message, ai_response)
-        fallback_title = " ".join(message.split()[:6]) or "New Chat"
-        conversation.title = clean_conversation_title(short_title, fallback_title)
-    
-    conversation.save()
-
-    # 8. Save AI Message
-    ChatMessage.objects.create(
-        conversation=conversation,
-        role="model",
-        content=ai_response
+    # The newest messages that fit the token budget, plus the summary and
+    # this turn's user message (saved together with the reply below)
+    usage = Usage()
+    try:
+        history = await abuild_history(conversation, pending=[{"role": "user", "content": message}])
+        ai_response = await aask_gemini(history, usage=usage)
+    except BaseException:
+        # Failed, or the client went away (CancelledError): drop the title call too.
+        discard_title(title_task)
+        raise
+
+    title = None
+    if title_task is not None:
+        title = conversation.title = await await_title(title_task, message)
+
+    # 6. Save both messages, counters and token usage in one transaction
+    user_message, model_message = await apersist_turn(
+        conversation, chat_user, message, ai_response, usage, title_usage, title, quota_identity(request)
     )
-    user_key = f"rate_limit_{get_chat_user(request).id}"
-    request_count = cache.get(user_key, 0)
-
-    if request_count > 50:
-         return Response({"error": "Daily limit reached"}, status=429)
-
-    cache.set(user_key, request_count + 1, timeout=86400)
-
-    # 🧠 9. Auto-Summarize (Memory Compression)
-    if conversation.messages.count() > 30:
-        # Get the oldest 20 messages
-        old_messages = conversation.messages.order_by("timestamp")[:20]
-        
-        summary_text = "\n".join([f"{m.role}: {m.content}" for m in old_messages])
-        summary_prompt = [{"role": "user", "content": f"Summarize this chat history for memory:\n\n{summary_text}"}]
-        
-        summary = ask_gemini(summary_prompt)
-
-        # Create a special system/model message for the summary
-        ChatMessage.objects.create(
-            conversation=conversation,
-            role="model",
-            content=f"[Memory Summary]: {summary}"
-        )
-
-        # Delete old messages to free up DB space and context window
-        ChatMessage.objects.filter(id__in=[m.id for m in old_messages]).delete()
+    await aappend_message(user_message, model_message)
+    conversation.total_messages += 2
 
-    conversation.total_messages = conversation.messages.count()
-    conversation.save(update_fields=["title", "total_tokens", "total_messages"])
+    # 🧠 7. Auto-Summarize (Memory Compression) off the request path
+    if conversation.total_messages > MEMORY_COMPRESSION_THRESHOLD:
+        submit(compress_conversation_memory, conversation.id)
 
-    return Response({
+    return JsonResponse({
         "conversation_id": conversation.id,
         "message": ai_response,
         "ai_response": ai_response,
@@ -341,7 +430,14 @@ def chat(request):
 @authentication_classes([LenientTokenAuthentication])
 @permission_classes([AllowAny])
 def get_conversation_messages(request, conversation_id):
+    """
+    Messages of a conversation, oldest first.
 
+    Without parameters the whole transcript is returned. ?before=<cursor>
+    pages towards older messages, ?after=<cursor> and ?since=<message id>
+    return only newer ones; ?limit= caps a page. The ETag follows the
+    conversation's version, so an unchanged poll costs one query and a 304.
+    """
     try:
         conversation = Conversation.objects.get(
             id=conversation_id,
@@ -350,26 +446,56 @@ def get_conversation_messages(request, conversation_id):
     except Conversation.DoesNotExist:
         return Response({"error": "Conversation not found"}, status=404)
 
-    messages = ChatMessage.objects.filter(
-        conversation=conversation
-    ).order_by("timestamp")
+    query = request.GET.urlencode()
+    etag = quote_etag(f"{conversation.id}.{conversation.version}.{hashlib.md5(query.encode()).hexdigest()[:8]}")
+    if etag in parse_etags(request.headers.get("If-None-Match", "")):
+        return Response(status=304, headers={"ETag": etag})
 
-    data = [
-        {
-            "id": m.id,
-            "role": m.role,
-            "content": m.content,
-            "timestamp": m.timestamp
-        }
-        for m in messages
-    ]
+    before = request.GET.get("before")
+    after = request.GET.get("after")
+    since = request.GET.get("since")
+    paginated = any([before, after, since, request.GET.get("limit")])
+    limit = pagination.page_limit(request.GET.get("limit"), default=50, maximum=200)
+
+    messages = ChatMessage.objects.filter(conversation=conversation)
+    try:
+        if before:
+            messages = messages.filter(pagination.before("timestamp", before))
+        if after:
+            messages = messages.filter(pagination.after("timestamp", after))
+        if since:
+            messages = messages.filter(id__gt=int(since))
+    except ValueError:
+        return Response({"error": "Invalid cursor"}, status=400)
+
+    fields = ("id", "role", "content", "timestamp")
+    has_more = False
+    if not paginated:
+        data = list(messages.order_by("timestamp", "id").values(*fields))
+    elif before or not (after or since):
+        # Newest page below the cursor, returned in chronological order.
+        data = list(messages.order_by("-timestamp", "-id").values(*fields)[:limit + 1])
+        has_more = len(data) > limit
+        data = data[:limit][::-1]
+    else:
+        data = list(messages.order_by("timestamp", "id").values(*fields)[:limit + 1])
+        has_more = len(data) > limit
+        data = data[:limit]
+
+    cursors = {"before": None, "after": None}
+    if data:
+        cursors["before"] = pagination.encode_cursor(data[0]["timestamp"], data[0]["id"])
+        cursors["after"] = pagination.encode_cursor(data[-1]["timestamp"], data[-1]["id"])
 
     return Response({
         "conversation_id": conversation.id,
         "title": conversation.title,
+        "version": conversation.version,
         "total_messages": len(data),
-        "messages": data
-    })
+        "messages": data,
+        "has_more": has_more,
+        "cursors": cursors,
+    }, headers={"ETag": etag})
 @api_view(['DELETE'])
 @authentication_classes([LenientTokenAuthentication])
 @permission_classes([AllowAny])
@@ -403,7 +529,8 @@ def rename_conversation(request, conversation_id):
         return Response({"error": "Conversation not found"}, status=404)
 
     conversation.title = new_title[:60]
-    conversation.save()
+    conversation.save(update_fields=["title"])
+    Conversation.bump_version(conversation.id)
 
     return Response({
         "message": "Title updated",
@@ -412,82 +539,62 @@ def rename_conversation(request, conversation_id):
     })
 
 
-@api_view(['GET'])
-@authentication_classes([LenientTokenAuthentication])
-@permission_classes([AllowAny])
-def list_conversations(request):
-    search_query = request.GET.get("search")
-
-    conversations = Conversation.objects.filter(user=get_chat_user(request))
-
-    if search_query:
-        conversations = conversations.filter(title__icontains=search_query)
+def replace_reply(conversation, old_message, ai_response, usage):
+    """Swap ``old_message`` (if any) for the new reply in one transaction."""
+    with transaction.atomic():
+        if old_message is not None:
+            old_message.delete()
+        model_message = ChatMessage.objects.create(
+            conversation=conversation,
+            role="model",
+            content=ai_response,
+            **message_usage_fields(usage)
+        )
+        Conversation.bump_version(conversation.id, added_messages=0 if old_message else 1)
+    return model_message
 
-    conversations = conversations.order_by("-created_at")
 
-    data = [
-        {
-            "id": c.id,
-            "title": c.title,
-            "created_at": c.created_at
-        }
-        for c in conversations
-    ]
+areplace_reply = sync_to_async(replace_reply)
 
-    return Response({
-        "user": get_chat_user(request).username,
-        "total": len(data),
-        "conversations": data
-    })
 
-@api_view(['POST'])
-@authentication_classes([LenientTokenAuthentication])
-@permission_classes([AllowAny])
-def regenerate_response(request):
+@async_api_view(['POST'])
+@rate_limit("regenerate", tokens=True)
+async def regenerate_response(request):
     conversation_id = request.data.get("conversation_id")
 
     if not conversation_id:
-        return Response({"error": "conversation_id is required"}, status=400)
+        return JsonResponse({"error": "conversation_id is required"}, status=400)
 
+    chat_user = await aget_chat_user(request)
     try:
-        conversation = Conversation.objects.get(
+        conversation = await Conversation.objects.aget(
             id=conversation_id,
-            user=get_chat_user(request)
+            user=chat_user
         )
     except Conversation.DoesNotExist:
-        return Response({"error": "Conversation not found"}, status=404)
+        return JsonResponse({"error": "Conversation not found"}, status=404)
 
-    # Delete last AI message
-    last_ai_message = ChatMessage.objects.filter(
+    # The last AI message is replaced, so the model must not see it
+    last_ai_message = await ChatMessage.objects.filter(
         conversation=conversation,
         role="model"
-    ).order_by("-timestamp").first()
+    ).order_by("-timestamp").afirst()
+    exclude = [last_ai_message.id] if last_ai_message else []
+    history = await abuild_history(conversation, exclude=exclude)
 
-    if last_ai_message:
-        last_ai_message.delete()
+    # A regenerate must produce a fresh answer, never the cached one. If
+    # the call fails (ModelError) the old answer stays.
+    usage = Usage()
+    ai_response = await aask_gemini(history, use_cache=False, usage=usage)
 
-    # Get history again
-    messages = ChatMessage.objects.filter(
-        conversation=conversation
-    ).order_by("timestamp")[:20]
-
-    history = [
-        {"role": m.role, "content": m.content}
-        for m in messages
-    ]
-
-    ai_response = ask_gemini(history)
-
-    if ai_response.startswith("Error"):
-        return Response({"error": ai_response}, status=502)
-
-    ChatMessage.objects.create(
-        conversation=conversation,
-        role="model",
-        content=ai_response
-    )
+    model_message = await areplace_reply(conversation, last_ai_message, ai_response, usage)
+    if last_ai_message:
+        await ainvalidate_window(conversation.id)
+    else:
+        await aappend_message(model_message)
+    await arecord_usage(conversation.id, chat_user.id, usage, identity=quota_identity(request))
 
-    return Response({
+    return JsonResponse({
         "conversation_id": conversation.id,
         "new_ai_response": ai_response
     })
@@ -495,171 +602,279 @@ def regenerate_response(request):
 # ----------------------------------------
 # STREAMING CHAT (POST /api/chat/stream)
 # ----------------------------------------
-from django.http import StreamingHttpResponse
-from rest_framework.decorators import api_view, authentication_classes, permission_classes
-from rest_framework.permissions import IsAuthenticated, AllowAny
-from rest_framework.authentication import TokenAuthentication
-from .gemini import ask_gemini_stream
-import json
+async def stream_turn(conversation, chat_user, message, history, first_turn, identity=None):
+    """
+    Generate one streamed turn as (event, data) pairs and save the reply.
+
+    Tokens come first, then usage, title (first turn only) and done, or a
+    single error event if the model call fails. Replies longer than
+    STREAM_MAX_REPLY_CHARS are cut off there and saved truncated.
+    """
+    title_usage = Usage()
+    title_task = start_title_generation(message, title_usage) if first_turn else None
+
+    # A local str: CPython extends it in place, so += copies nothing.
+    reply = ""
+    truncated = False
+    limit = settings.STREAM_MAX_REPLY_CHARS
+    usage = Usage()
+    try:
+        async with aclosing(aask_gemini_stream(history, usage=usage)) as chunks:
+            async for chunk in chunks:
+                if limit and len(reply) + len(chunk) > limit:
+                    chunk = chunk[:limit - len(reply)]
+                    truncated = True
+                reply += chunk
+                if chunk:
+                    yield "token", {"delta": chunk}
+                if truncated:
+                    # Closing the generator cancels the model call.
+                    break
+    except ModelError as e:
+        discard_title(title_task)
+        yield "error", model_error_payload(e)[0]
+        return
+    except BaseException:
+        discard_title(title_task)
+        raise
+
+    # Clients pick the title up from this event or the conversation listing
+    title = None
+    if title_task is not None:
+        title = await await_title(title_task, message)
+        await Conversation.objects.filter(id=conversation.id).aupdate(title=title)
+
+    # Save AI response after streaming finishes
+    model_message = await ChatMessage.objects.acreate(
+        conversation=conversation,
+        role="model",
+        content=reply,
+        **message_usage_fields(usage)
+    )
+    await aappend_message(model_message)
+    await arecord_usage(conversation.id, chat_user.id, usage, title_usage, identity=identity)
+    await Conversation.abump_version(conversation.id, added_messages=1)
+
+    yield "usage", message_usage_fields(usage)
+    if title:
+        yield "title", {"title": title}
+    yield "done", {"message_id": model_message.id, "truncated": truncated}
+
 
 # Authenticated streaming chat
-@api_view(['POST'])
-@authentication_classes([LenientTokenAuthentication])
-@permission_classes([AllowAny])
-def chat_stream(request):
+@async_api_view(['POST'])
+@rate_limit("chat_stream", tokens=True)
+async def chat_stream(request):
     message = request.data.get("message")
     conversation_id = request.data.get("conversation_id")
 
     if not message:
-        return Response({"error": "Message is required"}, status=400)
+        return JsonResponse({"error": "Message is required"}, status=400)
     if not conversation_id:
-        return Response({"error": "conversation_id is required"}, status=400)
+        return JsonResponse({"error": "conversation_id is required"}, status=400)
 
+    chat_user = await aget_chat_user(request)
     try:
-        conversation = Conversation.objects.get(id=conversation_id, user=get_chat_user(request))
+        conversation = await Conversation.objects.aget(id=conversation_id, user=chat_user)
     except Conversation.DoesNotExist:
-        return Response({"error": "Conversation not found"}, status=404)
+        return JsonResponse({"error": "Conversation not found"}, status=404)
+
+    first_turn = conversation.total_messages == 0
 
     # Save user message
-    ChatMessage.objects.create(
+    user_message = await ChatMessage.objects.acreate(
         conversation=conversation,
         role="user",
         content=message
     )
+    await aappend_message(user_message)
+    await Conversation.abump_version(conversation.id, added_messages=1)
 
-    # Fetch last 20 messages for context
-    messages = ChatMessage.objects.filter(conversation=conversation).order_by("timestamp")[:20]
-    history = [{"role": m.role, "content": m.content} for m in messages]
-
-    # Streaming generator
-    def stream():
-        full_response = ""
-        for chunk in ask_gemini_stream(history):
-            full_response += chunk
-            yield chunk
-        # Save AI response after streaming finishes
-        ChatMessage.objects.create(
-            conversation=conversation,
-            role="model",
-            content=full_response
-        )
+    # Newest messages that fit the token budget
+    history = await abuild_history(conversation)
+
+    # Generate into the stream buffer; this response (and any reconnect)
+    # follows it, so the reply is saved even if the client goes away
+    key = streams.stream_key(conversation.id, user_message.id)
+    turn = stream_turn(conversation, chat_user, message, history, first_turn, quota_identity(request))
+    buffer = await streams.start(key, turn)
 
-    response = StreamingHttpResponse(stream(), content_type='text/plain')
+    if sse.wants_sse(request):
+        return sse.response(buffer.follow(key), turn=user_message.id)
+
+    response = StreamingHttpResponse(sse.plain_text(buffer.follow(key)), content_type='text/plain')
     response['X-Accel-Buffering'] = 'no'  # Optional: disable buffering for immediate streaming
     return response
 
 
-# Public unauthenticated streaming endpoint
-@api_view(['POST'])
-@authentication_classes([])  # No auth
-@permission_classes([AllowAny])
-def chat_stream_public(request):
+@async_api_view(['GET'])
+async def resume_chat_stream(request, conversation_id):
     """
-    Example endpoint for testing streaming without auth (Postman-friendly)
+    Reconnect to an SSE chat stream.
+
+    Reads the Last-Event-ID header (or ?last_event_id=) left by a token
+    event and replays that turn from the offset: from the stream buffer
+    while it is live, else from the saved reply.
     """
     try:
-        data = json.loads(request.body)
-    except Exception:
-        return Response({"error": "Invalid JSON"}, status=400)
+        turn, offset = sse.parse_event_id(
+            request.headers.get("Last-Event-ID") or request.GET.get("last_event_id")
+        )
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    chat_user = await aget_chat_user(request)
+    try:
+        conversation = await Conversation.objects.aget(id=conversation_id, user=chat_user)
+    except Conversation.DoesNotExist:
+        return JsonResponse({"error": "Conversation not found"}, status=404)
+
+    # Still generating (or recently finished): follow the live buffer
+    buffer = streams.get_stream_buffer()
+    key = streams.stream_key(conversation.id, turn)
+    if await buffer.exists(key):
+        return sse.response(buffer.follow(key, offset), turn=turn, offset=offset)
+
+    # Otherwise the reply to a turn is the first model message saved after it
+    reply = await conversation.messages.filter(role="model", id__gt=turn).order_by("id").afirst()
+    if reply is None or not await conversation.messages.filter(id=turn, role="user").aexists():
+        return JsonResponse({"error": "Stream not found"}, status=404)
+
+    async def replay():
+        if offset < len(reply.content):
+            yield "token", {"delta": reply.content[offset:]}
+        yield "usage", message_usage_fields(reply)
+        yield "done", {"message_id": reply.id}
+
+    return sse.response(replay(), turn=turn, offset=offset)
 
-    message = data.get("message")
+
+async def reply_events(messages):
+    """(event, data) pairs for a one-off streamed reply that is not saved."""
+    try:
+        async for chunk in aask_gemini_stream(messages):
+            yield "token", {"delta": chunk}
+    except ModelError as e:
+        yield "error", model_error_payload(e)[0]
+        return
+    yield "done", {"message_id": None}
+
+
+# Public unauthenticated streaming endpoint
+@async_api_view(['POST'])
+@rate_limit("chat_stream")
+async def chat_stream_public(request):
+    """
+    Example endpoint for testing streaming without auth (Postman-friendly)
+    """
+    message = request.data.get("message")
     if not message:
-        return Response({"error": "Message is required"}, status=400)
+        return JsonResponse({"error": "Message is required"}, status=400)
 
     messages = [{"role": "user", "content": message}]
 
+    if sse.wants_sse(request):
+        return sse.response(reply_events(messages))
+
     response = StreamingHttpResponse(
-        ask_gemini_stream(messages),
+        sse.plain_text(reply_events(messages)),
         content_type='text/plain'
     )
     response['X-Accel-Buffering'] = 'no'
     return response
 
 
-import os
-from google import genai
-from google.genai import types  # <--- Essential for file bytes
-from django.shortcuts import get_object_or_404
-from rest_framework.authentication import TokenAuthentication
-from rest_framework.permissions import IsAuthenticated
-from rest_framework.parsers import MultiPartParser, FormParser
-from django.core.cache import cache
+@method_decorator(async_api_view(['POST']), name="dispatch")
+class FileUploadChatView(View):
 
-class FileUploadChatView(APIView):
-    parser_classes = (MultiPartParser, FormParser)
-    authentication_classes = [LenientTokenAuthentication]
-    permission_classes = [AllowAny]
-
-    def post(self, request):
-        conversation_id = request.data.get("conversation_id")
+    @method_decorator(rate_limit("upload", tokens=True))
+    async def post(self, request):
+        conversation_id = request.POST.get("conversation_id")
         file = request.FILES.get("file")
-        prompt = request.data.get("prompt", "Analyze this file.")
+        prompt = request.POST.get("prompt", "Analyze this file.")
 
         if not file or not conversation_id:
-            return Response({"error": "file and conversation_id are required"}, status=400)
-
-        conversation = get_object_or_404(Conversation, id=conversation_id, user=get_chat_user(request))
-
-        # 1. MIME TYPE FIXER logic
-        # Gemini is picky about 'application/msword'. 
-        # We try to detect if it's a type Gemini likes, otherwise we fallback.
-        supported_types = [
-            'application/pdf', 'image/jpeg', 'image/png', 
-            'image/webp', 'text/plain', 'application/json',
-            'application/vnd.openxmlformats-officedocument.wordprocessingml.document' # .docx
-        ]
-        
-        mime_type = file.content_type
-        
-        # If it's a known problematic type like .doc, we warn the user or try text/plain
-        if mime_type == 'application/msword':
-            return Response({
-                "error": "Gemini does not support old .doc files. Please save as .pdf or .docx"
-            }, status=400)
-
-        # 2. Save User Message
-        user_msg = ChatMessage.objects.create(
-            conversation=conversation,
-            role="user",
-            content=prompt,
-            file=file
-        )
+            return JsonResponse({"error": "file and conversation_id are required"}, status=400)
 
+        chat_user = await aget_chat_user(request)
         try:
-            # 3. Initialize Gemini Client
-            client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
-
-            file.seek(0)
-            file_bytes = file.read()
-
-            # 4. Request Analysis
-            response = client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=[
-                    prompt,
-                    types.Part.from_bytes(
-                        data=file_bytes,
-                        mime_type=mime_type
-                    )
-                ]
-            )
-            
-            ai_text = response.text
+            conversation = await Conversation.objects.aget(id=conversation_id, user=chat_user)
+        except Conversation.DoesNotExist:
+            return JsonResponse({"detail": "No Conversation matches the given query."}, status=404)
 
-            # 5. Save AI response
-            ChatMessage.objects.create(
+        # 1. Sniff the MIME type from the leading bytes; the client's
+        # content_type is only a hint and is often wrong
+        mime_type = uploads.sniff_mime_type(file)
+
+        # Old .doc files get a specific hint; anything else unknown is refused
+        if mime_type == 'application/msword':
+            return JsonResponse({
+                "error": "Gemini does not support old .doc files. Please save as .pdf or .docx"
+            }, status=400)
+        if mime_type not in uploads.SUPPORTED_TYPES:
+            return JsonResponse({
+                "error": "Unsupported file type. Upload a PDF, DOCX, image, text or JSON file."
+            }, status=415)
+
+        # 2. Save User Message; content already stored is referenced,
+        # not written again
+        digest = await sync_to_async(uploads.file_digest)(file)
+        user_msg = await sync_to_async(attach_upload)(conversation, prompt, file, digest, mime_type)
+        await aappend_message(user_msg)
+        await Conversation.abump_version(conversation.id, added_messages=1)
+
+        async def analyse(progress=None):
+            # 3. Request Analysis; a repeat of the same file and prompt is
+            # answered from the cache, long documents are read in chunks
+            usage = Usage()
+            ai_text = await aask_gemini_upload(file, prompt, mime_type, digest, usage=usage, progress=progress)
+
+            # 4. Save AI response
+            model_message = await ChatMessage.objects.acreate(
                 conversation=conversation,
                 role="model",
-                content=ai_text
+                content=ai_text,
+                **message_usage_fields(usage)
             )
+            await aappend_message(model_message)
+            await arecord_usage(conversation.id, chat_user.id, usage, identity=quota_identity(request))
+            await Conversation.abump_version(conversation.id, added_messages=1)
+            return ai_text, model_message, usage
+
+        # SSE clients see progress events while long documents are analysed
+        if sse.wants_sse(request):
+            return sse.response(self.progress_events(analyse))
+
+        ai_text, _, _ = await analyse()
+        return JsonResponse({"analysis": ai_text, "conversation_id": conversation.id, "title": conversation.title})
+
+    @staticmethod
+    async def progress_events(analyse):
+        """Run ``analyse`` in the background, yielding its progress and then the result."""
+        queue = asyncio.Queue()
+        task = asyncio.ensure_future(analyse(queue.put))
+        # Finish (and save) the analysis even if the client goes away.
+        streams.RUNNING.add(task)
+        task.add_done_callback(streams.RUNNING.discard)
+
+        while not task.done() or not queue.empty():
+            getter = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                yield "progress", getter.result()
+            else:
+                getter.cancel()
 
-            conversation.total_messages = conversation.messages.count()
-            conversation.save(update_fields=["total_messages"])
+        try:
+            ai_text, model_message, usage = task.result()
+        except ModelError as e:
+            yield "error", model_error_payload(e)[0]
+            return
+        yield "token", {"delta": ai_text}
+        yield "usage", message_usage_fields(usage)
+        yield "done", {"message_id": model_message.id}
 
-            return Response({"analysis": ai_text, "conversation_id": conversation.id, "title": conversation.title})
 
-        except Exception as e:
-            return Response({"error": f"AI Processing Error: {str(e)}"}, status=500)
 class ChatMessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = ChatMessage
@@ -668,18 +883,16 @@ class ChatMessageSerializer(serializers.ModelSerializer):
 
 
 
-@api_view(['POST'])
-@authentication_classes([]) # Disable authentication for this view
-@permission_classes([AllowAny]) # Allow anyone to access
-def chat_stream_view(request):
-    data = json.loads(request.body)
-    message = data.get("message", "")
+@async_api_view(['POST'])
+@rate_limit("chat_stream")
+async def chat_stream_view(request):
+    message = request.data.get("message", "")
     
     # We pass the list of messages to our gemini function
     messages = [{"role": "user", "content": message}]
     
     response = StreamingHttpResponse(
-        ask_gemini_stream(messages), 
+        sse.plain_text(reply_events(messages)),
         content_type='text/plain'
     )
-    return response
\ No newline at end of file
+    return response